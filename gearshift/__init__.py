@@ -3,7 +3,7 @@
 from gearshift import config
 from gearshift import dispatch
 from gearshift.controllers import expose, render, markup, flash, validate, \
-                                  redirect, url, elements
+                                  redirect, url, elements, pagecache
 from gearshift.errorhandling import error_handler, exception_handler
 from gearshift import controllers, view, database, validators, \
                       i18n, startup
@@ -16,7 +16,7 @@ from gearshift.startup import start_server
 
 i18n.install() # adds _ (gettext) to builtins namespace
 
-__all__ = ["url", "expose", "redirect", "validate", "flash",
+__all__ = ["url", "expose", "redirect", "validate", "flash", "pagecache",
            "error_handler", "exception_handler",
            "view", "controllers", "update_config",
            "database", "command", "validators",
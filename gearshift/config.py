@@ -42,6 +42,10 @@ server = cp_config
 #   Config values that are not server-wide should be put here.
 app = dict()
 
+# Incremented by every update, so that values derived from the config
+# can tell when they need to be computed again.
+generation = 0
+
 def get(*args):
     """Get a config setting.  Uses request.config if available,
     otherwise defaults back to server's config settings.
@@ -295,7 +299,7 @@ def update(configvalues):
     The values are sent to the appropriate config system 
     (server, app, or logging) automatically.
     """
-    global server, app
+    global server, app, generation
 
     # Send key values for applications to app, logging to logging, and
     # the rest to server.  app keys are identified by their leading slash.
@@ -318,4 +322,5 @@ def update(configvalues):
                                   "Use tools.visit.on instead.",
                                   DeprecationWarning, 2)                
                     server['tools.visit.on'] = value
+    generation += 1
 
@@ -121,6 +121,8 @@ cherrypy.tools.markup = tools.MarkupTool()
 markup = cherrypy.tools.markup
 cherrypy.tools.elements = tools.ElementTool()
 elements = cherrypy.tools.elements
+cherrypy.tools.pagecache = tools.PageCacheTool()
+pagecache = cherrypy.tools.pagecache
 
 class Controller(object):
     """Base class for a web application's controller.
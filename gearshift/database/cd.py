@@ -1,26 +1,31 @@
-from cherrypy import request
+import threading
 
 import couchdb
 from couchdb.client import Server
 
 from gearshift import config
 
-class CouchDBDatastore(object):
+class CouchDBDatastore(threading.local):
+    """Access to the configured CouchDB database.
+
+    Each thread keeps its own database object and thereby its own HTTP
+    connection, which is reused for all requests handled by the thread.
+
+    """
 
     def db(self):
-        if hasattr(request, "_couchdb_db"):
-            db = request._couchdb_db
-        else:
-            dburi = config.get("couchdb.dburi")
+        settings = (config.get("couchdb.dburi"),
+            config.get("couchdb.database"),
+            config.get("couchdb.username"), config.get("couchdb.password"))
+        if getattr(self, '_settings', None) != settings:
+            dburi, database, username, password = settings
             server = Server(dburi)
-            username = config.get("couchdb.username")
-            password = config.get("couchdb.password")
             if username:
                 server.resource.http.add_credentials(username, password)
-            db = server[config.get("couchdb.database")]
-            request._couchdb_db = db
-        return db
-    
+            self._db = server[database]
+            self._settings = settings
+        return self._db
+
     db = property(db)
-        
-datastore = CouchDBDatastore()
\ No newline at end of file
+
+datastore = CouchDBDatastore()
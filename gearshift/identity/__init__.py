@@ -26,8 +26,12 @@ __all__ = [
     'encrypt_password',
     'from_host',
     'from_any_host',
+    'get_default_provider',
     'get_identity_errors',
     'get_failure_url',
+    'invalidate_identity',
+    'invalidate_user',
+    'missing_model_classes',
     'in_all_groups',
     'in_any_group',
     'in_group',
@@ -35,10 +39,14 @@ __all__ = [
     'has_any_permission',
     'has_permission',
     'not_anonymous',
+    'pw_needs_rehash',
     'require',
     'set_current_identity',
     'set_current_provider',
+    'set_default_provider',
     'set_identity_errors',
+    'start_default_provider',
+    'verify_pw_with_algorithm',
     'was_login_attempted',
 ]
 
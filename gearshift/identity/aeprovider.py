@@ -157,12 +157,14 @@ class AppEngineIdentity(object):
             key = "VISITIDENTITY:%s" % self.visit_key
             visit = visit_class(key_name=key, user_id=str(self._user.key()))
         visit.put()
+        identity.invalidate_identity(self.visit_key)
 
     def logout(self):
         """Remove the link between this identity and the visit."""
         visit = self.visit_link
         if visit:
             visit.delete()
+        identity.invalidate_identity(self.visit_key)
         # Clear the current identity
         identity.set_current_identity(AppEngineIdentity())
 
@@ -213,9 +215,14 @@ class AppEngineIdentityProvider(object):
 
         # Default encryption algorithm is to use plain text passwords
         algorithm = get("tools.identity.aeprovider.encryption_algorithm", None)
+        self.encryption_algorithm = algorithm
         self.encrypt_password = lambda pw: \
             identity.encrypt_pw_with_algorithm(algorithm, pw)
 
+    def missing_model(self):
+        """Return the names of the model classes that could not be loaded."""
+        return identity.missing_model_classes(globals())
+
     def create_provider_model(self):
         """Create the database tables if they don't already exist."""
         return
@@ -264,7 +271,15 @@ class AppEngineIdentityProvider(object):
         subclass SqlObjectIdentityProvider, and override this method.
 
         """
-        return user.password == self.encrypt_password(password)
+        algorithm = self.encryption_algorithm
+        if not identity.verify_pw_with_algorithm(
+                algorithm, password, user.password):
+            return False
+        if identity.pw_needs_rehash(algorithm, user.password):
+            # Convert it to a hash with the current algorithm
+            user.password = self.encrypt_password(password)
+            user.put()
+        return True
 
     def load_identity(self, visit_key):
         """Lookup the principal represented by user_name.
@@ -384,6 +399,7 @@ class TG_User(db.Model):
                     " and no encryption algorithm specified in config."
                     " Setting password as plaintext.")
         self._SO_set_password(hash)
+        identity.invalidate_user(self.id)
 
     def set_password_raw(self, password):
         """Save the password as-is to the database."""
@@ -14,23 +14,43 @@ __all__ = [
     'current_provider',
     'encrypt_password',
     'encrypt_pw_with_algorithm',
+    'get_default_provider',
     'get_identity_errors',
     'get_failure_url',
+    'invalidate_identity',
+    'invalidate_user',
+    'missing_model_classes',
+    'pw_needs_rehash',
     'set_current_identity',
     'set_current_provider',
+    'set_default_provider',
     'set_identity_errors',
     'set_login_attempted',
+    'start_default_provider',
     'was_login_attempted',
     'verify_identity_status',
+    'verify_pw_with_algorithm',
 ]
 
 
+import base64
+import hmac
 import logging
+import os
+import sys
 try:
 	from hashlib import md5, sha1
 except ImportError:
 	from md5 import md5
 	from sha import sha as sha1
+try:
+    from hashlib import sha256
+except ImportError: # Python < 2.5
+    sha256 = None
+try:
+    from hashlib import pbkdf2_hmac
+except ImportError: # Python < 2.7.8
+    pbkdf2_hmac = None
 import threading
 
 import cherrypy
@@ -43,6 +63,12 @@ from gearshift.identity.exceptions import *
 
 log = logging.getLogger('gearshift.identity')
 
+# Global caches of resolved identities, see gearshift.identity.cache
+_identity_caches = []
+
+# The identity provider shared by all requests and non-request code
+_default_provider = None
+_default_provider_lock = threading.Lock()
 
 def create_default_provider():
     """Create default identity provider.
@@ -69,6 +95,62 @@ def create_default_provider():
     else:
         return provider_class()
 
+def get_default_provider():
+    """Get the identity provider of the application.
+
+    The provider is normally created on startup by start_default_provider().
+    Otherwise it is created from the configuration when first needed, for
+    instance by scripts using identity.current_provider.
+
+    """
+    if _default_provider is None:
+        _default_provider_lock.acquire()
+        try:
+            if _default_provider is None:
+                set_default_provider(create_default_provider())
+        finally:
+            _default_provider_lock.release()
+    return _default_provider
+
+
+def set_default_provider(provider):
+    """Set the identity provider of the application (None to reset it)."""
+    global _default_provider
+    _default_provider = provider
+
+
+def missing_model_classes(namespace):
+    """Return the names of the model classes missing in the namespace.
+
+    The bundled providers load their user_class, group_class,
+    permission_class and visit_class into module globals; their
+    missing_model() method passes these globals here.
+
+    """
+    return [name for name in ('group_class', 'permission_class',
+        'user_class', 'visit_class') if namespace.get(name) is None]
+
+
+def start_default_provider():
+    """Create the identity provider of the application on startup.
+
+    Raises an IdentityConfigurationException if the provider or its model
+    classes cannot be loaded, so that this shows up before the first request.
+    The model is checked with the missing_model() method of the provider,
+    if it has one, which returns the names of the classes not loaded.
+
+    """
+    provider = create_default_provider()
+    missing_model = getattr(provider, 'missing_model', None)
+    missing = missing_model and missing_model()
+    if missing:
+        raise IdentityConfigurationException(
+            "Could not load the identity model (%s) of %s, check the"
+            " tools.identity model settings" % (', '.join(missing),
+                provider.__class__.__name__))
+    set_default_provider(provider)
+    return provider
+
 def was_login_attempted():
     try:
         return cherrypy.request.identity_login_attempted
@@ -97,25 +179,128 @@ def set_current_provider(provider):
     cherrypy.request.identityProvider = provider
 
 
+def set_identity_caches(*caches):
+    _identity_caches[:] = [cache for cache in caches if cache is not None]
+
+
+def invalidate_identity(visit_key):
+    """Drop the cached identity of the visit with the given key.
+
+    This is called by the identity providers on login and logout.
+
+    """
+    if visit_key is not None:
+        for cache in _identity_caches:
+            cache.remove(visit_key)
+
+
+def invalidate_user(user_id):
+    """Drop all cached identities of the given user.
+
+    Call this when the password, groups or permissions of the user have
+    changed. Only the caches of this process are reached; caches of other
+    processes, except file based ones, keep the identities until they are
+    older than the ttl of the cache.
+
+    """
+    for cache in _identity_caches:
+        cache.remove_user(user_id)
+
+
+# Prefix of password hashes made with the 'pbkdf2' algorithm, the hash is
+# followed by the number of iterations, the salt and the derived key
+_pbkdf2_prefix = 'pbkdf2_sha256$'
+
+# Bounds the number of passwords hashed at once, see _hash_password()
+_hash_slots = None
+_hash_generation = None
+_hash_slots_lock = threading.Lock()
+
+
+def _pbkdf2(password, salt, iterations):
+    """Return the base64 encoded PBKDF2-HMAC-SHA256 key of the password."""
+    if pbkdf2_hmac is not None:
+        key = pbkdf2_hmac('sha256', password, salt, iterations)
+    else:
+        # one block of PBKDF2 suffices for the 32 bytes of a SHA256 digest
+        mac = hmac.new(password, None, sha256)
+        def prf(data):
+            h = mac.copy()
+            h.update(data)
+            return h.digest()
+        u = prf(salt + '\0\0\0\1')
+        result = long(u.encode('hex'), 16)
+        for i in xrange(iterations - 1):
+            u = prf(u)
+            result ^= long(u.encode('hex'), 16)
+        key = ('%064x' % result).decode('hex')
+    return base64.b64encode(key)
+
+
+def _hash_password(password, salt, iterations):
+    """Return _pbkdf2() of the password, hashing few passwords at once.
+
+    At most tools.identity.hash_threads (default 2) passwords are hashed at
+    the same time, further threads wait for a free slot. A burst of logins
+    thereby leaves CPU time, and with the pure Python fallback the GIL, to
+    the other request threads.
+
+    """
+    global _hash_slots, _hash_generation
+    slots = _hash_slots
+    if slots is None or _hash_generation != gearshift.config.generation:
+        _hash_slots_lock.acquire()
+        try:
+            if (_hash_slots is None
+                    or _hash_generation != gearshift.config.generation):
+                _hash_slots = threading.BoundedSemaphore(max(1,
+                    gearshift.config.get('tools.identity.hash_threads', 2)))
+                _hash_generation = gearshift.config.generation
+            slots = _hash_slots
+        finally:
+            _hash_slots_lock.release()
+    slots.acquire()
+    try:
+        return _pbkdf2(password, salt, iterations)
+    finally:
+        slots.release()
+
+
+def _to_8bit(password):
+    # The algorithms don't work with unicode objects, so decode first.
+    if isinstance(password, unicode):
+        return password.encode('utf-8')
+    return password
+
+
 def encrypt_pw_with_algorithm(algorithm, password):
     """Hash the given password with the specified algorithm.
 
-    Valid values for algorithm are 'md5' and 'sha1' or 'custom'. If the
-    algorithm is 'custom', the config setting 'tools.identity.custom_encryption'
-    needs to be set to a dotted-notation path to a callable that takes
-    an unencrypted password and gives back the password hash.
+    Valid values for algorithm are 'pbkdf2', 'md5' and 'sha1' or 'custom'.
+    The 'pbkdf2' algorithm uses a random salt and the number of iterations
+    given by 'tools.identity.pbkdf2.iterations' (default 100000), both are
+    stored in the hash, so verify_pw_with_algorithm() must be used to check
+    passwords. If the algorithm is 'custom', the config setting
+    'tools.identity.custom_encryption' needs to be set to a dotted-notation
+    path to a callable that takes an unencrypted password and gives back the
+    password hash.
 
     All other algorithm values will be essentially a no-op.
 
     """
     
     hashed_password = password
-    # The algorithms don't work with unicode objects, so decode first.
-    if isinstance(password, unicode):
-        password_8bit = password.encode('utf-8')
-    else:
-        password_8bit = password
-    if algorithm == 'md5':
+    password_8bit = _to_8bit(password)
+    if algorithm == 'pbkdf2':
+        if sha256 is None:
+            raise IdentityConfigurationException(
+                "The pbkdf2 algorithm needs Python 2.5 or newer")
+        iterations = int(gearshift.config.get(
+            'tools.identity.pbkdf2.iterations', 100000))
+        salt = base64.b64encode(os.urandom(12))
+        hashed_password = '%s%d$%s$%s' % (_pbkdf2_prefix, iterations, salt,
+            _hash_password(password_8bit, salt, iterations))
+    elif algorithm == 'md5':
         hashed_password =  md5(password_8bit).hexdigest()
     elif algorithm == 'sha1':
         hashed_password = sha1(password_8bit).hexdigest()
@@ -133,6 +318,67 @@ def encrypt_pw_with_algorithm(algorithm, password):
         hashed_password = hashed_password.decode('utf-8')
     return hashed_password
 
+
+def _compare_digest(a, b):
+    """Compare two strings in time independent of their common prefix."""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def verify_pw_with_algorithm(algorithm, password, hashed_password):
+    """Check the password against a hash made by encrypt_pw_with_algorithm.
+
+    Hashes made with the 'pbkdf2' algorithm are verified with the salt and
+    iterations stored in them. Other hashes are compared to the hash of the
+    password with the given algorithm or, if that is 'pbkdf2', with the
+    algorithm of the existing hashes given by the config setting
+    'tools.identity.legacy_encryption_algorithm'. If that is not set, other
+    hashes are rejected; set it to 'plain' to accept stored plaintext
+    passwords.
+
+    """
+    if hashed_password is None:
+        return False
+    if hashed_password.startswith(_pbkdf2_prefix):
+        try:
+            iterations, salt, key = hashed_password[
+                len(_pbkdf2_prefix):].split('$')
+            iterations = int(iterations)
+        except ValueError:
+            log.warning("Malformed pbkdf2 password hash")
+            return False
+        return _compare_digest(str(key),
+            _hash_password(_to_8bit(password), str(salt), iterations))
+    if algorithm == 'pbkdf2':
+        algorithm = gearshift.config.get(
+            'tools.identity.legacy_encryption_algorithm', None)
+        if not algorithm:
+            log.warning("Password hash is not pbkdf2 and"
+                " tools.identity.legacy_encryption_algorithm is not set")
+            return False
+    return hashed_password == encrypt_pw_with_algorithm(algorithm, password)
+
+
+def pw_needs_rehash(algorithm, hashed_password):
+    """Check whether the password hash should be replaced on login.
+
+    This is the case for hashes made with an older algorithm or with fewer
+    iterations than configured now.
+
+    """
+    if algorithm != 'pbkdf2' or hashed_password is None:
+        return False
+    if not hashed_password.startswith(_pbkdf2_prefix):
+        return True
+    iterations = hashed_password[len(_pbkdf2_prefix):].split('$', 1)[0]
+    return iterations != str(gearshift.config.get(
+        'tools.identity.pbkdf2.iterations', 100000))
+
+
 _encrypt_password = deprecated(
     "Use identity.encrypt_pw_with_algorithm instead."
 )(encrypt_pw_with_algorithm)
@@ -185,7 +431,7 @@ class ProviderWrapper(object):
             provider = cherrypy.request.identityProvider
         except AttributeError:
             try:
-                provider = create_default_provider()
+                provider = get_default_provider()
             except Exception:
                 provider = None
 
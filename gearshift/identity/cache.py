@@ -0,0 +1,232 @@
+"""A cache of resolved identities by visit key.
+
+Loading the identity of an authenticated visit takes a query for the visit
+link, one for the user and further ones for the groups and permissions of
+the user. With the identity cache enabled, the user id, user name, groups,
+permissions and group ids are cached per visit key for some seconds:
+
+    tools.identity.cache.on = True
+    tools.identity.cache.ttl = 60
+    # "memory" (default) for an LRU cache per process,
+    # "file" for a cache shared by the processes on a host
+    # or the dotted path of a custom cache class
+    tools.identity.cache.backend = "memory"
+    tools.identity.cache.size = 10000
+    tools.identity.cache.path = "/var/cache/myapp/identity"
+
+Cached identities are dropped on login and logout. When the groups or
+permissions of a user change, call identity.invalidate_user(user_id).
+Note that with the memory backend, other processes may still use the old
+identity until the ttl has passed.
+
+"""
+
+import cPickle as pickle
+import logging
+import os
+import tempfile
+import time
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from gearshift import config
+from gearshift.identity.exceptions import get_failure_url
+from gearshift.util import load_class, LRUCache
+
+log = logging.getLogger("gearshift.identity.cache")
+
+
+def create_identity_cache():
+    """Create the identity cache specified in the config file or None."""
+    get = config.get
+    if not get("tools.identity.cache.on", False):
+        return None
+    ttl = get("tools.identity.cache.ttl", 60)
+    backend = get("tools.identity.cache.backend", "memory")
+    if backend == "memory":
+        return MemoryIdentityCache(
+            get("tools.identity.cache.size", 10000), ttl)
+    if backend == "file":
+        return FileIdentityCache(
+            get("tools.identity.cache.path", "identity-cache"), ttl)
+    cache_class = load_class(backend)
+    if cache_class is None:
+        raise config.ConfigError(
+            "Identity cache backend missing: %s" % backend)
+    return cache_class(ttl)
+
+
+def cache_entry(identity):
+    """Return the cacheable information of an identity."""
+    return (identity.user_id, identity.user_name, frozenset(identity.groups),
+        frozenset(identity.permissions), frozenset(identity.group_ids))
+
+
+class CachedIdentity(object):
+    """An authenticated identity restored from the identity cache.
+
+    Anything but the cached information is taken from the identity returned
+    by the load function, which is only called when it is actually needed.
+
+    """
+
+    anonymous = False
+
+    def __init__(self, visit_key, entry, load):
+        self.visit_key = visit_key
+        (self.user_id, self.user_name, self.groups, self.permissions,
+            self.group_ids) = entry
+        self._load = load
+        self._identity = None
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        identity = self._identity
+        if identity is None:
+            identity = self._identity = self._load()
+        return getattr(identity, name)
+
+    @property
+    def login_url(self):
+        """Get the URL for the login page."""
+        return get_failure_url()
+
+
+class MemoryIdentityCache(LRUCache):
+    """An LRU cache of identities in the memory of this process."""
+
+    def __init__(self, size=10000, ttl=60):
+        super(MemoryIdentityCache, self).__init__(size, ttl)
+        # the time at which the identities of a user have been invalidated
+        self._invalidated = dict()
+
+    def _is_fresh(self, entry, stored):
+        return (time.time() - stored <= self.ttl
+            and self._invalidated.get(entry[0], 0) < stored)
+
+    def remove_user(self, user_id):
+        """Remove the cached identities of the given user."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            invalidated = self._invalidated
+            # older invalidations can not affect cached entries any more
+            for other_id, stamp in invalidated.items():
+                if now - stamp > self.ttl:
+                    del invalidated[other_id]
+            invalidated[user_id] = now
+        finally:
+            self.lock.release()
+
+
+class FileIdentityCache(object):
+    """A cache of identities in files shared by the processes on a host.
+
+    Every cached identity is stored in its own file, which is replaced
+    atomically. A user's identities are invalidated by touching a file for
+    the user; cached identities older than that file are not used. Files
+    which can no longer be used are removed on access and, at most once per
+    ttl, by sweeping the cache directories when an identity is stored.
+
+    """
+
+    def __init__(self, path, ttl=60):
+        self.path = path
+        self.ttl = ttl
+        self._next_cleanup = time.time() + ttl
+        for directory in ('visits', 'users'):
+            directory = os.path.join(path, directory)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def _filename(self, directory, key):
+        return os.path.join(self.path, directory,
+            sha1(unicode(key).encode('utf-8')).hexdigest())
+
+    def _mtime(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def get(self, visit_key):
+        """Return the cached identity information of the visit or None."""
+        filename = self._filename('visits', visit_key)
+        stored = self._mtime(filename)
+        if stored is None:
+            return None
+        if time.time() - stored > self.ttl:
+            self.remove(visit_key)
+            return None
+        try:
+            f = open(filename, 'rb')
+            try:
+                entry = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        invalidated = self._mtime(self._filename('users', entry[0]))
+        if invalidated is not None and invalidated >= stored:
+            self.remove(visit_key)
+            return None
+        return entry
+
+    def put(self, visit_key, entry):
+        """Store the identity information of the visit."""
+        if time.time() >= self._next_cleanup:
+            self.cleanup()
+        fd, tmpname = tempfile.mkstemp(dir=self.path)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(entry, f, 2)
+            finally:
+                f.close()
+            os.rename(tmpname, self._filename('visits', visit_key))
+        except (IOError, OSError), e:
+            log.warning("Could not cache identity: %s", e)
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+
+    def remove(self, visit_key):
+        """Remove the cached identity of the visit."""
+        try:
+            os.remove(self._filename('visits', visit_key))
+        except OSError:
+            pass
+
+    def remove_user(self, user_id):
+        """Remove the cached identities of the given user."""
+        filename = self._filename('users', user_id)
+        open(filename, 'w').close()
+        os.utime(filename, None)
+
+    def cleanup(self):
+        """Remove the files which are older than the ttl.
+
+        Expired identities are never used again, and invalidation marks of
+        users can only affect identities stored within the ttl.
+
+        """
+        now = time.time()
+        self._next_cleanup = now + self.ttl
+        for directory in ('visits', 'users'):
+            directory = os.path.join(self.path, directory)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                filename = os.path.join(directory, name)
+                stored = self._mtime(filename)
+                if stored is not None and now - stored > self.ttl:
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        pass
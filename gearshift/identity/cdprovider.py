@@ -1,14 +1,17 @@
 import logging
+import socket
 from datetime import datetime
 
 import couchdb
-from couchdb.client import ResourceNotFound, ResourceConflict
+from couchdb.client import ResourceNotFound, ResourceConflict, ServerError
+from couchdb.design import ViewDefinition
 from couchdb.schema import Document, Schema, BooleanField, DateTimeField, \
                            IntegerField, TextField, DictField, ListField, View
 
 import gearshift
 from gearshift import identity
 from gearshift.util import load_class
+from gearshift.visit import invalidate_visit
 from gearshift.database.cd import datastore
 
 log = logging.getLogger("gearshift.identity.cdprovider")
@@ -31,6 +34,26 @@ permission_class = None
 visit_class = None
 foreign_user_class = None
 
+
+def user_memberships(db, user_id):
+    """Return the group and permission documents of the user.
+
+    Both are fetched from the memberships view, including the linked
+    documents, so this takes two queries regardless of the number of groups.
+
+    """
+    groups = [row.doc for row in TG_UserGroup.memberships(db,
+        key=[user_id, 'group'], include_docs=True) if row.doc is not None]
+    if not groups:
+        return [], []
+    permissions = dict()
+    for row in TG_UserGroup.memberships(db, keys=[[group.id, 'permission']
+            for group in groups], include_docs=True):
+        if row.doc is not None:
+            permissions[row.doc.id] = row.doc
+    return groups, permissions.values()
+
+
 class CouchDbIdentity(object):
     """Identity that uses a model from a database (via CoachDB)."""
 
@@ -51,21 +74,49 @@ class CouchDbIdentity(object):
             pass
         # Attempt to load the user. After this code executes, there *will* be
         # a _user attribute, even if the value is None.
-        visit = self.visit_link
-        if visit:
+        self._user = None
+        if self.visit_key is not None:
             try:
-                self._user = user_class.load(datastore.db, visit.user_id)
-            except Exception:
-                log.warning("Datastore timeout for user with ID: %s", 
-                            visit.user_id)
-                self_user = None
-                
-            if not self._user:
-                log.warning("No such user with ID: %s", visit.user_id)
-        else:
-            self._user = None
+                self._load_visit()
+            except (socket.error, ServerError), e:
+                # the database is unreachable or failing, anything else
+                # like a missing view is an error of the application
+                log.warning("Datastore error for visit %s: %s",
+                    self.visit_key, e)
         return self._user
 
+    def _load_visit(self):
+        """Load the user linked to the visit.
+
+        The by_visit view returns the user document with the visit identity
+        in a single query. The groups and permissions are always looked up
+        by user when needed, taking two more queries, so that membership
+        changes apply immediately. A map function cannot follow the links
+        from the visit to the user and on to the groups and permissions, so
+        these can not be emitted by a single view without copying them.
+
+        """
+        for row in visit_class.by_visit(datastore.db,
+                key=self.visit_key, include_docs=True):
+            if row.doc is None:
+                # the linked document has been deleted
+                log.warning("No such user with ID: %s", row.value['_id'])
+            else:
+                self._user = user_class.wrap(row.doc)
+
+    def _set_memberships(self, groups, permissions):
+        self._group_ids = frozenset(group.id for group in groups)
+        self._groups = frozenset(group['group_name'] for group in groups)
+        self._permissions = frozenset(
+            permission['permission_name'] for permission in permissions)
+
+    def _load_memberships(self):
+        if not self.user:
+            self._set_memberships((), ())
+        else:
+            self._set_memberships(*user_memberships(
+                datastore.db, self.user.id))
+
     @property
     def user_name(self):
         """Get user name of this identity."""
@@ -93,22 +144,19 @@ class CouchDbIdentity(object):
         except AttributeError:
             # Permissions haven't been computed yet
             pass
-        if not self.user:
-            self._permissions = frozenset()
-        else:
-            self._permissions = frozenset(
-                p.permission_name for p in self.user.permissions)
+        self._load_memberships()
         return self._permissions
 
     @property
     def groups(self):
         """Get set of group names of this identity."""
-        
-        if not self.user:
-            return frozenset()
-                                
-        groups = self.user.groups
-        return groups
+        try:
+            return self._groups
+        except AttributeError:
+            # Groups haven't been computed yet
+            pass
+        self._load_memberships()
+        return self._groups
 
     @property
     def group_ids(self):
@@ -118,11 +166,7 @@ class CouchDbIdentity(object):
         except AttributeError:
             # Groups haven't been computed yet
             pass
-        if not self.user:
-            self._group_ids = frozenset()
-        else:
-            self._group_ids = frozenset(
-                ug.group.id for ug in self.user.user_groups)
+        self._load_memberships()
         return self._group_ids
 
     @property
@@ -146,11 +190,11 @@ class CouchDbIdentity(object):
         else:
             key = "VISITIDENTITY:%s" % self.visit_key
             visit = visit_class(id=key, user_id=str(self._user.id))
-
         try:
             visit.store(datastore.db)
         except ResourceConflict:
-            log.error("Error storing new visitidentity: %s" % key)
+            log.error("Error storing visitidentity: %s" % visit.id)
+        identity.invalidate_identity(self.visit_key)
 
     def logout(self):
         """Remove the link between this identity and the visit."""
@@ -164,6 +208,8 @@ class CouchDbIdentity(object):
             except ResourceConflict:
                 pass
                 
+        invalidate_visit(self.visit_key)
+        identity.invalidate_identity(self.visit_key)
         # Clear the current identity
         identity.set_current_identity(CouchDbIdentity())
 
@@ -207,12 +253,21 @@ class CouchDbIdentityProvider(object):
 
         # Default encryption algorithm is to use plain text passwords
         algorithm = get("tools.identity.cdprovider.encryption_algorithm", None)
+        self.encryption_algorithm = algorithm
         self.encrypt_password = lambda pw: \
             identity.encrypt_pw_with_algorithm(algorithm, pw)
 
+    def missing_model(self):
+        """Return the names of the model classes that could not be loaded."""
+        return identity.missing_model_classes(globals())
+
     def create_provider_model(self):
-        """Create the database tables if they don't already exist."""
-        return
+        """Create the design document for the identity views."""
+        try:
+            ViewDefinition.sync_many(datastore.db,
+                [visit_class.by_visit, TG_UserGroup.memberships])
+        except Exception, e:
+            log.error("Error creating the identity views: %s", e)
 
     def validate_identity(self, user_name, password, visit_key):
         """Validate the identity represented by user_name using the password.
@@ -258,7 +313,15 @@ class CouchDbIdentityProvider(object):
         subclass SqlObjectIdentityProvider, and override this method.
 
         """
-        return user.password == self.encrypt_password(password)
+        algorithm = self.encryption_algorithm
+        if not identity.verify_pw_with_algorithm(
+                algorithm, password, user.password):
+            return False
+        if identity.pw_needs_rehash(algorithm, user.password):
+            # Convert it to a hash with the current algorithm
+            user.password = self.encrypt_password(password)
+            user.store(datastore.db)
+        return True
 
     def load_identity(self, visit_key):
         """Lookup the principal represented by user_name.
@@ -297,7 +360,15 @@ class TG_VisitIdentity(Document):
     type = TextField(default="VisitIdentity")
 ##    visit_key = db.StringProperty(required=True)
     user_id = TextField()
-    
+
+    # the linked user document of a visit
+    by_visit = View('identity', """
+        function(doc) {
+            if (doc.type == 'VisitIdentity' && doc.user_id) {
+                emit(doc._id.substring(14), {_id: doc.user_id});
+            }
+        }""", wrapper=None)
+
     @classmethod
     def by_visit_key(cls, visit_key):
         """Look up VisitIdentity by given visit key."""
@@ -383,6 +454,7 @@ class TG_User(Document):
                     " and no encryption algorithm specified in config."
                     " Setting password as plaintext.")
         self._SO_set_password(hash)
+        identity.invalidate_user(self.id)
 
     def set_password_raw(self, password):
         """Save the password as-is to the database."""
@@ -393,6 +465,16 @@ class TG_UserGroup(Document):
 
     user_id = TextField()
     group_id = TextField()
+
+    # the linked group documents of a user and permission documents of a group
+    memberships = View('identity', """
+        function(doc) {
+            if (doc.type == 'UserGroup') {
+                emit([doc.user_id, 'group'], {_id: doc.group_id});
+            } else if (doc.type == 'GroupPermission') {
+                emit([doc.group_id, 'permission'], {_id: doc.permission_id});
+            }
+        }""", wrapper=None)
     
 class TG_Permission(Document):
     """Permissions for a given group."""
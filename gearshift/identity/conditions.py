@@ -10,6 +10,8 @@ __all__ = [
     'Predicate',
     'SecureObject',
     'SecureResource',
+    'check_predicate',
+    'compile_predicate',
     'from_host',
     'from_any_host',
     'in_all_groups',
@@ -22,6 +24,7 @@ __all__ = [
 ]
 
 
+import threading
 import types
 
 from cherrypy import request
@@ -29,7 +32,86 @@ from gearshift import config
 from gearshift.identity.exceptions import *
 from gearshift.identity.base import current
 from gearshift.decorator import weak_signature_decorator
-from gearshift.util import match_ip
+from gearshift.util import IPRangeSet
+
+
+# Group and permission names used by compiled predicates, mapped to the bit
+# representing them in the masks of an identity
+_bits = dict(group=dict(), permission=dict())
+_bits_lock = threading.Lock()
+
+
+def _bit(kind, name):
+    """Return the bit for the group or permission name."""
+    bits = _bits[kind]
+    try:
+        return bits[name]
+    except KeyError:
+        pass
+    _bits_lock.acquire()
+    try:
+        return bits.setdefault(name,
+            1 << (len(_bits['group']) + len(_bits['permission'])))
+    finally:
+        _bits_lock.release()
+
+
+def _mask(kind, names):
+    """Return the mask for the names used by compiled predicates."""
+    get = _bits[kind].get
+    mask = 0
+    for name in names:
+        mask |= get(name, 0)
+    return mask
+
+
+def identity_masks(identity):
+    """Return group mask, permission mask and anonymity of the identity.
+
+    The masks are computed once per identity, unless predicates using new
+    group or permission names have been compiled since.
+
+    """
+    generation = len(_bits['group']) + len(_bits['permission'])
+    # not using getattr, since identities might load missing attributes
+    cached = identity.__dict__.get('_predicate_masks')
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    if identity.anonymous:
+        masks = (0, 0, True)
+    else:
+        masks = (_mask('group', identity.groups),
+            _mask('permission', identity.permissions), False)
+    identity._predicate_masks = (generation, masks)
+    return masks
+
+
+def compile_predicate(predicate):
+    """Return the compiled evaluator for the predicate.
+
+    The evaluator is called with an identity and the identity_masks() of
+    it and returns whether the predicate holds, without error messages.
+
+    """
+    try:
+        return predicate.__dict__['_evaluator']
+    except KeyError:
+        evaluator = predicate.__dict__['_evaluator'] = predicate.compile()
+        return evaluator
+
+
+def check_predicate(predicate, errors=None):
+    """Evaluate the predicate for the current identity.
+
+    Error messages are only collected if the predicate does not hold.
+
+    """
+    identity = current.identity()
+    if compile_predicate(predicate)(identity, identity_masks(identity)):
+        return True
+    if errors is not None:
+        predicate.eval_with_object(current, errors)
+    return False
 
 
 class Predicate(object):
@@ -38,6 +120,16 @@ class Predicate(object):
         """Determine whether predicate is True or False for the given object."""
         raise NotImplementedError
 
+    def compile(self):
+        """Return an evaluator for compile_predicate().
+
+        This evaluator simply calls eval_with_object(), predicates which can
+        be evaluated on the identity masks provide a faster one.
+
+        """
+        eval_with_object = self.eval_with_object
+        return lambda identity, masks: eval_with_object(identity)
+
     def append_error_message(self, errors=None):
         if errors is None:
             return
@@ -49,6 +141,25 @@ class CompoundPredicate(Predicate):
     def __init__(self, *predicates):
         self.predicates = predicates
 
+    def _compile_parts(self):
+        """Split the sub-predicates into group and permission masks.
+
+        Returns the mask of groups and the mask of permissions required by
+        plain in_group and has_permission sub-predicates, and the compiled
+        evaluators of all other sub-predicates.
+
+        """
+        groups = permissions = 0
+        others = []
+        for p in self.predicates:
+            if type(p) is in_group:
+                groups |= _bit('group', p.group_name)
+            elif type(p) is has_permission:
+                permissions |= _bit('permission', p.permission_name)
+            else:
+                others.append(compile_predicate(p))
+        return groups, permissions, others
+
 
 class All(CompoundPredicate):
     """Logical and of all sub-predicates.
@@ -65,6 +176,19 @@ class All(CompoundPredicate):
                 return False
         return True
 
+    def compile(self):
+        groups, permissions, others = self._compile_parts()
+
+        def evaluator(identity, masks):
+            if (masks[0] & groups != groups
+                    or masks[1] & permissions != permissions):
+                return False
+            for other in others:
+                if not other(identity, masks):
+                    return False
+            return True
+        return evaluator
+
 
 class Any(CompoundPredicate):
     """Logical or of all sub-predicates.
@@ -83,11 +207,23 @@ class Any(CompoundPredicate):
         self.append_error_message(errors)
         return False
 
+    def compile(self):
+        groups, permissions, others = self._compile_parts()
+
+        def evaluator(identity, masks):
+            if masks[0] & groups or masks[1] & permissions:
+                return True
+            for other in others:
+                if other(identity, masks):
+                    return True
+            return False
+        return evaluator
+
 
 class IdentityPredicateHelper(object):
     """A mix-in helper class for Identity Predicates."""
     def __nonzero__(self):
-        return self.eval_with_object(current)
+        return check_predicate(self)
 
 
 class in_group(Predicate, IdentityPredicateHelper):
@@ -103,6 +239,10 @@ class in_group(Predicate, IdentityPredicateHelper):
         self.append_error_message(errors)
         return False
 
+    def compile(self):
+        bit = _bit('group', self.group_name)
+        return lambda identity, masks: bool(masks[0] & bit)
+
 
 class in_all_groups(All, IdentityPredicateHelper):
     """Predicate for requiring membership in a number of groups."""
@@ -131,6 +271,9 @@ class not_anonymous(Predicate, IdentityPredicateHelper):
             return False
         return True
 
+    def compile(self):
+        return lambda identity, masks: not masks[2]
+
 
 class has_permission(Predicate, IdentityPredicateHelper):
     """Predicate for checking whether visitor has a particular permission."""
@@ -146,6 +289,10 @@ class has_permission(Predicate, IdentityPredicateHelper):
         self.append_error_message(errors)
         return False
 
+    def compile(self):
+        bit = _bit('permission', self.permission_name)
+        return lambda identity, masks: bool(masks[1] & bit)
+
 
 class has_all_permissions(All, IdentityPredicateHelper):
     """Predicate for checking whether the visitor has all permissions."""
@@ -180,23 +327,51 @@ class from_host(Predicate, IdentityPredicateHelper):
 
     def __init__(self, host):
         self.host = host
+        self.ranges = IPRangeSet([host])
 
     def eval_with_object(self, obj, errors=None):
         """Match the visitor's host against the criteria."""
-        ip = _remoteHost()
-        if match_ip(self.host, ip):
+        if _remoteHost() in self.ranges:
             return True
         self.append_error_message(errors)
         return False
 
 
 class from_any_host(Any, IdentityPredicateHelper):
-    """Predicate for checking the visitor against a number of allowed hosts."""
+    """Predicate for checking the visitor against a number of allowed hosts.
+
+    The hosts can be given as a list of addresses and address blocks or as
+    an IPRangeSet, e.g. one read from a file with IPRangeSet.from_file().
+
+    """
     error_message = "Access from this host is not permitted."
 
     def __init__(self, hosts):
-        host_predicates = [from_host(h) for h in hosts]
-        super(from_any_host, self).__init__(*host_predicates)
+        # The hosts are matched by the range set only, so the predicates of
+        # the single hosts are not built unless they are asked for.
+        if isinstance(hosts, IPRangeSet):
+            self.ranges = hosts
+            self._hosts = ()
+        else:
+            self._hosts = hosts = tuple(hosts)
+            self.ranges = IPRangeSet(hosts)
+        self._predicates = None
+
+    @property
+    def predicates(self):
+        if self._predicates is None:
+            self._predicates = tuple(from_host(h) for h in self._hosts)
+        return self._predicates
+
+    def eval_with_object(self, obj, errors=None):
+        """Match the visitor's host against all allowed hosts at once."""
+        if _remoteHost() in self.ranges:
+            return True
+        self.append_error_message(errors)
+        return False
+
+    def compile(self):
+        return Predicate.compile(self)
 
 require = None # Will be set by startup
 
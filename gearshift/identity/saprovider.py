@@ -1,8 +1,10 @@
-from sqlalchemy.orm import class_mapper
+from sqlalchemy import and_, bindparam
+from sqlalchemy.orm import class_mapper, eagerload_all
 
 from gearshift import config, identity
-from gearshift.database import session
+from gearshift.database.sa.sa import session
 from gearshift.util import load_class
+from gearshift.visit import invalidate_visit
 
 import logging
 
@@ -15,6 +17,40 @@ group_class = None
 permission_class = None
 visit_class = None
 
+# Query options and criterion for loading a user with groups and permissions
+# in one query, these will be set up on first use.
+_user_options = None
+_user_by_visit = None
+
+
+def _column(cls, name):
+    return class_mapper(cls).get_property(name).columns[0]
+
+def user_query():
+    """Return a query for users with their groups and permissions.
+
+    The groups and permissions are loaded with the users by joins, as given
+    by tools.identity.saprovider.eagerload (default "groups.permissions").
+
+    """
+    global _user_options
+    if _user_options is None:
+        path = config.get("tools.identity.saprovider.eagerload",
+            "groups.permissions")
+        _user_options = path and [eagerload_all(path)] or []
+    return session.query(user_class).options(*_user_options)
+
+def user_for_visit(visit_key):
+    """Return the user linked to the visit or None in a single query."""
+    global _user_by_visit
+    if _user_by_visit is None:
+        _user_by_visit = and_(
+            _column(visit_class, 'user_id') == _column(user_class, 'user_id'),
+            _column(visit_class, 'visit_key') == bindparam('visit_key'))
+    return user_query().filter(_user_by_visit).params(
+        visit_key=visit_key).first()
+
+
 class SqlAlchemyIdentity(object):
     """Identity that uses a model from a database (via SQLAlchemy)."""
 
@@ -35,8 +71,10 @@ class SqlAlchemyIdentity(object):
             pass
         # Attempt to load the user. After this code executes, there *will* be
         # a _user attribute, even if the value is None.
-        visit = self.visit_link
-        self._user = visit and user_class.query.get(visit.user_id)
+        if self.visit_key is None:
+            self._user = None
+        else:
+            self._user = user_for_visit(self.visit_key)
         return self._user
 
     @property
@@ -123,6 +161,7 @@ class SqlAlchemyIdentity(object):
             visit.visit_key = self.visit_key
             visit.user_id = self._user.user_id
         session.flush()
+        identity.invalidate_identity(self.visit_key)
 
     def logout(self):
         """Remove the link between this identity and the visit."""
@@ -130,6 +169,8 @@ class SqlAlchemyIdentity(object):
         if visit:
             session.delete(visit)
             session.flush()
+        invalidate_visit(self.visit_key)
+        identity.invalidate_identity(self.visit_key)
         # Clear the current identity
         identity.set_current_identity(SqlAlchemyIdentity())
 
@@ -141,7 +182,8 @@ class SqlAlchemyIdentityProvider(object):
         super(SqlAlchemyIdentityProvider, self).__init__()
         get = config.get
 
-        global user_class, group_class, permission_class, visit_class
+        global user_class, group_class, permission_class, visit_class, \
+            _user_options, _user_by_visit
 
         user_class_path = get("tools.identity.saprovider.model.user", None)
         user_class = load_class(user_class_path)
@@ -153,11 +195,17 @@ class SqlAlchemyIdentityProvider(object):
         visit_class_path = get("tools.identity.saprovider.model.visit", None)
         log.info("Loading: %s", visit_class_path)
         visit_class = load_class(visit_class_path)
+        _user_options = _user_by_visit = None
         # Default encryption algorithm is to use plain text passwords
         algorithm = get("tools.identity.saprovider.encryption_algorithm", None)
+        self.encryption_algorithm = algorithm
         self.encrypt_password = lambda pw: \
             identity.encrypt_pw_with_algorithm(algorithm, pw)
 
+    def missing_model(self):
+        """Return the names of the model classes that could not be loaded."""
+        return identity.missing_model_classes(globals())
+
     def create_provider_model(self):
         """Create the database tables if they don't already exist."""
         class_mapper(user_class).local_table.create(checkfirst=True)
@@ -176,7 +224,7 @@ class SqlAlchemyIdentityProvider(object):
             permissions: a set of permission names
 
         """
-        user = user_class.query.filter_by(user_name=user_name).first()
+        user = user_query().filter_by(user_name=user_name).first()
         if not user:
             log.warning("No such user: %s", user_name)
             return None
@@ -197,7 +245,14 @@ class SqlAlchemyIdentityProvider(object):
         subclass SqlAlchemyIdentityProvider, and override this method.
 
         """
-        return user.password == self.encrypt_password(password)
+        algorithm = self.encryption_algorithm
+        if not identity.verify_pw_with_algorithm(
+                algorithm, password, user.password):
+            return False
+        if identity.pw_needs_rehash(algorithm, user.password):
+            # Convert it to a hash with the current algorithm
+            user.password = password
+        return True
 
     def load_identity(self, visit_key):
         """Lookup the principal represented by user_name.
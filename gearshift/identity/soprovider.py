@@ -11,6 +11,7 @@ import gearshift
 from gearshift import identity
 from gearshift.database.so import PackageHub
 from gearshift.util import load_class
+from gearshift.visit import invalidate_visit
 
 ##from turbojson.jsonify import jsonify_sqlobject, jsonify
 
@@ -150,12 +151,15 @@ class SqlObjectIdentity(object):
             visit.user_id = self._user.id
         else:
             visit = visit_class(visit_key=self.visit_key, user_id=self._user.id)
+        identity.invalidate_identity(self.visit_key)
 
     def logout(self):
         """Remove the link between this identity and the visit."""
         visit = self.visit_link
         if visit:
             visit.destroySelf()
+        invalidate_visit(self.visit_key)
+        identity.invalidate_identity(self.visit_key)
         # Clear the current identity
         identity.set_current_identity(SqlObjectIdentity())
 
@@ -199,9 +203,14 @@ class SqlObjectIdentityProvider(object):
 
         # Default encryption algorithm is to use plain text passwords
         algorithm = get("tools.identity.soprovider.encryption_algorithm", None)
+        self.encryption_algorithm = algorithm
         self.encrypt_password = lambda pw: \
             identity.encrypt_pw_with_algorithm(algorithm, pw)
 
+    def missing_model(self):
+        """Return the names of the model classes that could not be loaded."""
+        return identity.missing_model_classes(globals())
+
     def create_provider_model(self):
         """Create the database tables if they don't already exist."""
         try:
@@ -251,7 +260,14 @@ class SqlObjectIdentityProvider(object):
         subclass SqlObjectIdentityProvider, and override this method.
 
         """
-        return user.password == self.encrypt_password(password)
+        algorithm = self.encryption_algorithm
+        if not identity.verify_pw_with_algorithm(
+                algorithm, password, user.password):
+            return False
+        if identity.pw_needs_rehash(algorithm, user.password):
+            # Convert it to a hash with the current algorithm
+            user.password = password
+        return True
 
     def load_identity(self, visit_key):
         """Lookup the principal represented by user_name.
@@ -359,6 +375,7 @@ class TG_User(InheritableSQLObject):
                     " and no encryption algorithm specified in config."
                     " Setting password as plaintext.")
         self._SO_set_password(hash)
+        identity.invalidate_user(self.id)
 
     def set_password_raw(self, password):
         """Save the password as-is to the database."""
@@ -12,6 +12,7 @@ log = logging.getLogger("gearshift.identity.stprovider")
 import gearshift
 from gearshift import identity
 from gearshift.util import load_class
+from gearshift.visit import invalidate_visit
 
 def to_db_encoding(s, encoding):
     if isinstance(s, str):
@@ -142,7 +143,8 @@ class StormIdentity(object):
             visit.user_id = self._user.id
         else:
             visit = visit_class(visit_key=self.visit_key, user_id=self._user.id)
-            store.add(visit)            
+            store.add(visit)
+        identity.invalidate_identity(self.visit_key)
 
     def logout(self):
         """Remove the link between this identity and the visit."""
@@ -151,6 +153,8 @@ class StormIdentity(object):
         visit = self.visit_link
         if visit:
             store.remove(visit)
+        invalidate_visit(self.visit_key)
+        identity.invalidate_identity(self.visit_key)
         # Clear the current identity
         identity.set_current_identity(StormIdentity())
 
@@ -194,9 +198,14 @@ class StormIdentityProvider(object):
 
         # Default encryption algorithm is to use plain text passwords
         algorithm = get("tools.identity.stprovider.encryption_algorithm", None)
+        self.encryption_algorithm = algorithm
         self.encrypt_password = lambda pw: \
             identity.encrypt_pw_with_algorithm(algorithm, pw)
 
+    def missing_model(self):
+        """Return the names of the model classes that could not be loaded."""
+        return identity.missing_model_classes(globals())
+
     def create_provider_model(self):
         """Create the database tables if they don't already exist."""
         return
@@ -234,6 +243,24 @@ class StormIdentityProvider(object):
         subclass StormIdentityProvider, and override this method.
 
         """
+        algorithm = self.encryption_algorithm
+        if algorithm == 'pbkdf2':
+            # The salt is part of the hash, passwords with a legacy hash
+            # are converted on login
+            success = identity.verify_pw_with_algorithm(
+                algorithm, password, user.password)
+            salt = user.password[40:]
+            legacy = gearshift.config.get(
+                'tools.identity.legacy_encryption_algorithm', None)
+            if not success and salt and legacy and not (
+                    user.password.startswith('pbkdf2')):
+                success = user.password[:40] == (
+                    identity.encrypt_pw_with_algorithm(legacy,
+                        password + salt))
+            if success and identity.pw_needs_rehash(algorithm,
+                    user.password):
+                user.password = password
+            return success
         salt = user.password[40:]
         if salt:
             hashed_pass = self.encrypt_password(password + salt)
@@ -347,6 +374,7 @@ class TG_User(object):
                 log.info("Identity provider not enabled,"
                     " and no encryption algorithm specified in config."
                     " Setting password as plaintext.")
+        identity.invalidate_user(object.id)
         return hash
 
     password = Unicode(validator=_set_password)
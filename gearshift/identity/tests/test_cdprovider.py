@@ -0,0 +1,188 @@
+import os
+import socket
+import time
+from unittest import TestCase
+
+from couchdb.client import Document, ResourceNotFound, Row
+from nose.plugins.skip import SkipTest
+
+from gearshift import config
+from gearshift.identity import cdprovider
+from gearshift.identity.conditions import in_group
+
+
+class FakeDatabase(object):
+    """A local stand-in for a CouchDB database, counting requests.
+
+    The identity views are implemented like their map functions.
+
+    """
+
+    def __init__(self):
+        self.docs = dict()
+        self.requests = 0
+
+    def get(self, doc_id, default=None):
+        self.requests += 1
+        doc = self.docs.get(doc_id)
+        if doc is None:
+            return default
+        return Document(doc)
+
+    def __setitem__(self, doc_id, doc):
+        self.requests += 1
+        self.docs[doc_id] = dict(doc, _id=doc_id)
+
+    def view(self, name, wrapper=None, key=None, keys=None,
+            include_docs=False):
+        self.requests += 1
+        if keys is None:
+            keys = [key]
+        rows = []
+        for key in keys:
+            for doc_id, value in self.emitted(name, key):
+                row = dict(id=doc_id, key=key, value=value)
+                if include_docs:
+                    row['doc'] = self.docs.get(value['_id'])
+                rows.append(Row(row))
+        return rows
+
+    def emitted(self, name, key):
+        for doc in self.docs.values():
+            if name == 'identity/by_visit':
+                if (doc['type'] == 'VisitIdentity' and doc.get('user_id')
+                        and doc['_id'][14:] == key):
+                    yield doc['_id'], dict(_id=doc['user_id'])
+            elif name == 'identity/memberships':
+                if doc['type'] == 'UserGroup' and key == [
+                        doc['user_id'], 'group']:
+                    yield doc['_id'], dict(_id=doc['group_id'])
+                elif doc['type'] == 'GroupPermission' and key == [
+                        doc['group_id'], 'permission']:
+                    yield doc['_id'], dict(_id=doc['permission_id'])
+
+    def add(self, doc_id, **doc):
+        self.docs[doc_id] = dict(doc, _id=doc_id)
+
+
+def identity_docs():
+    """Return a user in five groups granting two permissions."""
+    docs = dict(joe=dict(type='User', user_name='joe'))
+    for i in range(5):
+        docs['group%d' % i] = dict(type='Group', group_name='group%d' % i)
+        docs['ug%d' % i] = dict(type='UserGroup', user_id='joe',
+            group_id='group%d' % i)
+        for j in range(2):
+            docs['perm%d' % j] = dict(type='Permission',
+                permission_name='perm%d' % j)
+            docs['gp%d%d' % (i, j)] = dict(type='GroupPermission',
+                group_id='group%d' % i, permission_id='perm%d' % j)
+    return docs
+
+
+class FakeDatastore(object):
+
+    def __init__(self, db):
+        self.db = db
+
+
+class TestCouchDbIdentity(TestCase):
+
+    def setUp(self):
+        self._datastore = cdprovider.datastore
+        self.db = FakeDatabase()
+        cdprovider.datastore = FakeDatastore(self.db)
+        self.provider = cdprovider.CouchDbIdentityProvider()
+        for doc_id, doc in identity_docs().iteritems():
+            self.db.add(doc_id, **doc)
+
+    def tearDown(self):
+        cdprovider.datastore = self._datastore
+
+    def check(self, identity):
+        assert identity.user_name == 'joe'
+        assert identity.groups == frozenset(
+            ['group%d' % i for i in range(5)])
+        assert identity.group_ids == identity.groups
+        assert identity.permissions == frozenset(['perm0', 'perm1'])
+        assert not identity.anonymous
+
+    def test_queries(self):
+        self.db.add('VISITIDENTITY:abc', type='VisitIdentity', user_id='joe')
+        self.db.requests = 0
+        self.check(self.provider.load_identity('abc'))
+        # the user, then the groups and then the permissions
+        assert self.db.requests == 3
+
+    def test_login(self):
+        user = cdprovider.TG_User.wrap(self.db.docs['joe'])
+        self.check(cdprovider.CouchDbIdentity('xyz', user))
+        assert self.db.docs['VISITIDENTITY:xyz']['user_id'] == 'joe'
+        self.check(self.provider.load_identity('xyz'))
+
+    def test_revoked_group(self):
+        user = cdprovider.TG_User.wrap(self.db.docs['joe'])
+        cdprovider.CouchDbIdentity('xyz', user)
+        predicate = in_group('group0')
+        assert predicate.eval_with_object(self.provider.load_identity('xyz'))
+        del self.db.docs['ug0']
+        # the next request of the visit is denied
+        identity = self.provider.load_identity('xyz')
+        assert not predicate.eval_with_object(identity)
+        assert identity.permissions == frozenset(['perm0', 'perm1'])
+
+    def test_datastore_errors(self):
+        self.db.add('VISITIDENTITY:abc', type='VisitIdentity', user_id='joe')
+
+        def timeout(*args, **kw):
+            raise socket.timeout('timed out')
+
+        self.db.view = timeout
+        assert self.provider.load_identity('abc').anonymous
+
+        def missing(*args, **kw):
+            raise ResourceNotFound('missing')
+
+        self.db.view = missing
+        try:
+            self.provider.load_identity('abc').anonymous
+        except ResourceNotFound:
+            pass
+        else:
+            self.fail("Missing view not reported")
+
+    def test_unknown_visit(self):
+        identity = self.provider.load_identity('unknown')
+        assert identity.anonymous and not identity.groups
+        assert self.db.requests == 1
+
+
+def test_benchmark():
+    """Time identity lookups with a local CouchDB instance.
+
+    Set GEARSHIFT_COUCHDB_URI to the URI of a scratch database to run it.
+
+    """
+    uri = os.environ.get('GEARSHIFT_COUCHDB_URI')
+    if not uri:
+        raise SkipTest("GEARSHIFT_COUCHDB_URI not set")
+    dburi, database = uri.rstrip('/').rsplit('/', 1)
+    _config = dict((key, config.get(key, None)) for key in (
+        'couchdb.dburi', 'couchdb.database'))
+    config.update({'couchdb.dburi': dburi, 'couchdb.database': database})
+    try:
+        db = cdprovider.datastore.db
+        provider = cdprovider.CouchDbIdentityProvider()
+        provider.create_provider_model()
+        for doc_id, doc in identity_docs().iteritems():
+            if doc_id not in db:
+                db[doc_id] = doc
+        user = cdprovider.TG_User.load(db, 'joe')
+        cdprovider.CouchDbIdentity('bench', user)
+        start = time.time()
+        for i in range(100):
+            identity = provider.load_identity('bench')
+            assert len(identity.permissions) == 2
+        assert time.time() - start < 10
+    finally:
+        config.update(_config)
@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from couchdb.client import ResourceConflict, Row
+
+from gearshift.visit import cdvisit
+
+
+class FakeDatabase(object):
+    """A local stand-in for a CouchDB database, counting requests."""
+
+    def __init__(self):
+        self.docs = dict()
+        self.requests = 0
+        # documents that will be changed by someone else on the next update
+        self.contended = set()
+
+    def view(self, name, wrapper=None, keys=None, include_docs=False,
+            endkey=None, limit=None):
+        self.requests += 1
+        rows = []
+        if name == '_all_docs':
+            for key in keys:
+                doc = self.docs.get(key)
+                if doc is None:
+                    rows.append(dict(key=key, error='not_found'))
+                else:
+                    rows.append(dict(id=key, key=key,
+                        value=dict(rev=doc['_rev']), doc=dict(doc)))
+        elif name == 'visit/by_expiry':
+            docs = [(doc['expiry'], doc) for doc in self.docs.itervalues()
+                if doc['expiry'] <= endkey]
+            docs.sort()
+            for expiry, doc in docs[:limit]:
+                rows.append(dict(id=doc['_id'], key=expiry,
+                    value=doc['_rev']))
+        return [Row(row) for row in rows]
+
+    def update(self, docs):
+        self.requests += 1
+        results = []
+        for doc in docs:
+            doc_id = doc['_id']
+            current = self.docs.get(doc_id)
+            if doc_id in self.contended:
+                self.contended.remove(doc_id)
+                current['_rev'] = str(int(current['_rev']) + 1)
+            if current is None or doc['_rev'] != current['_rev']:
+                results.append((False, doc_id, ResourceConflict()))
+            elif doc.get('_deleted'):
+                del self.docs[doc_id]
+                results.append((True, doc_id, None))
+            else:
+                doc['_rev'] = str(int(current['_rev']) + 1)
+                self.docs[doc_id] = doc
+                results.append((True, doc_id, doc['_rev']))
+        return results
+
+    def add_visit(self, visit_key, expiry):
+        doc_id = 'VISIT:%s' % visit_key
+        self.docs[doc_id] = dict(_id=doc_id, _rev='1', type='Visit',
+            expiry=to_json(expiry))
+
+
+def to_json(expiry):
+    """Return the expiry as stored in a visit document."""
+    return cdvisit.TG_Visit(expiry=expiry).unwrap()['expiry']
+
+
+class FakeDatastore(object):
+
+    def __init__(self, db):
+        self.db = db
+
+
+class TestCouchDbVisitManager(TestCase):
+
+    def setUp(self):
+        self._datastore = cdvisit.datastore
+        self.db = FakeDatabase()
+        cdvisit.datastore = FakeDatastore(self.db)
+        self.manager = cdvisit.CouchDbVisitManager(timedelta(minutes=20))
+        self.manager.shutdown()
+
+    def tearDown(self):
+        cdvisit.datastore = self._datastore
+
+    def test_bulk_update(self):
+        now = datetime.now().replace(microsecond=0)
+        for i in range(50):
+            self.db.add_visit(str(i), now)
+        self.db.requests = 0
+        expiry = now + timedelta(minutes=20)
+        queue = dict([(str(i), expiry) for i in range(50)])
+        queue['deleted'] = expiry
+        self.manager.update_queued_visits(queue)
+        # one multi-key fetch and one bulk update
+        assert self.db.requests == 2
+        for doc in self.db.docs.itervalues():
+            assert doc['expiry'] == to_json(expiry)
+        assert 'VISIT:deleted' not in self.db.docs
+
+    def test_conflicts_are_retried(self):
+        now = datetime.now().replace(microsecond=0)
+        for i in range(5):
+            self.db.add_visit(str(i), now)
+        self.db.contended.update(['VISIT:1', 'VISIT:3'])
+        self.db.requests = 0
+        expiry = now + timedelta(minutes=20)
+        self.manager.update_queued_visits(
+            dict([(str(i), expiry) for i in range(5)]))
+        assert self.db.requests == 4
+        for doc in self.db.docs.itervalues():
+            assert doc['expiry'] == to_json(expiry)
+
+    def test_deleted_visits_not_updated(self):
+        expiry = datetime.now() + timedelta(minutes=20)
+        self.manager.update_queued_visits(dict(deleted=expiry))
+        # only the fetch, no empty bulk update
+        assert self.db.requests == 1
+
+    def test_delete_expired_visits(self):
+        now = datetime.now().replace(microsecond=0)
+        for i in range(5):
+            self.db.add_visit('old%d' % i, now - timedelta(hours=1))
+        self.db.add_visit('active', now + timedelta(minutes=20))
+        assert self.manager.delete_expired_visits(now, 3) == 3
+        assert self.manager.delete_expired_visits(now, 3) == 2
+        assert self.db.docs.keys() == ['VISIT:active']
@@ -0,0 +1,141 @@
+from unittest import TestCase
+
+import cherrypy
+
+from gearshift.identity import All, Any, check_predicate, \
+    compile_predicate, from_any_host, from_host, has_any_permission, has_all_permissions, \
+    has_permission, in_all_groups, in_any_group, in_group, not_anonymous, \
+    Predicate
+from gearshift.util import IPRangeSet
+
+
+class FakeIdentity(object):
+
+    def __init__(self, groups=(), permissions=(), anonymous=False):
+        self.groups = frozenset(groups)
+        self.permissions = frozenset(permissions)
+        self.anonymous = anonymous
+        self.lookups = 0
+
+    def __getattribute__(self, name):
+        if name in ('groups', 'permissions'):
+            object.__getattribute__(self, '__dict__')['lookups'] += 1
+        return object.__getattribute__(self, name)
+
+
+class is_even(Predicate):
+    """A custom predicate that has no compiled evaluator of its own."""
+
+    error_message = "Odd"
+
+    def __init__(self, number):
+        self.number = number
+
+    def eval_with_object(self, identity, errors=None):
+        if self.number % 2 == 0:
+            return True
+        self.append_error_message(errors)
+        return False
+
+
+class TestCompiledPredicates(TestCase):
+
+    def setUp(self):
+        self.identity = cherrypy.request.identity = FakeIdentity(
+            ['admin', 'editor'], ['read', 'write'])
+
+    def tearDown(self):
+        cherrypy.request.identity = None
+
+    def check(self, predicate, expected):
+        errors = []
+        assert check_predicate(predicate, errors) == expected
+        assert predicate.eval_with_object(self.identity) == expected
+        assert bool(errors) != expected
+
+    def test_simple(self):
+        self.check(in_group('admin'), True)
+        self.check(in_group('other'), False)
+        self.check(has_permission('write'), True)
+        self.check(has_permission('delete'), False)
+        self.check(not_anonymous(), True)
+
+    def test_compound(self):
+        self.check(in_all_groups('admin', 'editor'), True)
+        self.check(in_all_groups('admin', 'other'), False)
+        self.check(in_any_group('other', 'editor'), True)
+        self.check(in_any_group('other', 'nobody'), False)
+        self.check(has_all_permissions('read', 'write'), True)
+        self.check(has_any_permission('delete', 'drop'), False)
+        self.check(All(in_group('admin'), Any(has_permission('delete'),
+            not_anonymous())), True)
+        self.check(Any(All(in_group('admin'), has_permission('delete')),
+            in_group('other')), False)
+        self.check(Any(), False)
+        self.check(All(), True)
+
+    def test_custom_predicates(self):
+        self.check(All(in_group('admin'), is_even(2)), True)
+        self.check(All(in_group('admin'), is_even(3)), False)
+        self.check(Any(in_group('other'), is_even(4)), True)
+
+    def test_anonymous(self):
+        self.identity = cherrypy.request.identity = FakeIdentity(
+            anonymous=True)
+        self.check(not_anonymous(), False)
+        self.check(in_any_group('admin', 'editor'), False)
+
+    def test_error_messages(self):
+        errors = []
+        check_predicate(in_all_groups('admin', 'other', 'nobody'), errors)
+        assert errors == ['Not member of group: other']
+        errors = []
+        check_predicate(has_any_permission('delete', 'drop'), errors)
+        assert errors == ['No matching permissions: delete, drop']
+
+    def test_masks_computed_once(self):
+        predicates = [in_group('editor'), has_permission('read'),
+            in_all_groups('admin', 'editor')]
+        for predicate in predicates:
+            compile_predicate(predicate)
+        self.identity.lookups = 0
+        for predicate in predicates * 10:
+            assert check_predicate(predicate)
+        assert self.identity.lookups == 2
+
+    def test_new_names_after_masks(self):
+        assert check_predicate(in_group('admin'))
+        # a predicate compiled later uses a new bit
+        assert check_predicate(in_group('editor'))
+        assert not check_predicate(in_group('newly_seen'))
+
+
+class TestHostPredicates(TestCase):
+
+    def setUp(self):
+        cherrypy.request.identity = FakeIdentity()
+        self._headers = cherrypy.request.headers
+        cherrypy.request.headers = {'Remote-Addr': '10.1.2.3'}
+
+    def tearDown(self):
+        cherrypy.request.headers = self._headers
+        cherrypy.request.identity = None
+
+    def test_from_host(self):
+        assert check_predicate(from_host('10.0.0.0/8'))
+        assert not check_predicate(from_host('10.1.2.4'))
+
+    def test_from_any_host(self):
+        assert check_predicate(from_any_host(['127.0.0.1', '10.1.0.0/16']))
+        errors = []
+        assert not check_predicate(from_any_host(['127.0.0.1', '::1']), errors)
+        assert errors == ['Access from this host is not permitted.']
+        cherrypy.request.headers['X-Forwarded-For'] = '1.1.1.1, 127.0.0.1'
+        assert check_predicate(from_any_host(IPRangeSet(['127.0.0.0/8'])))
+
+    def test_from_any_host_predicates(self):
+        predicate = from_any_host(['127.0.0.1', '10.1.0.0/16'])
+        assert predicate._predicates is None
+        assert [p.host for p in predicate.predicates] == [
+            '127.0.0.1', '10.1.0.0/16']
+        assert not from_any_host(IPRangeSet(['127.0.0.0/8'])).predicates
@@ -0,0 +1,264 @@
+import base64
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+import cherrypy
+
+from gearshift import config, identity
+from gearshift.identity.cache import CachedIdentity, FileIdentityCache, \
+    MemoryIdentityCache, cache_entry
+from gearshift.identity.visitor import IdentityVisitPlugin
+
+
+class FakeIdentity(object):
+
+    def __init__(self, visit_key, user_id=None):
+        self.visit_key = visit_key
+        self.user_id = user_id
+        self.anonymous = user_id is None
+        self.user_name = user_id and 'user%d' % user_id
+        self.groups = user_id and frozenset(['admin']) or frozenset()
+        self.permissions = frozenset()
+        self.group_ids = user_id and frozenset([1]) or frozenset()
+        self.user = user_id and object()
+
+
+class FakeProvider(object):
+    """An identity provider counting the identities it loads."""
+
+    # maps visit keys to user ids
+    visits = dict()
+    loads = 0
+
+    def load_identity(self, visit_key):
+        FakeProvider.loads += 1
+        return FakeIdentity(visit_key, self.visits.get(visit_key))
+
+    def anonymous_identity(self):
+        return FakeIdentity(None)
+
+
+class IdentityCacheTests(object):
+    """Tests that apply to all identity cache backends."""
+
+    entry = (1, u'user1', frozenset([u'admin']), frozenset([u'edit']),
+        frozenset([1]))
+
+    def test_get_and_put(self):
+        assert self.cache.get('a') is None
+        self.cache.put('a', self.entry)
+        assert self.cache.get('a') == self.entry
+        self.cache.remove('a')
+        assert self.cache.get('a') is None
+
+    def test_ttl(self):
+        self.cache.ttl = -1
+        self.cache.put('a', self.entry)
+        assert self.cache.get('a') is None
+
+    def test_remove_user(self):
+        self.cache.put('a', self.entry)
+        self.cache.put('b', (2,) + self.entry[1:])
+        time.sleep(0.01)
+        self.cache.remove_user(1)
+        assert self.cache.get('a') is None
+        assert self.cache.get('b')
+        # identities cached afterwards are valid again
+        time.sleep(0.01)
+        self.cache.put('a', self.entry)
+        assert self.cache.get('a') == self.entry
+
+
+class TestMemoryIdentityCache(IdentityCacheTests, TestCase):
+
+    def setUp(self):
+        self.cache = MemoryIdentityCache(10, 60)
+
+
+class TestFileIdentityCache(IdentityCacheTests, TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = FileIdentityCache(self.path, 60)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_shared(self):
+        other = FileIdentityCache(self.path, 60)
+        self.cache.put('a', self.entry)
+        assert other.get('a') == self.entry
+        other.remove('a')
+        assert self.cache.get('a') is None
+
+    def test_cleanup(self):
+        self.cache.put('a', self.entry)
+        self.cache.put('b', (2,) + self.entry[1:])
+        self.cache.remove_user(3)
+        time.sleep(0.01)
+        self.cache.remove_user(2)
+        assert self.cache.get('b') is None
+        assert not os.path.exists(self.cache._filename('visits', 'b'))
+        self.cache.put('c', self.entry)
+        old = time.time() - 120
+        for name in ('a', 'c'):
+            os.utime(self.cache._filename('visits', name), (old, old))
+        os.utime(self.cache._filename('users', 3), (old, old))
+        self.cache.cleanup()
+        assert os.listdir(os.path.join(self.path, 'visits')) == []
+        assert os.listdir(os.path.join(self.path, 'users')) == [
+            os.path.basename(self.cache._filename('users', 2))]
+
+
+class TestCachedIdentity(TestCase):
+
+    def test_delegation(self):
+        FakeProvider.visits['a'] = 1
+        entry = cache_entry(FakeIdentity('a', 1))
+        loads = FakeProvider.loads
+        cached = CachedIdentity('a', entry,
+            lambda: FakeProvider().load_identity('a'))
+        assert not cached.anonymous and cached.user_name == 'user1'
+        assert cached.groups == frozenset(['admin'])
+        assert FakeProvider.loads == loads
+        # anything else is taken from the identity loaded by the provider
+        assert cached.user
+        assert FakeProvider.loads == loads + 1
+
+
+class TestIdentityVisitPlugin(TestCase):
+
+    def setUp(self):
+        self._config = dict((key, config.get(key, None)) for key in (
+            'tools.identity.provider', 'tools.identity.cache.on'))
+        config.update({'tools.identity.provider': __name__ + '.FakeProvider',
+            'tools.identity.cache.on': True})
+        self.plugin = IdentityVisitPlugin()
+
+    def tearDown(self):
+        config.update(self._config)
+        identity.base.set_identity_caches()
+
+    def test_identity_from_visit(self):
+        FakeProvider.visits['b'] = 2
+        loads = FakeProvider.loads
+        assert self.plugin.identity_from_visit('b').user_name == 'user2'
+        cached = self.plugin.identity_from_visit('b')
+        assert isinstance(cached, CachedIdentity)
+        assert cached.user_name == 'user2'
+        assert FakeProvider.loads == loads + 1
+        identity.invalidate_identity('b')
+        assert not isinstance(self.plugin.identity_from_visit('b'),
+            CachedIdentity)
+
+    def test_anonymous_not_cached(self):
+        loads = FakeProvider.loads
+        assert self.plugin.identity_from_visit('c').anonymous
+        assert self.plugin.identity_from_visit('c').anonymous
+        assert FakeProvider.loads == loads + 2
+
+    def test_invalidate_user(self):
+        FakeProvider.visits['d'] = 3
+        self.plugin.identity_from_visit('d')
+        time.sleep(0.01)
+        identity.invalidate_user(3)
+        assert not isinstance(self.plugin.identity_from_visit('d'),
+            CachedIdentity)
+
+
+class FakeVisit(object):
+    """A lazily created visit."""
+
+    persisted = False
+
+    def __init__(self, key):
+        self.key = key
+
+    def persist(self):
+        self.persisted = True
+
+
+class CredentialsProvider(FakeProvider):
+    """An identity provider counting the credentials it validates."""
+
+    passwords = {'user4': 'secret'}
+    validations = 0
+
+    def validate_identity(self, user_name, password, visit_key):
+        CredentialsProvider.validations += 1
+        if self.passwords.get(user_name) == password:
+            return FakeIdentity(visit_key, 4)
+
+
+class TestCredentialsCache(TestCase):
+
+    def setUp(self):
+        self._config = dict((key, config.get(key, None)) for key in (
+            'tools.identity.provider', 'tools.identity.http_auth.cache.on'))
+        config.update({
+            'tools.identity.provider': __name__ + '.CredentialsProvider',
+            'tools.identity.http_auth.cache.on': True})
+        self.plugin = IdentityVisitPlugin()
+        self._headers = cherrypy.request.headers
+        cherrypy.request.headers = {}
+
+    def tearDown(self):
+        cherrypy.request.headers = self._headers
+        config.update(self._config)
+        identity.base.set_identity_caches()
+
+    def login(self, password):
+        cherrypy.request.headers['Authorization'] = 'Basic ' + \
+            base64.b64encode('user4:' + password)
+        return self.plugin.identity_from_http_auth('e')
+
+    def record_request(self, params):
+        visit = FakeVisit('e')
+        _params = cherrypy.request.params
+        cherrypy.request.params = params
+        try:
+            self.plugin.record_request(visit)
+        finally:
+            cherrypy.request.params = _params
+            cherrypy.request.__dict__.pop('identity_form_login', None)
+        return visit
+
+    def test_cached(self):
+        validations = CredentialsProvider.validations
+        assert self.login('secret').user_name == 'user4'
+        cached = self.login('secret')
+        assert isinstance(cached, CachedIdentity)
+        assert cached.user_name == 'user4'
+        assert CredentialsProvider.validations == validations + 1
+        # the credentials are only validated when needed
+        assert cached.user
+        assert CredentialsProvider.validations == validations + 2
+        # the credentials are not stored in clear
+        assert 'secret' not in repr(self.plugin.credentials_cache.__dict__)
+
+    def test_wrong_password_not_cached(self):
+        validations = CredentialsProvider.validations
+        assert self.login('wrong') is None
+        assert self.login('wrong') is None
+        assert CredentialsProvider.validations == validations + 2
+
+    def test_basic_auth_keeps_visit_lazy(self):
+        self.login('secret')
+        visit = self.record_request(dict())
+        assert cherrypy.request.identity.user_name == 'user4'
+        assert not visit.persisted
+
+    def test_form_login_persists_visit(self):
+        visit = self.record_request(dict(user_name='user4',
+            password='secret', login='Login'))
+        assert cherrypy.request.identity.user_name == 'user4'
+        assert visit.persisted
+
+    def test_password_change(self):
+        self.login('secret')
+        time.sleep(0.01)
+        identity.invalidate_user(4)
+        assert not isinstance(self.login('secret'), CachedIdentity)
@@ -0,0 +1,125 @@
+import threading
+import time
+from unittest import TestCase
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from gearshift import config, identity
+from gearshift.identity import base
+
+
+class TestPasswords(TestCase):
+
+    def setUp(self):
+        self._config = dict((key, config.get(key, None)) for key in (
+            'tools.identity.pbkdf2.iterations',
+            'tools.identity.legacy_encryption_algorithm'))
+        config.update({'tools.identity.pbkdf2.iterations': 1000})
+
+    def tearDown(self):
+        config.update(self._config)
+
+    def test_pbkdf2(self):
+        hashed = identity.encrypt_pw_with_algorithm('pbkdf2', u'secr\xe9t')
+        assert isinstance(hashed, unicode)
+        assert hashed.startswith('pbkdf2_sha256$1000$')
+        # the salt is random
+        assert hashed != identity.encrypt_pw_with_algorithm(
+            'pbkdf2', u'secr\xe9t')
+        assert identity.verify_pw_with_algorithm(
+            'pbkdf2', u'secr\xe9t', hashed)
+        assert not identity.verify_pw_with_algorithm(
+            'pbkdf2', u'secret', hashed)
+        assert not identity.pw_needs_rehash('pbkdf2', hashed)
+        config.update({'tools.identity.pbkdf2.iterations': 2000})
+        assert identity.pw_needs_rehash('pbkdf2', hashed)
+
+    def test_legacy(self):
+        config.update({'tools.identity.legacy_encryption_algorithm': 'sha1'})
+        hashed = unicode(sha1('secret').hexdigest())
+        assert identity.verify_pw_with_algorithm('pbkdf2', 'secret', hashed)
+        assert not identity.verify_pw_with_algorithm('pbkdf2', 'x', hashed)
+        assert identity.pw_needs_rehash('pbkdf2', hashed)
+        assert identity.verify_pw_with_algorithm('sha1', 'secret', hashed)
+        assert not identity.pw_needs_rehash('sha1', hashed)
+
+    def test_legacy_not_set(self):
+        config.update({'tools.identity.legacy_encryption_algorithm': None})
+        assert not identity.verify_pw_with_algorithm(
+            'pbkdf2', 'secret', u'secret')
+        config.update({'tools.identity.legacy_encryption_algorithm': 'plain'})
+        assert identity.verify_pw_with_algorithm(
+            'pbkdf2', 'secret', u'secret')
+        assert not identity.verify_pw_with_algorithm('pbkdf2', 'x', u'secret')
+
+    def test_malformed(self):
+        assert not identity.verify_pw_with_algorithm(
+            'pbkdf2', 'secret', u'pbkdf2_sha256$many$salt')
+        assert not identity.verify_pw_with_algorithm('pbkdf2', 'secret', None)
+
+    def test_pure_python_pbkdf2(self):
+        expected = base._pbkdf2('password', 'salt', 2)
+        pbkdf2_hmac = base.pbkdf2_hmac
+        base.pbkdf2_hmac = None
+        try:
+            assert base._pbkdf2('password', 'salt', 2) == expected
+        finally:
+            base.pbkdf2_hmac = pbkdf2_hmac
+
+
+def test_login_concurrency():
+    """Page views go on while many threads are hashing passwords."""
+    _config = dict((key, config.get(key, None)) for key in (
+        'tools.identity.pbkdf2.iterations', 'tools.identity.hash_threads'))
+    config.update({'tools.identity.pbkdf2.iterations': 2000,
+        'tools.identity.hash_threads': 1})
+    pbkdf2, pbkdf2_hmac = base._pbkdf2, base.pbkdf2_hmac
+    hashing = []
+
+    def counting_pbkdf2(*args):
+        hashing.append(len(hashing) + 1)
+        try:
+            return pbkdf2(*args)
+        finally:
+            hashing.pop()
+
+    def page_views(logins):
+        stop = threading.Event()
+        counts = dict(logins=0, views=0, max_hashing=0)
+
+        def login():
+            while not stop.isSet():
+                identity.encrypt_pw_with_algorithm('pbkdf2', 'secret')
+                counts['logins'] += 1
+                counts['max_hashing'] = max(counts['max_hashing'],
+                    len(hashing))
+
+        def view():
+            while not stop.isSet():
+                # some pure Python work holding the GIL
+                sum([i * i for i in xrange(1000)])
+                counts['views'] += 1
+
+        threads = [threading.Thread(target=login) for i in range(logins)]
+        threads.append(threading.Thread(target=view))
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return counts
+
+    # the pure Python fallback holds the GIL while hashing
+    base._pbkdf2, base.pbkdf2_hmac = counting_pbkdf2, None
+    try:
+        idle = page_views(0)
+        busy = page_views(8)
+    finally:
+        base._pbkdf2, base.pbkdf2_hmac = pbkdf2, pbkdf2_hmac
+        config.update(_config)
+    assert busy['logins'] and busy['max_hashing'] <= 1
+    # one hashing thread at a time leaves about half of the GIL to views
+    assert busy['views'] > idle['views'] * 0.25, (busy, idle)
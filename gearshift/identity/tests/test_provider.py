@@ -0,0 +1,98 @@
+from unittest import TestCase
+
+import cherrypy
+
+from gearshift import config, identity
+from gearshift.tools.identity import IdentityTool
+from gearshift.util import load_class
+
+# the model classes, loaded by the provider like the real ones do
+user_class = None
+
+
+class User(object):
+    pass
+
+
+class ModelProvider(object):
+    """An identity provider loading its model class from the config."""
+
+    instances = 0
+
+    def __init__(self):
+        global user_class
+        ModelProvider.instances += 1
+        user_class = load_class(config.get(
+            'tools.identity.testprovider.model.user') or __name__ + '.User')
+
+    def missing_model(self):
+        return [name for name in identity.missing_model_classes(globals())
+            if name == 'user_class']
+
+    def encrypt_password(self, password):
+        return password[::-1]
+
+
+class UncheckedProvider(object):
+    """A custom identity provider without a model check."""
+
+
+class TestDefaultProvider(TestCase):
+
+    def setUp(self):
+        self._config = dict((key, config.get(key, None)) for key in (
+            'tools.identity.provider',
+            'tools.identity.testprovider.model.user'))
+        config.update({'tools.identity.provider': __name__ + '.ModelProvider'})
+        identity.set_default_provider(None)
+        try:
+            self._provider = cherrypy.request.identityProvider
+            del cherrypy.request.identityProvider
+        except AttributeError:
+            self._provider = None
+
+    def tearDown(self):
+        identity.set_default_provider(None)
+        if self._provider is not None:
+            cherrypy.request.identityProvider = self._provider
+        config.update(self._config)
+
+    def test_created_once(self):
+        instances = ModelProvider.instances
+        assert identity.current_provider.encrypt_password('abc') == 'cba'
+        assert identity.current_provider.encrypt_password('abc') == 'cba'
+        assert identity.get_default_provider() is identity.get_default_provider()
+        assert ModelProvider.instances == instances + 1
+
+    def test_start(self):
+        provider = identity.start_default_provider()
+        assert isinstance(provider, ModelProvider)
+        assert user_class is User
+        assert identity.get_default_provider() is provider
+
+    def test_start_missing_model(self):
+        config.update({'tools.identity.testprovider.model.user':
+            __name__ + '_missing.User'})
+        try:
+            identity.start_default_provider()
+        except identity.IdentityConfigurationException, e:
+            assert 'user_class' in str(e)
+        else:
+            self.fail("Missing model class not detected")
+
+    def test_start_without_model_check(self):
+        config.update({'tools.identity.provider':
+            __name__ + '.UncheckedProvider'})
+        assert isinstance(identity.start_default_provider(),
+            UncheckedProvider)
+
+    def test_reset_on_stop(self):
+        provider = identity.start_default_provider()
+        IdentityTool().shutdown_extension()
+        assert identity.get_default_provider() is not provider
+
+
+def test_missing_model_classes():
+    namespace = dict(user_class=User, group_class=None, visit_class=User)
+    assert identity.missing_model_classes(namespace) == [
+        'group_class', 'permission_class']
@@ -0,0 +1,150 @@
+from unittest import TestCase
+
+from sqlalchemy import create_engine, MetaData, Table, Column, ForeignKey, \
+    Integer, String, Unicode
+from sqlalchemy.interfaces import ConnectionProxy
+from sqlalchemy.orm import mapper, relation
+
+from gearshift import config
+from gearshift.database.sa.sa import session
+from gearshift.identity import saprovider
+
+
+class QueryCounter(ConnectionProxy):
+    """Count the statements executed by an engine."""
+
+    count = 0
+
+    def cursor_execute(self, execute, cursor, statement, parameters,
+            context, executemany):
+        self.count += 1
+        return execute(cursor, statement, parameters, context)
+
+
+counter = QueryCounter()
+metadata = MetaData(create_engine('sqlite:///:memory:', proxy=counter))
+
+visit_identity_table = Table('visit_identity', metadata,
+    Column('visit_key', String(40), primary_key=True),
+    Column('user_id', Integer, ForeignKey('tg_user.user_id'), index=True))
+
+users_table = Table('tg_user', metadata,
+    Column('user_id', Integer, primary_key=True),
+    Column('user_name', Unicode(16), unique=True),
+    Column('password', Unicode(40)))
+
+groups_table = Table('tg_group', metadata,
+    Column('group_id', Integer, primary_key=True),
+    Column('group_name', Unicode(16), unique=True))
+
+permissions_table = Table('permission', metadata,
+    Column('permission_id', Integer, primary_key=True),
+    Column('permission_name', Unicode(16), unique=True))
+
+user_group_table = Table('user_group', metadata,
+    Column('user_id', Integer, ForeignKey('tg_user.user_id'),
+        primary_key=True),
+    Column('group_id', Integer, ForeignKey('tg_group.group_id'),
+        primary_key=True))
+
+group_permission_table = Table('group_permission', metadata,
+    Column('group_id', Integer, ForeignKey('tg_group.group_id'),
+        primary_key=True),
+    Column('permission_id', Integer, ForeignKey('permission.permission_id'),
+        primary_key=True))
+
+
+class VisitIdentity(object):
+    query = session.query_property()
+
+
+class User(object):
+    query = session.query_property()
+
+    @property
+    def permissions(self):
+        p = set()
+        for g in self.groups:
+            p |= set(g.permissions)
+        return p
+
+
+class Group(object):
+    query = session.query_property()
+
+
+class Permission(object):
+    query = session.query_property()
+
+
+mapper(VisitIdentity, visit_identity_table)
+mapper(User, users_table)
+mapper(Group, groups_table, properties=dict(users=relation(User,
+    secondary=user_group_table, backref='groups')))
+mapper(Permission, permissions_table, properties=dict(groups=relation(Group,
+    secondary=group_permission_table, backref='permissions')))
+
+
+class TestSqlAlchemyIdentityProvider(TestCase):
+
+    def setUp(self):
+        self._config = dict((key, config.get(key, None)) for key in (
+            'tools.identity.saprovider.model.user',
+            'tools.identity.saprovider.model.group',
+            'tools.identity.saprovider.model.permission',
+            'tools.identity.saprovider.model.visit'))
+        if not config.get('sqlalchemy.dburi', None):
+            # needed for creating the session
+            config.update({'sqlalchemy.dburi': 'sqlite:///:memory:'})
+        config.update({
+            'tools.identity.saprovider.model.user': __name__ + '.User',
+            'tools.identity.saprovider.model.group': __name__ + '.Group',
+            'tools.identity.saprovider.model.permission':
+                __name__ + '.Permission',
+            'tools.identity.saprovider.model.visit':
+                __name__ + '.VisitIdentity'})
+        metadata.create_all()
+        self.provider = saprovider.SqlAlchemyIdentityProvider()
+        engine = metadata.bind
+        engine.execute(users_table.insert(), user_id=1, user_name=u'joe',
+            password=u'secret')
+        for i in range(10):
+            engine.execute(groups_table.insert(), group_id=i,
+                group_name=u'group%d' % i)
+            engine.execute(user_group_table.insert(), user_id=1, group_id=i)
+            for j in range(3):
+                engine.execute(permissions_table.insert(),
+                    permission_id=i * 3 + j, permission_name=u'perm%d' % (
+                    i * 3 + j))
+                engine.execute(group_permission_table.insert(),
+                    group_id=i, permission_id=i * 3 + j)
+        engine.execute(visit_identity_table.insert(), visit_key='abc',
+            user_id=1)
+
+    def tearDown(self):
+        session.remove()
+        metadata.drop_all()
+        config.update(self._config)
+
+    def test_load_identity_queries(self):
+        counter.count = 0
+        identity = self.provider.load_identity('abc')
+        assert identity.user_name == 'joe'
+        assert len(identity.groups) == 10
+        assert len(identity.group_ids) == 10
+        assert 'perm29' in identity.permissions
+        assert not identity.anonymous
+        # visit link, user, groups and permissions in one query
+        assert counter.count == 1, counter.count
+
+    def test_unknown_visit(self):
+        counter.count = 0
+        identity = self.provider.load_identity('xyz')
+        assert identity.anonymous and not identity.permissions
+        assert counter.count == 1, counter.count
+
+    def test_validate_identity_queries(self):
+        counter.count = 0
+        identity = self.provider.validate_identity(u'joe', u'secret', None)
+        assert len(identity.permissions) == 30
+        assert counter.count == 1, counter.count
@@ -65,6 +65,21 @@ class TestVisit(TestCase):
         response = self.app.get("/", headers=cookie_header(response))
         assert not response.raw['new']
 
+    def test_excluded_bot(self):
+        """Test that requests by bots are not tracked when configured."""
+        bots = config.get('tools.visit.exclude.bots', False)
+        try:
+            testutil.stop_server(tg_only = False)
+            config.update({'tools.visit.exclude.bots': True})
+            app = testutil.make_app(VisitRoot)
+            testutil.start_server()
+            response = app.get("/", headers={'User-Agent':
+                'Mozilla/5.0 (compatible; Googlebot/2.1)'})
+        finally:
+            config.update({'tools.visit.exclude.bots': bots})
+        assert not response.cookies_set.has_key(self.cookie_name)
+        assert response.raw['key'] is None
+
     def test_visit_from_form(self):
         """Test if the visit key is retrieved from the request params."""
         _app = self.app
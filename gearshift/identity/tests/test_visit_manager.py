@@ -0,0 +1,689 @@
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import create_engine, select, MetaData, Table, Column, \
+    DateTime, String
+from sqlalchemy.interfaces import PoolListener
+from sqlalchemy.orm import mapper
+
+from gearshift import config
+from gearshift.visit import api, savisit
+from gearshift.visit.api import AsyncVisitPlugin, BaseVisitManager, \
+    LazyVisit, RequestFilter, Visit, VisitCache, VisitUpdateQueue
+from gearshift.visit.scvisit import SignedCookieVisitManager
+from gearshift.visit.shmvisit import SharedMemoryVisitManager, VisitTable
+
+
+class MemoryVisitManager(BaseVisitManager):
+    """A visit manager keeping the visits in a dict, counting lookups."""
+
+    def __init__(self, timeout):
+        self.visits = dict()
+        self.lookups = 0
+        super(MemoryVisitManager, self).__init__(timeout)
+
+    def create_visit(self, visit_key, created, expiry):
+        self.visits[visit_key] = expiry
+
+    def lookup_expiry(self, visit_key):
+        self.lookups += 1
+        return self.visits.get(visit_key)
+
+    def update_queued_visits(self, queue):
+        self.visits.update(queue)
+
+    def delete_expired_visits(self, before, limit):
+        expired = [(expiry, visit_key)
+            for visit_key, expiry in self.visits.iteritems()
+            if expiry < before]
+        expired.sort()
+        for expiry, visit_key in expired[:limit]:
+            del self.visits[visit_key]
+        return len(expired[:limit])
+
+
+class TestVisitCache(TestCase):
+
+    def test_get_and_put(self):
+        cache = VisitCache(10, 60)
+        expiry = datetime.now() + timedelta(minutes=5)
+        assert cache.get('a') is None
+        cache.put('a', expiry)
+        assert cache.get('a') == expiry
+        assert len(cache) == 1
+
+    def test_expired(self):
+        cache = VisitCache(10, 60)
+        cache.put('a', datetime.now() - timedelta(seconds=1))
+        assert cache.get('a') is None
+        assert 'a' not in cache
+
+    def test_ttl(self):
+        cache = VisitCache(10, 0)
+        cache.put('a', datetime.now() + timedelta(minutes=5))
+        assert cache.get('a') is None
+
+    def test_lru(self):
+        cache = VisitCache(2, 60)
+        expiry = datetime.now() + timedelta(minutes=5)
+        cache.put('a', expiry)
+        cache.put('b', expiry)
+        # touch 'a' so that 'b' is the least recently used one
+        assert cache.get('a') == expiry
+        cache.put('c', expiry)
+        assert 'a' in cache and 'c' in cache
+        assert 'b' not in cache
+        assert len(cache) == 2
+
+    def test_update_and_remove(self):
+        cache = VisitCache(10, 60)
+        expiry = datetime.now() + timedelta(minutes=5)
+        cache.update('a', expiry)
+        assert 'a' not in cache
+        cache.put('a', expiry)
+        cache.update('a', expiry + timedelta(minutes=5))
+        assert cache.get('a') == expiry + timedelta(minutes=5)
+        cache.remove('a')
+        assert 'a' not in cache
+        cache.put('a', expiry)
+        cache.clear()
+        assert len(cache) == 0 and cache.get('a') is None
+
+    def test_disabled(self):
+        cache = VisitCache(0, 60)
+        cache.put('a', datetime.now() + timedelta(minutes=5))
+        assert 'a' not in cache
+
+
+class TestVisitUpdateQueue(TestCase):
+
+    def test_put_and_swap(self):
+        queue = VisitUpdateQueue(4)
+        expiry = datetime.now()
+        for i in range(10):
+            queue.put(str(i), expiry)
+        queue.put('0', expiry + timedelta(minutes=1))
+        assert len(queue) == 10
+        assert '0' in queue and 'x' not in queue
+        assert queue.get('0') == expiry + timedelta(minutes=1)
+        pending = queue.swap()
+        assert len(pending) == 10 and len(queue) == 0
+        assert pending['0'] == expiry + timedelta(minutes=1)
+        assert not queue.swap()
+
+    def test_stale_and_dropped(self):
+        queue = VisitUpdateQueue(1, 2)
+        expiry = datetime.now()
+        queue.put('a', expiry)
+        assert queue.put('a', expiry - timedelta(minutes=1)) is None
+        assert queue.get('a') == expiry and queue.stale() == 1
+        assert queue.put('b', expiry) == 2
+        assert queue.put('c', expiry) is None
+        assert 'c' not in queue and queue.dropped() == 1
+        # known visits can still be updated
+        queue.put('b', expiry + timedelta(minutes=1))
+        assert queue.get('b') == expiry + timedelta(minutes=1)
+
+
+def test_update_visit_benchmark():
+    """Measure update_visit() called by many threads while flushing."""
+    threads, updates = 64, 2000
+    durations = dict()
+    for stripes in (1, 16):
+        manager = MemoryVisitManager(timedelta(minutes=20))
+        # this test takes the role of the flusher thread
+        manager.shutdown()
+        manager.queue = VisitUpdateQueue(stripes)
+        flushed = dict()
+        expiry = datetime.now()
+
+        def request_thread(n):
+            update_visit = manager.update_visit
+            for i in xrange(updates):
+                update_visit('%d-%d' % (n, i % 100), expiry)
+
+        workers = [threading.Thread(target=request_thread, args=(n,))
+            for n in range(threads)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        while [w for w in workers if w.isAlive()]:
+            flushed.update(manager.queue.swap())
+        duration = time.time() - start
+        flushed.update(manager.queue.swap())
+        # no update may get lost while the buffers are swapped
+        assert len(flushed) == threads * 100
+        durations[stripes] = duration
+    # striping must not slow the request threads down, allowing for noise
+    assert durations[16] < durations[1] * 1.5
+
+
+class TestBaseVisitManager(TestCase):
+
+    def setUp(self):
+        self.manager = MemoryVisitManager(timedelta(minutes=20))
+
+    def tearDown(self):
+        self.manager.shutdown()
+
+    def test_new_visit_is_cached(self):
+        visit = self.manager.new_visit_with_key('a')
+        assert visit.key == 'a' and visit.is_new
+        visit = self.manager.visit_for_key('a')
+        assert visit.key == 'a' and not visit.is_new
+        assert self.manager.lookups == 0
+
+    def test_lookup_populates_cache(self):
+        self.manager.visits['a'] = datetime.now() + timedelta(minutes=5)
+        assert not self.manager.visit_for_key('a').is_new
+        assert not self.manager.visit_for_key('a').is_new
+        assert self.manager.lookups == 1
+        assert 'a' in self.manager.queue
+
+    def test_unknown_and_expired_visits(self):
+        assert self.manager.visit_for_key('a') is None
+        self.manager.visits['b'] = datetime.now() - timedelta(seconds=1)
+        assert self.manager.visit_for_key('b') is None
+        assert 'b' not in self.manager.cache
+
+    def test_update_extends_cached_expiry(self):
+        self.manager.new_visit_with_key('a')
+        expiry = datetime.now() + timedelta(hours=1)
+        self.manager.update_visit('a', expiry)
+        assert self.manager.cache.get('a') == expiry
+
+    def test_dropped_update_not_cached(self):
+        manager = self.manager
+        manager.queue = VisitUpdateQueue(1, 1)
+        manager.new_visit_with_key('a')
+        expiry = manager.cache.get('a')
+        manager.update_visit('b', datetime.now() + timedelta(hours=1))
+        manager.update_visit('a', datetime.now() + timedelta(hours=1))
+        assert 'a' not in manager.queue
+        assert manager.cache.get('a') == expiry
+
+    def test_invalidate(self):
+        self.manager.new_visit_with_key('a')
+        self.manager.invalidate('a')
+        assert self.manager.visit_for_key('a')
+        assert self.manager.lookups == 1
+
+    def test_extend_below(self):
+        manager = self.manager
+        manager.extend_below = timedelta(minutes=10)
+        manager.visits['a'] = datetime.now() + timedelta(minutes=15)
+        manager.visits['b'] = datetime.now() + timedelta(minutes=5)
+        assert manager.visit_for_key('a') and manager.visit_for_key('b')
+        assert 'a' not in manager.queue and 'b' in manager.queue
+        assert manager.get_stats()['extend_suppressed'] == 1
+
+    def test_extend_suppressed_threads(self):
+        manager = self.manager
+        manager.visits['a'] = datetime.now() + timedelta(minutes=30)
+
+        def request_thread():
+            for i in xrange(1000):
+                manager.visit_for_key('a')
+
+        workers = [threading.Thread(target=request_thread)
+            for i in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert manager.get_stats()['extend_suppressed'] == 8000
+
+    def test_extend_below_config(self):
+        extend = config.get('tools.visit.extend_below', 1.0)
+        try:
+            config.update({'tools.visit.extend_below': 0.5})
+            assert api.extend_below(timedelta(minutes=20)) == timedelta(
+                minutes=10)
+        finally:
+            config.update({'tools.visit.extend_below': extend})
+        assert api.extend_below(timedelta(minutes=20)) == timedelta(
+            minutes=20)
+
+    def test_adaptive_flush(self):
+        manager = self.manager
+        # this test takes the role of the flusher thread
+        manager.shutdown()
+        manager._flush.clear()
+        manager.high_water = 10
+        expiry = datetime.now() + timedelta(minutes=20)
+        for i in range(20):
+            manager.update_visit(str(i), expiry)
+        assert manager._flush.isSet()
+        manager.flush()
+        assert len(manager.visits) == 20
+        assert manager.interval == 15
+        stats = manager.get_stats()
+        assert stats['queue_depth'] == 0
+        assert stats['flush_runs'] == 1 and stats['flush_last_updates'] == 20
+        manager.update_visit('a', expiry)
+        manager.flush()
+        assert manager.interval == 30
+        manager.flush()
+        assert manager.get_stats()['flush_runs'] == 2
+
+    def test_collect_garbage(self):
+        manager = self.manager
+        expired = datetime.now() - timedelta(hours=1)
+        for i in range(25):
+            manager.visits['expired%d' % i] = expired
+        manager.new_visit_with_key('active')
+        manager.gc_chunk_size = 10
+        manager.gc_max_chunks = 2
+        manager._next_gc = 0
+        manager.collect_garbage()
+        assert len(manager.visits) == 6
+        assert manager.stats['gc_last_deleted'] == 20
+        # the gc interval has not yet passed
+        manager.collect_garbage()
+        assert len(manager.visits) == 6
+        manager._next_gc = 0
+        manager.collect_garbage()
+        assert manager.visits.keys() == ['active']
+        assert manager.stats['gc_runs'] == 2
+        assert manager.stats['gc_deleted'] == 25
+
+
+class TestLazyVisit(TestCase):
+
+    def setUp(self):
+        self._manager = api._manager
+        api._manager = self.manager = MemoryVisitManager(
+            timedelta(minutes=20))
+        self.cookies = []
+
+    def tearDown(self):
+        self.manager.shutdown()
+        api._manager = self._manager
+
+    def test_untouched(self):
+        visit = LazyVisit('a', self.cookies.append)
+        assert visit.is_new and not visit.dirty
+        visit.persist_if_dirty()
+        assert not self.manager.visits and not self.cookies
+
+    def test_persist(self):
+        visit = LazyVisit('a', self.cookies.append)
+        visit.persist()
+        visit.persist()
+        assert visit.persisted
+        assert 'a' in self.manager.visits
+        assert self.cookies == ['a']
+
+    def test_write_marks_dirty(self):
+        visit = LazyVisit('a', self.cookies.append)
+        visit.referer = 'http://example.com/'
+        assert visit.dirty
+        visit.persist_if_dirty()
+        assert 'a' in self.manager.visits
+
+
+class TestRequestFilter(TestCase):
+
+    def test_paths(self):
+        request_filter = RequestFilter(paths=['/favicon.ico'],
+            prefixes=['/tg_static/', '/tg_js/'], patterns=[r'/health/\w+$'])
+        assert request_filter.excludes('/favicon.ico')
+        assert request_filter.excludes('/tg_js/MochiKit.js')
+        assert request_filter.excludes('/health/db')
+        assert not request_filter.excludes('/favicon.ico/x')
+        assert not request_filter.excludes('/login')
+        assert not request_filter.excludes('/my/health/db')
+
+    def test_bots(self):
+        request_filter = RequestFilter(bots=RequestFilter.default_bots)
+        assert request_filter.excludes('/',
+            'Mozilla/5.0 (compatible; Googlebot/2.1)')
+        assert request_filter.excludes('/', 'ELB-HealthChecker/2.0')
+        assert not request_filter.excludes('/',
+            'Mozilla/5.0 (X11; Linux x86_64; rv:60.0) Firefox/60.0')
+        assert not request_filter.excludes('/')
+
+    def test_authorized_clients(self):
+        request_filter = RequestFilter(bots=RequestFilter.default_bots)
+        assert not request_filter.excludes('/api', 'curl/7.68.0',
+            'Basic dXNlcjpzZWNyZXQ=')
+        assert not request_filter.excludes('/api', 'curl/7.68.0')
+        assert not request_filter.excludes('/api', 'Wget/1.20.3 (linux-gnu)')
+        # clients that authenticate need their identity
+        assert not request_filter.excludes('/api',
+            'Zabbix monitoring (compatible; bot)', 'Basic dXNlcjpzZWNyZXQ=')
+        assert request_filter.excludes('/api',
+            'Zabbix monitoring (compatible; bot)')
+
+    def test_empty(self):
+        assert not RequestFilter()
+        assert RequestFilter(bots=['spider'])
+        assert not RequestFilter().excludes('/tg_static/logo.png')
+
+    def test_config(self):
+        bots = config.get('tools.visit.exclude.bots', False)
+        try:
+            request_filter = api._create_request_filter()
+            assert request_filter.excludes('/tg_static/logo.png')
+            assert request_filter.bots is None
+            config.update({'tools.visit.exclude.bots': True})
+            request_filter = api._create_request_filter()
+            assert request_filter.excludes('/', 'Googlebot/2.1')
+        finally:
+            config.update({'tools.visit.exclude.bots': bots})
+
+
+class BatchPlugin(object):
+    """An asynchronous visit plugin collecting the batches it gets."""
+
+    asynchronous = True
+
+    def __init__(self, **settings):
+        self.__dict__.update(settings)
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def record_requests(self, records):
+        self.release.wait()
+        self.batches.append(records)
+
+
+class TestAsyncVisitPlugin(TestCase):
+
+    def test_batches(self):
+        plugin = BatchPlugin(batch_size=10)
+        plugin.release.clear()
+        dispatcher = AsyncVisitPlugin(plugin)
+        for i in range(25):
+            dispatcher.record_request(Visit(str(i), False))
+        plugin.release.set()
+        dispatcher.shutdown()
+        records = [record for batch in plugin.batches for record in batch]
+        assert [visit.key for visit, snapshot in records] == map(str, range(25))
+        assert max(map(len, plugin.batches)) <= 10
+        assert 'path_info' in records[0][1]
+        stats = dispatcher.get_stats()
+        assert stats['records'] == 25 and stats['queue_depth'] == 0
+        assert stats['batches'] == len(plugin.batches)
+
+    def test_drop_when_full(self):
+        plugin = BatchPlugin(queue_size=5, batch_size=1)
+        plugin.release.clear()
+        dispatcher = AsyncVisitPlugin(plugin)
+        for i in range(20):
+            dispatcher.record_request(Visit(str(i), False))
+        plugin.release.set()
+        dispatcher.shutdown()
+        stats = dispatcher.get_stats()
+        # one record may have been taken by the blocked worker
+        assert stats['queued'] + stats['dropped'] == 20
+        assert 5 <= stats['queued'] <= 6
+        assert stats['records'] == stats['queued']
+
+    def test_block_when_full(self):
+        plugin = BatchPlugin(queue_size=2, batch_size=1, overflow='block',
+            block_timeout=0.01)
+        plugin.release.clear()
+        dispatcher = AsyncVisitPlugin(plugin)
+        for i in range(5):
+            dispatcher.record_request(Visit(str(i), False))
+        assert dispatcher.get_stats()['dropped'] >= 2
+        threading.Timer(0.05, plugin.release.set).start()
+        # waits until the plugin has taken records from the queue
+        dispatcher.block_timeout = 5
+        dispatcher.record_request(Visit('late', False))
+        dispatcher.shutdown()
+        assert plugin.batches[-1][-1][0].key == 'late'
+
+    def test_errors_are_counted(self):
+        plugin = BatchPlugin()
+        plugin.record_requests = None
+        dispatcher = AsyncVisitPlugin(plugin)
+        dispatcher.record_request(Visit('a', False))
+        dispatcher.shutdown()
+        assert dispatcher.get_stats()['errors'] == 1
+
+    def test_invalid_overflow(self):
+        self.assertRaises(config.ConfigError,
+            AsyncVisitPlugin, BatchPlugin(overflow='ignore'))
+
+
+class TestSignedCookieVisitManager(TestCase):
+
+    def setUp(self):
+        self._secret = config.get('tools.visit.signed.secret', None)
+        config.update({'tools.visit.signed.secret': 'sekrit'})
+        self.manager = SignedCookieVisitManager(timedelta(minutes=20))
+
+    def tearDown(self):
+        config.update({'tools.visit.signed.secret': self._secret})
+
+    def test_round_trip(self):
+        visit = self.manager.new_visit_with_key('a')
+        assert visit.is_new
+        cookie_value = self.manager.cookie_value(visit)
+        assert cookie_value.startswith('a-')
+        visit = self.manager.visit_for_key(cookie_value)
+        assert visit.key == 'a' and not visit.is_new
+        # no need to re-issue the cookie of a fresh visit
+        assert self.manager.cookie_value(visit) is None
+
+    def test_tampered(self):
+        visit = self.manager.new_visit_with_key('a')
+        cookie_value = self.manager.cookie_value(visit)
+        assert self.manager.visit_for_key('b' + cookie_value[1:]) is None
+        assert self.manager.visit_for_key(cookie_value[:-1] + 'x') is None
+        assert self.manager.visit_for_key('garbage') is None
+
+    def test_renew_and_expire(self):
+        visit = self.manager.new_visit_with_key('a')
+        visit.expiry = datetime.now() + timedelta(minutes=5)
+        visit = self.manager.visit_for_key(self.manager.encode(visit))
+        assert visit.expiry > datetime.now() + timedelta(minutes=19)
+        assert self.manager.cookie_value(visit)
+        visit.expiry = datetime.now() - timedelta(minutes=1)
+        assert self.manager.visit_for_key(self.manager.encode(visit)) is None
+
+    def test_secret_required(self):
+        config.update({'tools.visit.signed.secret': None})
+        self.assertRaises(config.ConfigError,
+            SignedCookieVisitManager, timedelta(minutes=20))
+
+
+class TestVisitTable(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_shared_between_tables(self):
+        table = VisitTable(self.path, 64)
+        other = VisitTable(self.path, 64)
+        expiry = int(time.time()) + 60
+        table.put('a', expiry)
+        assert other.get('a') == expiry
+        other.put('a', expiry + 60)
+        assert table.get('a') == expiry + 60
+        other.remove('a')
+        assert table.get('a') is None
+        table.close()
+        other.close()
+
+    def test_eviction(self):
+        table = VisitTable(self.path, 4)
+        expiry = int(time.time()) + 60
+        for i in range(4):
+            table.put(str(i), expiry + i)
+        table.put('new', expiry + 10)
+        # the visit that expires first has been evicted
+        assert table.get('0') is None and table.get('new') == expiry + 10
+        assert table.get('3') == expiry + 3
+        table.close()
+
+    def test_torn_slot(self):
+        table = VisitTable(self.path, 64)
+        table.put('a', int(time.time()) + 60)
+        offset = table._offsets('a').next()
+        # simulate a concurrent partial write of the expiry
+        table.map[offset + 47] = chr(ord(table.map[offset + 47]) ^ 1)
+        assert table.get('a') is None
+        table.close()
+
+    def test_resized(self):
+        old = VisitTable(self.path, 64)
+        expiry = int(time.time()) + 60
+        old.put('a', expiry)
+        table = VisitTable(self.path, 128)
+        assert table.get('a') is None
+        assert os.path.getsize(self.path) == table.size
+        # the table mapped by a running process is left alone
+        assert old.get('a') == expiry
+        old.put('b', expiry)
+        table.close()
+        old.close()
+
+    def test_stale_header(self):
+        f = open(self.path, 'wb')
+        f.write('garbage')
+        f.close()
+        table = VisitTable(self.path, 64)
+        table.put('a', int(time.time()) + 60)
+        other = VisitTable(self.path, 64)
+        assert other.get('a')
+        other.close()
+        table.close()
+
+
+class TestSharedMemoryVisitManager(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self._config = dict((key, config.get(key, None)) for key in (
+            'tools.visit.shm.backend', 'tools.visit.shm.path'))
+        config.update({'tools.visit.shm.backend': __name__
+            + '.MemoryVisitManager', 'tools.visit.shm.path': self.path})
+        self.manager = SharedMemoryVisitManager(timedelta(minutes=20))
+        self.other = SharedMemoryVisitManager(timedelta(minutes=20))
+
+    def tearDown(self):
+        self.manager.shutdown()
+        self.other.shutdown()
+        config.update(self._config)
+        os.remove(self.path)
+
+    def test_visit_shared_between_processes(self):
+        visit = self.manager.new_visit_with_key('a')
+        assert visit.is_new and 'a' in self.manager.backend.visits
+        visit = self.other.visit_for_key('a')
+        assert visit.key == 'a' and not visit.is_new
+        assert self.other.backend.lookups == 0
+        assert self.other.get_stats()['shm_hits'] == 1
+
+    def test_miss_falls_back_to_backend(self):
+        backend = self.manager.backend
+        backend.visits['a'] = datetime.now() + timedelta(minutes=5)
+        assert self.manager.visit_for_key('a')
+        assert backend.lookups == 1
+        assert self.other.visit_for_key('a')
+        assert self.other.backend.lookups == 0
+        assert self.manager.visit_for_key('b') is None
+
+    def test_miss_keeps_backend_expiry(self):
+        manager = self.manager
+        backend = manager.backend
+        # a small extend fraction: the backend doesn't extend the visit
+        backend.extend_below = timedelta(minutes=5)
+        expiry = (datetime.now() + timedelta(minutes=15)).replace(
+            microsecond=0)
+        backend.visits['a'] = expiry
+        assert manager.visit_for_key('a')
+        assert 'a' not in backend.queue
+        assert manager.table.get('a') == int(time.mktime(expiry.timetuple()))
+        # the visit is extended when the backend extends it
+        backend.cache.clear()
+        backend.visits['a'] = expiry = expiry - timedelta(minutes=12)
+        manager.table.remove('a')
+        assert manager.visit_for_key('a')
+        assert manager.table.get('a') == int(time.mktime(
+            backend.queue.get('a').timetuple()))
+
+    def test_extend_is_persisted(self):
+        manager = self.manager
+        manager.extend_below_seconds = 600
+        manager.table.put('a', int(time.time()) + 300)
+        assert manager.visit_for_key('a')
+        assert 'a' in manager.backend.queue
+        assert manager.table.get('a') > time.time() + 1000
+
+    def test_invalidate(self):
+        self.manager.new_visit_with_key('a')
+        self.other.invalidate('a')
+        assert self.manager.visit_for_key('a')
+        assert self.manager.get_stats()['shm_misses'] == 1
+
+
+class CheckoutCounter(PoolListener):
+    """Count the connections checked out from a pool."""
+
+    count = 0
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        self.count += 1
+
+
+class TestSqlAlchemyVisitManager(TestCase):
+
+    def setUp(self):
+        self.checkouts = CheckoutCounter()
+        metadata = MetaData(create_engine('sqlite:///:memory:',
+            listeners=[self.checkouts]))
+        # other column names than in TG_Visit
+        self.table = Table('visit', metadata,
+            Column('id', String(40), primary_key=True),
+            Column('created', DateTime),
+            Column('expires', DateTime))
+        metadata.create_all()
+
+        class Visit(object):
+            pass
+
+        mapper(Visit, self.table, properties=dict(
+            visit_key=self.table.c.id, expiry=self.table.c.expires))
+        self._visit_class = savisit.visit_class
+        savisit.visit_class = Visit
+        # the manager thread is not needed for flushing the queue
+        self.manager = savisit.SqlAlchemyVisitManager.__new__(
+            savisit.SqlAlchemyVisitManager)
+
+    def tearDown(self):
+        savisit.visit_class = self._visit_class
+
+    def expiries(self):
+        return dict(self.table.bind.execute(
+            select([self.table.c.id, self.table.c.expires])).fetchall())
+
+    def test_update_queued_visits(self):
+        now = datetime.now().replace(microsecond=0)
+        self.table.insert().execute([dict(id=key, created=now, expires=now)
+            for key in 'abc'])
+        queue = dict(a=now + timedelta(minutes=1),
+            b=now + timedelta(minutes=2))
+        self.manager.update_queued_visits(queue)
+        assert self.expiries() == dict(queue, c=now)
+
+    def test_empty_queue(self):
+        checkouts = self.checkouts.count
+        self.manager.update_queued_visits(dict())
+        # no connection and thereby no transaction is used
+        assert self.checkouts.count == checkouts
+        self.manager.update_queued_visits(dict(a=datetime.now()))
+        assert self.checkouts.count == checkouts + 1
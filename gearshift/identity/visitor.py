@@ -1,6 +1,12 @@
 """The visit and identity management *plugins* are defined here."""
 
 import base64
+import hmac
+import os
+try:
+    from hashlib import sha256 as credentials_digest
+except ImportError: # Python < 2.5
+    from sha import sha as credentials_digest
 
 from cherrypy import request
 
@@ -9,6 +15,9 @@ from gearshift.identity import create_default_provider
 from gearshift.identity import set_current_identity
 from gearshift.identity import set_current_provider
 from gearshift.identity import set_login_attempted
+from gearshift.identity.base import set_identity_caches
+from gearshift.identity.cache import CachedIdentity, MemoryIdentityCache, \
+    cache_entry, create_identity_cache
 
 from gearshift.identity.exceptions import *
 
@@ -19,16 +28,34 @@ oauth = None
 import logging
 log = logging.getLogger("gearshift.identity")
 
-def create_extension_model():
-    provider = create_default_provider()
+def create_extension_model(provider=None):
+    if provider is None:
+        provider = create_default_provider()
     provider.create_provider_model()
 
 class IdentityVisitPlugin(object):
-    def __init__(self):
+    def __init__(self, provider=None):
         log.info("Identity visit plugin initialised")
         get = gearshift.config.get
 
-        self.provider = create_default_provider()
+        if provider is None:
+            provider = create_default_provider()
+        self.provider = provider
+        # Optional cache of identities loaded from the visit
+        self.identity_cache = create_identity_cache()
+        # Optional cache of identities verified by HTTP Basic auth, keyed by
+        # a keyed hash of the credentials that is only valid in this process.
+        # invalidate_user() only reaches the cache of this process; other
+        # processes accept an old password until its entry is older than
+        # the ttl.
+        if get('tools.identity.http_auth.cache.on', False):
+            self.credentials_cache = MemoryIdentityCache(
+                get('tools.identity.http_auth.cache.size', 1000),
+                get('tools.identity.http_auth.cache.ttl', 60))
+            self.credentials_secret = os.urandom(32)
+        else:
+            self.credentials_cache = None
+        set_identity_caches(self.identity_cache, self.credentials_cache)
 
         # When retrieving identity information from the form, use the following
         # form field names. These fields will be removed from the post data to
@@ -129,13 +156,40 @@ class IdentityVisitPlugin(object):
             log.error("HTTP Auth is not basic")
             return None
 
+        set_login_attempted(True)
+        cache = self.credentials_cache
+        if cache is not None:
+            credentials_key = hmac.new(self.credentials_secret,
+                schemeData.strip(), credentials_digest).digest()
+            entry = cache.get(credentials_key)
+            if entry is not None:
+                def validate():
+                    # the full identity is only validated when needed
+                    user_name, password = self.decode_basic_credentials(
+                        schemeData)
+                    return self.provider.validate_identity(
+                        user_name, password, visit_key)
+                return CachedIdentity(visit_key, entry, validate)
         # decode credentials
         user_name, password = self.decode_basic_credentials(schemeData)
-        set_login_attempted(True)
-        return self.provider.validate_identity(user_name, password, visit_key)
+        identity = self.provider.validate_identity(
+            user_name, password, visit_key)
+        if identity is not None and cache is not None:
+            cache.put(credentials_key, cache_entry(identity))
+        return identity
 
     def identity_from_visit(self, visit_key):
-        return self.provider.load_identity(visit_key)
+        cache = self.identity_cache
+        if cache is None:
+            return self.provider.load_identity(visit_key)
+        entry = cache.get(visit_key)
+        if entry is not None:
+            return CachedIdentity(visit_key, entry,
+                lambda: self.provider.load_identity(visit_key))
+        identity = self.provider.load_identity(visit_key)
+        if not identity.anonymous:
+            cache.put(visit_key, cache_entry(identity))
+        return identity
 
     def identity_from_form(self, visit_key):
         """Inspect the form to pull out identity information.
@@ -158,6 +212,7 @@ class IdentityVisitPlugin(object):
                 submit_x = params.pop('%s.x' % self.submit_button_name, None)
                 submit_y = params.pop('%s.y' % self.submit_button_name, None)
                 set_login_attempted(True)
+                request.identity_form_login = True
                 identity = self.provider.validate_identity(user_name, pw, visit_key)
                 if identity is None:
                     log.warning("The credentials specified weren't valid")
@@ -169,6 +224,14 @@ class IdentityVisitPlugin(object):
         else:
             return None
 
+    def skip_request(self):
+        """Set the anonymous identity for a request that isn't tracked."""
+        if not gearshift.config.get('tools.identity.on', True):
+            set_current_identity(None)
+            return
+        set_current_identity(self.provider.anonymous_identity())
+        set_current_provider(self.provider)
+
     def record_request(self, visit):
         # default to keeping the identity hook off
         if not gearshift.config.get('tools.identity.on', True):
@@ -186,4 +249,11 @@ class IdentityVisitPlugin(object):
         # stash the user in the thread data for this request
         set_current_identity(identity)
         set_current_provider(self.provider)
+        # Lazily created visits must be stored when a user has logged in
+        # with the login form. HTTP Basic auth sends the credentials with
+        # every request, so these requests do not need a stored visit.
+        if (getattr(request, 'identity_form_login', False)
+                and not identity.anonymous
+                and not getattr(visit, 'persisted', True)):
+            visit.persist()
         
\ No newline at end of file
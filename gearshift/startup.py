@@ -26,6 +26,7 @@ from gearshift.visit.api import VisitTool
 from gearshift import controllers
 from gearshift import visit
 from gearshift.tools.identity import IdentityTool
+from gearshift.tools.expose.render import precompile_templates
 from gearshift import identity
     
 try:
@@ -104,6 +105,10 @@ def startTurboGears():
     if conf('sqlalchemy.dburi'):
         database.bind_metadata()
 
+    # Compile the exposed templates before the first requests need them
+    if conf('tools.expose.precompile', True):
+        precompile_templates()
+
     # Call registered startup functions
     for item in call_on_startup:
         item()
@@ -126,6 +131,7 @@ def stopTurboGears():
 
     #  Stops all TurboGears extensions
     visit.shutdown_extension()
+    cherrypy.tools.identity.shutdown_extension()
 
     for item in call_on_shutdown:
         item()
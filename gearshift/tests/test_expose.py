@@ -1,5 +1,8 @@
+import time
+
+import cherrypy
 import simplejson
-from gearshift import controllers, expose
+from gearshift import config, controllers, expose
 from gearshift.testutil import make_app, start_server, stop_server
 
 def setup_module():
@@ -73,3 +76,125 @@ def test_allow_json():
     assert values == dict(title="Foobar", mybool=False, someval="niggles",
         tg_flash=None)
     assert response.headers["Content-Type"] == "application/json"
+
+def test_precompile_templates():
+    from gearshift.tools.expose.render import exposed_templates, \
+        precompile_templates
+
+    class SubController(controllers.Controller):
+
+        @expose("gearshift.tests.doesnotexist")
+        def missing(self):
+            return dict()
+
+    class PrecompileRoot(ExposeRoot):
+        sub = SubController()
+
+    assert exposed_templates(PrecompileRoot()) == set([
+        ("gearshift.tests.simple", None),
+        ("genshi:gearshift.tests.textfmt", "text"),
+        ("gearshift.tests.doesnotexist", None)])
+    assert precompile_templates([PrecompileRoot()]) == dict(genshi=3)
+    from gearshift.tools.expose.render import genshi_loader
+    cached = list(genshi_loader._cache)
+    assert [path for path in cached if path.endswith('simple.html')]
+    assert [path for path in cached if path.endswith('textfmt.txt')]
+
+def test_streaming():
+
+    class StreamRoot(controllers.RootController):
+        _cp_config = { "tools.expose.on" : True }
+
+        @expose("gearshift.tests.simple", stream=True)
+        @expose("json", as_format="json", stream=True)
+        def report(self):
+            return dict(someval=u"\xe9" * 10000)
+
+        @expose("gearshift.tests.simple")
+        def buffered(self):
+            return self.report()
+
+        @expose("gearshift.tests.simple", stream=True)
+        def in_transaction(self):
+            request = cherrypy.request
+            request.in_transaction = True
+            request.hooks.attach('on_end_resource',
+                lambda: streamed.append(cherrypy.response.stream))
+            return self.report()
+
+    streamed = []
+
+    app = make_app(StreamRoot)
+    response = app.get("/report")
+    assert "Paging all " + "\xc3\xa9" * 10000 in response
+    buffered = app.get("/buffered")
+    assert response.body == buffered.body
+    assert response.headers["Content-Type"] == buffered.headers["Content-Type"]
+    # the page is rendered within the transaction
+    assert app.get("/in_transaction").body == buffered.body
+    assert streamed == [False]
+    # engines that can not stream return the whole output
+    response = app.get("/report?tg_format=json")
+    assert simplejson.loads(response.body)["someval"] == u"\xe9" * 10000
+
+def test_stream_chunks():
+    from gearshift.tools.expose.render import encode_chunks, render
+    chunks = list(encode_chunks([u"\xe9"] * 10, "utf-8", size=4))
+    assert chunks == ["\xc3\xa9" * 4, "\xc3\xa9" * 4, "\xc3\xa9" * 2]
+    info = dict(someval="foo")
+    output = render(info.copy(), template="gearshift.tests.simple",
+        stream=True)
+    assert not isinstance(output, basestring)
+    assert "".join(output) == render(info.copy(),
+        template="gearshift.tests.simple")
+
+def test_expose_table():
+    from gearshift.tools.expose.tool import ExposeTable
+    exposes = ExposeRoot.with_json_via_accept._cp_config[
+        "tools.expose.exposes"]
+    table = ExposeTable(exposes, __name__)
+    get = config.get
+    html = table.resolve(None, "text/html", get)
+    assert html[0] == "gearshift.tests.simple"
+    assert html[-1][2:] == ("genshi", "html", "text/html; charset=utf-8")
+    assert table.resolve(None, "text/html", get) is html
+    text = table.resolve(None, "text/plain", get)
+    assert text[-1][2:] == ("genshi", "text", "text/plain; charset=utf-8")
+    json = table.resolve("json", "text/html", get)
+    assert json[-1][2:] == ("json", "json", "application/json")
+    # the table is computed again after config updates
+    config.update({"tg.content_type": None})
+    assert table.resolve(None, "text/html", get) is not html
+    assert table.resolve(None, "text/html", get) == html
+    # and for other settings of the request
+    settings = {"tools.expose.stream": True}
+    assert table.resolve(None, "text/html", settings.get)[4]
+    settings["tg.content_type"] = "text/xml"
+    assert table.resolve(None, "text/html", settings.get)[5] == "text/xml"
+
+def test_expose_overhead():
+    """Compare choosing the expose options per request with the table."""
+    from gearshift.tools.expose.tool import ExposeTable
+    exposes = ExposeRoot.with_json_via_accept._cp_config[
+        "tools.expose.exposes"]
+    table = ExposeTable(exposes, __name__)
+    accept = "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8"
+    # a plain dict like request.config
+    get = dict(config.server).get
+    durations = dict()
+    for name, resolve in (("per request", table._resolve),
+                          ("table", table.resolve)):
+        start = time.time()
+        for i in xrange(1000):
+            resolve(None, accept, get)
+        durations[name] = time.time() - start
+    assert durations["table"] < durations["per request"] / 2
+
+def test_config_table():
+    from gearshift.tools.expose.tool import _config_table
+    get = dict().get
+    table = _config_table(get)
+    assert _config_table(get) is table
+    exposes = dict(default=dict(template="json"))
+    other = _config_table({"tools.expose.exposes": exposes}.get)
+    assert other is not table and other.exposes is exposes
@@ -0,0 +1,177 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+import cherrypy
+from cherrypy._cprequest import Request, Response
+from cherrypy.lib import httputil
+
+from gearshift.tools import pagecache
+from gearshift.tools.pagecache import FilePageStore, MemoryPageStore, \
+    PageCacheTool
+
+
+class PageStoreTests(object):
+    """Tests that apply to all page stores."""
+
+    entry = ([('Content-Type', 'text/html')], '<html/>', '"abc"', 0,
+        ('products',), 60)
+
+    def test_get_and_put(self):
+        assert self.store.get('a') is None
+        self.store.put('a', self.entry)
+        assert self.store.get('a') == self.entry
+
+    def test_ttl(self):
+        self.store.put('a', self.entry[:5] + (-1,))
+        assert self.store.get('a') is None
+        self.store.ttl = -1
+        self.store.put('b', self.entry)
+        assert self.store.get('b') is None
+
+    def test_invalidate_tags(self):
+        self.store.put('a', self.entry)
+        self.store.put('b', self.entry[:4] + (('news',), 60))
+        time.sleep(0.01)
+        self.store.invalidate_tags(['products'])
+        assert self.store.get('a') is None
+        assert self.store.get('b')
+        # pages cached afterwards are valid again
+        time.sleep(0.01)
+        self.store.put('a', self.entry)
+        assert self.store.get('a') == self.entry
+
+
+class TestMemoryPageStore(PageStoreTests, TestCase):
+
+    def setUp(self):
+        self.store = MemoryPageStore(10, 60)
+
+
+class TestFilePageStore(PageStoreTests, TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = FilePageStore(self.path, 60)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_cleanup(self):
+        self.store.size = 4
+        old = time.time() - 120
+        for key in 'abc':
+            self.store.put(key, self.entry)
+            os.utime(self.store._filename('pages', key), (old, old))
+        self.store.invalidate_tags(['products'])
+        os.utime(self.store._filename('tags', 'products'), (old, old))
+        self.store.put('d', self.entry)
+        # expired pages and tags are removed when size pages were stored
+        assert self.store.get('d') == self.entry
+        assert len(os.listdir(os.path.join(self.path, 'pages'))) == 1
+        assert not os.listdir(os.path.join(self.path, 'tags'))
+        for key in 'efgh':
+            self.store.put(key, self.entry)
+            time.sleep(0.01)
+        self.store.cleanup()
+        # only the newest pages are kept
+        assert len(os.listdir(os.path.join(self.path, 'pages'))) == 4
+        assert self.store.get('d') is None and self.store.get('h')
+
+
+class TestPageCacheTool(TestCase):
+
+    def setUp(self):
+        pagecache.set_page_store(MemoryPageStore(10, 60))
+        self.tool = PageCacheTool()
+        self.calls = 0
+        self._serving = cherrypy.serving.request, cherrypy.serving.response
+
+    def tearDown(self):
+        cherrypy.serving.request, cherrypy.serving.response = self._serving
+        pagecache.set_page_store(None)
+
+    def controller(self, page=1):
+        self.calls += 1
+        cherrypy.response.headers['Content-Type'] = 'text/html'
+        return '<html>page %s</html>' % page
+
+    def request(self, query_string='page=1', headers={}, **kw):
+        local = httputil.Host('127.0.0.1', 50000, '')
+        remote = httputil.Host('127.0.0.1', 50001, '')
+        request = Request(local, remote)
+        request.query_string = query_string
+        request.path_info = '/products'
+        request.headers = httputil.HeaderMap(headers)
+        request.handler = self.controller
+        request.stage = 'before_handler'
+        request.config = {}
+        cherrypy.serving.request = request
+        cherrypy.serving.response = response = Response()
+        self.tool.before_handler(**kw)
+        if request.handler is not None:
+            response.body = request.handler()
+        return response
+
+    def test_cached(self):
+        response = self.request()
+        assert self.calls == 1
+        etag = response.headers['ETag']
+        response = self.request()
+        assert self.calls == 1
+        assert response.collapse_body() == '<html>page 1</html>'
+        assert response.headers['Content-Type'] == 'text/html'
+        assert response.headers['ETag'] == etag
+        assert response.headers['Last-Modified']
+
+    def test_shared_caches(self):
+        for i in range(2):
+            response = self.request()
+            assert response.headers['Vary'] == 'Accept, Accept-Language'
+            assert response.headers['Cache-Control'] == 'private'
+        assert self.calls == 1
+        response = self.request(vary_identity=False)
+        assert 'Cache-Control' not in response.headers
+        assert response.headers['Vary'] == 'Accept, Accept-Language'
+
+    def test_vary(self):
+        self.request()
+        self.request('page=2')
+        self.request(headers={'Accept': 'application/json'})
+        self.request(headers={'Accept-Language': 'de'})
+        assert self.calls == 4
+        self.request('page=3&sort=name', params=['page'])
+        assert self.calls == 5
+        self.request('page=3&sort=date', params=['page'])
+        assert self.calls == 5
+
+    def test_not_modified(self):
+        etag = self.request().headers['ETag']
+        response = self.request(headers={'If-None-Match': etag})
+        assert response.status == 304
+        assert not response.collapse_body()
+        modified = response.headers['Last-Modified']
+        response = self.request(headers={'If-Modified-Since': modified})
+        assert response.status == 304
+        assert self.calls == 1
+
+    def test_invalidate_tags(self):
+        self.request(tags=['products'])
+        time.sleep(0.01)
+        pagecache.invalidate_tags('products')
+        self.request(tags=['products'])
+        assert self.calls == 2
+
+    def test_cookies_not_cached(self):
+        controller = self.controller
+
+        def flash(page=1):
+            cherrypy.response.cookie['tg_flash'] = 'saved'
+            return controller(page)
+
+        self.controller = flash
+        self.request()
+        self.request()
+        assert self.calls == 2
@@ -275,3 +275,71 @@ def test_match_ip():
         '2001:0db8:85a3:08d3:1399:8a2e:0370:7334')
     assert not m('2001:db8:85a3:8d3:1300::/72',
         '2001:0db8:85a3:08d3:1219:8a2e:0370:7334')
+
+
+def test_ip_range_set():
+    s = util.IPRangeSet(['192.168.42.76/31', '224.0.0.0/3', '1.2.3.4',
+        '2001:db8:85a3:8d3:1300::/72', '10.0.0.0/8', '10.1.0.0/16'])
+    # the overlapping and adjacent blocks are merged
+    assert len(s) == 5
+    for ip in ('192.168.42.76', '192.168.42.77', '224.1.2.3',
+            '255.255.255.255', '1.2.3.4', '::ffff:102:304', '10.1.2.3',
+            '2001:0db8:85a3:08d3:1399:8a2e:0370:7334'):
+        assert ip in s, ip
+    for ip in ('192.168.42.73', '192.168.42.78', '192.0.0.0', '1.2.3.5',
+            '::102:304', '11.0.0.0', '9.255.255.255', '0.0.0.0',
+            '2001:0db8:85a3:08d3:1219:8a2e:0370:7334'):
+        assert ip not in s, ip
+    assert '1.2.3.4' not in util.IPRangeSet()
+    assert '::1' in util.IPRangeSet(['::/0'])
+
+
+def test_ip_range_set_from_file():
+    import os, tempfile
+    fd, path = tempfile.mkstemp()
+    try:
+        os.write(fd, '# corporate networks\n\n')
+        for i in range(2000):
+            os.write(fd, '10.%d.%d.0/24 # site %d\n' % (i // 256, i % 256, i))
+        os.close(fd)
+        s = util.IPRangeSet.from_file(path)
+    finally:
+        os.remove(path)
+    # adjacent blocks are merged into one range
+    assert len(s) == 1
+    assert '10.7.207.255' in s
+    assert '10.7.208.0' not in s
+
+def test_lru_cache():
+    cache = util.LRUCache(2, 60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    cache.update('a', 4)
+    assert cache.get('a') == 4
+    cache.remove('a')
+    assert cache.get('a') is None and len(cache) == 1
+    cache.ttl = -1
+    assert cache.get('c') is None and len(cache) == 0
+
+
+def test_lazy_bunch():
+    calls = []
+    def compute():
+        calls.append(1)
+        return 42
+    bunch = util.LazyBunch(a=1)
+    bunch.set_lazy(b=compute)
+    assert 'b' in bunch and len(bunch) == 2
+    assert not calls
+    assert bunch.b == bunch['b'] == bunch.get('b') == 42
+    assert len(calls) == 1
+    bunch.set_lazy(c=lambda: 1 / 0)
+    bunch.c = 3
+    assert sorted(bunch.items()) == [('a', 1), ('b', 42), ('c', 3)]
+    bunch.set_lazy(d=lambda: 1 / 0)
+    del bunch.d
+    assert 'd' not in bunch and bunch.get('d') is None
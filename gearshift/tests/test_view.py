@@ -37,6 +37,25 @@ class TestView(unittest.TestCase):
         assert not view.base.ipeek(seq)
         assert list(seq) == []
 
+    def test_lazy_stdvars(self):
+        calls = []
+        def provider(tg_vars):
+            tg_vars.set_lazy(report=lambda: calls.append(1) or 'report')
+        view.variable_providers.append(provider)
+        view.lazy_variables['total'] = lambda: calls.append(2) or 42
+        try:
+            tg = view.stdvars()['tg']
+            assert 'locale' in tg._lazy and 'session' in tg._lazy
+            assert tg.tg_version and tg.url
+            assert not calls
+            assert tg.total == 42 and tg.report == 'report'
+            assert calls == [2, 1]
+            assert tg.locale == 'en' and tg.session is None
+            assert view.stdvars()['tg'].tg_static == tg.tg_static
+        finally:
+            view.variable_providers.remove(provider)
+            del view.lazy_variables['total']
+
     def test_UnicodeValueAppearingInATemplateIsFine(self):
         ustr = u"micro-eXtreme Programming ( µ XP): Embedding XP Within Standard Projects"
         info = dict(someval=ustr)
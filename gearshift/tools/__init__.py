@@ -1,4 +1,5 @@
 from expose import ExposeTool
 from markup import MarkupTool
 from flash import FlashTool
-from elementtool import ElementTool
\ No newline at end of file
+from elementtool import ElementTool
+from pagecache import PageCacheTool
@@ -16,7 +16,11 @@ except ImportError:
         return pathname
 
 import os.path
+import itertools
 import logging
+import sys
+import time
+import types
 
 import cherrypy
 from cherrypy import request, response
@@ -31,61 +35,89 @@ from gearshift.i18n import gettext, lazy_gettext
 log = logging.getLogger("gearshift.expose")
 
 engines = dict()
+# Functions loading and compiling a template into the cache of an engine
+loaders = dict()
+# Functions rendering a template into an iterator of encoded chunks
+streamers = dict()
 
-def render_kajiki(template=None, info=None, format=None, fragment=False, mapping=None):
+def load_kajiki(template, format=None):
     global kajiki_loader
     if kajiki_loader is None:
         # Lazy imports of Kajiki
         from kajiki import PackageLoader
         kajiki_loader = PackageLoader()
             
-    Template = kajiki_loader.import_(template)
+    return kajiki_loader.import_(template)
+
+loaders['kajiki'] = load_kajiki
+
+def _kajiki_template(template, info, format):
+    Template = load_kajiki(template, format)
        
     context = Bunch()
     context.update(stdvars())
     context.update(info)
 
-    templ = Template(context)
-    return templ.render()
+    return Template(context)
+
+def render_kajiki(template=None, info=None, format=None, fragment=False, mapping=None):
+    return _kajiki_template(template, info, format).render()
 
 engines['kajiki'] = render_kajiki
 
-def render_genshi(template=None, info=None, format=None, fragment=False, mapping=None):
-    global genshi, genshi_loader
-    if genshi is None:
-        # Lazy imports of Genshi
-        import genshi
-        import genshi.template
-        import genshi.output
-        import genshi.input
-        import genshi.filters
-    
-        def genshi_loader_callback(template):
-            """This function will be called by genshi TemplateLoader after
-            loading the template"""
-            translator = genshi.filters.Translator(gettext)
-            # Genshi 0.6 supports translation directives. Lets use them if available.
-            if hasattr(translator, "setup"):
-                translator.setup(template)
-            else:
-                template.filters.insert(0, translator)
-        
-        if config.get("i18n.run_template_filter", False):
-            callback = genshi_loader_callback
-        else:
-            callback = None
-        
-        auto_reload = config.get("genshi.auto_reload", "1")
-        if isinstance(auto_reload, basestring):
-            auto_reload = auto_reload.lower() in ('1', 'on', 'yes', 'true')
+def stream_kajiki(template=None, info=None, format=None, fragment=False, mapping=None):
+    templ = _kajiki_template(template, info, format)
+    errors = format == 'text' and 'strict' or 'xmlcharrefreplace'
+    return encode_chunks(iter(templ),
+        get_template_encoding_default('kajiki'), errors)
 
-        max_cache_size = config.get("genshi.max_cache_size", 25)
+streamers['kajiki'] = stream_kajiki
 
-        genshi_loader = genshi.template.TemplateLoader([""],
-                auto_reload=auto_reload,
-                callback=genshi_loader_callback,
-                max_cache_size=max_cache_size,
-        )
+def _init_genshi():
+    global genshi, genshi_loader
+    # Lazy imports of Genshi
+    import genshi
+    import genshi.template
+    import genshi.output
+    import genshi.input
+    import genshi.filters
+
+    def genshi_loader_callback(template):
+        """This function will be called by genshi TemplateLoader after
+        loading the template"""
+        translator = genshi.filters.Translator(gettext)
+        # Genshi 0.6 supports translation directives. Lets use them if available.
+        if hasattr(translator, "setup"):
+            translator.setup(template)
+        else:
+            template.filters.insert(0, translator)
+    
+    if config.get("i18n.run_template_filter", False):
+        callback = genshi_loader_callback
+    else:
+        callback = None
+    
+    auto_reload = config.get("genshi.auto_reload", "1")
+    if isinstance(auto_reload, basestring):
+        auto_reload = auto_reload.lower() in ('1', 'on', 'yes', 'true')
+
+    # Zero means no limit; the default is raised by precompile_templates()
+    # if there are more templates than that
+    max_cache_size = config.get("genshi.max_cache_size", None)
+    if max_cache_size is None:
+        max_cache_size = 25
+    elif not max_cache_size:
+        max_cache_size = sys.maxint
+
+    genshi_loader = genshi.template.TemplateLoader([""],
+            auto_reload=auto_reload,
+            callback=genshi_loader_callback,
+            max_cache_size=max_cache_size,
+    )
+
+def load_genshi(template, format=None):
+    if genshi is None:
+        _init_genshi()
 
     # Choose Genshi template engine
     if format == "text":
@@ -108,7 +140,13 @@ def render_genshi(template=None, info=None, format=None, fragment=False, mapping
         template = '%s.%s' % (template, default_extension)
     
     encoding = config.get("genshi.encoding", "utf-8")
-    templ = genshi_loader.load(template, encoding=encoding, cls=cls)
+    return genshi_loader.load(template, encoding=encoding, cls=cls)
+
+loaders['genshi'] = load_genshi
+
+def _generate_genshi(template, info, format, fragment, mapping):
+    """Return the serializer and the event stream of a Genshi template."""
+    templ = load_genshi(template, format)
 
     if format == 'html' and not fragment:
         mapping.setdefault('doctype', config.get('genshi.default_doctype',
@@ -130,12 +168,30 @@ def render_genshi(template=None, info=None, format=None, fragment=False, mapping
     stream = templ.generate(context)
     if config.get('genshi.html_form_filler', False):
         stream = stream | genshi.filters.HTMLFormFiller(data=info)
-    
+    return serializer, stream
+
+def render_genshi(template=None, info=None, format=None, fragment=False, mapping=None):
+    serializer, stream = _generate_genshi(template, info, format, fragment,
+                                          mapping)
     encode = genshi.output.encode
-    return encode(serializer(stream), method=serializer, encoding=encoding)
+    return encode(serializer(stream), method=serializer,
+        encoding=config.get("genshi.encoding", "utf-8"))
 
 engines['genshi'] = render_genshi
 
+def stream_genshi(template=None, info=None, format=None, fragment=False, mapping=None):
+    serializer, stream = _generate_genshi(template, info, format, fragment,
+                                          mapping)
+    # the same error handling as genshi.output.encode
+    if isinstance(serializer, genshi.output.TextSerializer):
+        errors = 'strict'
+    else:
+        errors = 'xmlcharrefreplace'
+    return encode_chunks(serializer(stream),
+        config.get("genshi.encoding", "utf-8"), errors)
+
+streamers['genshi'] = stream_genshi
+
 def default_json(obj):
     if hasattr(obj, '__json__'):
         return obj.__json__()
@@ -160,9 +216,7 @@ def render_json(template=None, info=None, format=None, fragment=False, mapping=N
 
 engines['json'] = render_json
 
-def render_kid(template=None, info=None, format=None, fragment=False, mapping=None):
-    """We need kid support in order to get some of the tests working
-    """
+def load_kid(template, format=None):
     global kid
     if kid is None:
         import kid
@@ -175,12 +229,20 @@ def render_kid(template=None, info=None, format=None, fragment=False, mapping=No
     else:
         template = '%s.%s' % (template, extension)
 
-    template = kid.Template(file=template, fragment=fragment, **info)
+    # Kid keeps the compiled template module in sys.modules
+    return kid.load_template(template)
+
+loaders['kid'] = load_kid
+
+def render_kid(template=None, info=None, format=None, fragment=False, mapping=None):
+    """We need kid support in order to get some of the tests working
+    """
+    template = load_kid(template, format).Template(fragment=fragment, **info)
     return template.serialize()
 
 engines['kid'] = render_kid
 
-def render_mako(template=None, info=None, format=None, fragment=False, mapping=None):
+def load_mako(template, format=None):
     global mako, mako_lookup
     if mako is None:
         import mako
@@ -195,7 +257,12 @@ def render_mako(template=None, info=None, format=None, fragment=False, mapping=N
     else:
         template = '%s.%s' % (template, extension)
     
-    templ = mako_lookup.get_template(template)
+    return mako_lookup.get_template(template)
+
+loaders['mako'] = load_mako
+
+def render_mako(template=None, info=None, format=None, fragment=False, mapping=None):
+    templ = load_mako(template, format)
     try:
         ret = templ.render(**info)
     except Exception:
@@ -204,6 +271,39 @@ def render_mako(template=None, info=None, format=None, fragment=False, mapping=N
 
 engines['mako'] = render_mako
 
+def encode_chunks(chunks, encoding, errors='strict', size=None):
+    """Encode the text chunks of a template, joining small ones.
+
+    Template engines produce many tiny chunks, which are collected until
+    there are at least size characters (tg.stream_buffer_size).
+
+    """
+    if size is None:
+        size = config.get("tg.stream_buffer_size", 8192)
+    buffer, length = [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield u''.join(buffer).encode(encoding, errors)
+            buffer, length = [], 0
+    if buffer:
+        yield u''.join(buffer).encode(encoding, errors)
+
+def _start_stream(chunks):
+    """Render the first chunk right away.
+
+    Errors in finding, loading or starting the template are raised before
+    the response headers are sent and can be handled as usual.
+
+    """
+    chunks = iter(chunks)
+    try:
+        first = chunks.next()
+    except StopIteration:
+        return iter([])
+    return itertools.chain([first], chunks)
+
 def _choose_engine(template):
     if isinstance(template, basestring):
         colon = template.find(":")
@@ -223,8 +323,63 @@ def _choose_engine(template):
             "Template engine %s is not installed" % enginename
     return engine, template, enginename
 
+def _choose_format(template, format):
+    """Return engine, template, engine name and the format to render."""
+    engine, template, enginename = _choose_engine(template)
+    if format:
+        if format == 'plain':
+            if enginename == 'genshi':
+                format = 'text'
+        elif format == 'text':
+            if enginename == 'kid':
+                format = 'plain'
+    else:
+        format = enginename == 'json' and 'json' or config.get(
+            "%s.outputformat" % enginename,
+            config.get("%s.default_format" % enginename, 'html'))
+    return engine, template, enginename, format
+
+def content_type_for(format, enginename, content_type=None):
+    """Return the Content-Type header for the output of an engine.
+
+    We simply derive the content type from the format here
+    and use the charset specified in the configuration setting.
+    This could be improved by also examining the engine and the output.
+
+    """
+    if not content_type:
+        if format:
+            content_format = format
+            if isinstance(content_format, (tuple, list)):
+                content_format = content_format[0]
+            if isinstance(content_format, str):
+                content_format = content_format.split(
+                    )[0].split('-' , 1)[0].lower()
+            else:
+                content_format = 'html'
+        else:
+            content_format = 'html'
+        content_type = get_mime_type_for_format(content_format)
+    if mime_type_has_charset(
+            content_type) and '; charset=' not in content_type:
+        charset = get_template_encoding_default(enginename)
+        if charset:
+            content_type += '; charset=' + charset
+    return content_type
+
+def resolve(template=None, format=None, content_type=None):
+    """Choose the engine and the Content-Type for rendering a template.
+
+    Returns the engine, template, engine name, format and Content-Type,
+    which can be passed to render() as resolved.
+
+    """
+    engine, template, enginename, format = _choose_format(template, format)
+    return (engine, template, enginename, format,
+        content_type_for(format, enginename, content_type))
+
 def render(info, template=None, format=None, headers=None, mapping=None, 
-           fragment=False):
+           fragment=False, stream=False, resolved=None):
     """Renders data in the desired format.
 
     @param info: the data itself
@@ -242,6 +397,14 @@ def render(info, template=None, format=None, headers=None, mapping=None,
 
     @param template: name of the template to use
     @type template: string
+
+    @param stream: return an iterator of encoded chunks instead of a
+                   string if the template engine supports it
+    @type stream: bool
+
+    @param resolved: the result of resolve() for the template, the format
+                     and the content type in headers, if known already
+    @type resolved: tuple
     """
     
     # What's this stuff for? Just for testing?
@@ -249,46 +412,112 @@ def render(info, template=None, format=None, headers=None, mapping=None,
     if environ.get('paste.testing', False):
         cherrypy.request.wsgi_environ['paste.testing_variables']['raw'] = info
 
-    template = format == 'json' and 'json' or info.pop("tg_template", template)
-    engine, template, enginename = _choose_engine(template)
-    if format:
-        if format == 'plain':
-            if enginename == 'genshi':
-                format = 'text'
-        elif format == 'text':
-            if enginename == 'kid':
-                format = 'plain'
-    else:
-        format = enginename == 'json' and 'json' or config.get(
-            "%s.outputformat" % enginename,
-            config.get("%s.default_format" % enginename, 'html'))
+    if format == 'json':
+        template = 'json'
+    elif "tg_template" in info:
+        # the controller has chosen another template
+        template = info.pop("tg_template")
+        resolved = None
+    if resolved is None:
+        resolved = resolve(template, format,
+            isinstance(headers, dict) and headers.get('Content-Type') or None)
+    engine, template, enginename, format, content_type = resolved
 
     if isinstance(headers, dict):
         # Determine the proper content type and charset for the response.
-        # We simply derive the content type from the format here
-        # and use the charset specified in the configuration setting.
-        # This could be improved by also examining the engine and the output.
-        content_type = headers.get('Content-Type')
-        if not content_type:
-            if format:
-                content_format = format
-                if isinstance(content_format, (tuple, list)):
-                    content_format = content_format[0]
-                if isinstance(content_format, str):
-                    content_format = content_format.split(
-                        )[0].split('-' , 1)[0].lower()
-                else:
-                    content_format = 'html'
-            else:
-                content_format = 'html'
-            content_type = get_mime_type_for_format(content_format)
-        if mime_type_has_charset(
-                content_type) and '; charset=' not in content_type:
-            charset = get_template_encoding_default(enginename)
-            if charset:
-                content_type += '; charset=' + charset
         headers['Content-Type'] = content_type
     
     mapping = mapping or dict()
+    if stream and enginename in streamers:
+        return _start_stream(streamers[enginename](info=info, format=format,
+            fragment=fragment, template=template, mapping=mapping))
     return engine(info=info, format=format, fragment=fragment, 
                   template=template, mapping=mapping)
+
+def exposed_templates(root):
+    """Return the (template, format) pairs exposed by a controller tree.
+
+    Sub-controllers are found in the attributes of the controller classes
+    and instances, which are read directly, so that no attribute access
+    hooks like those of SecureResource are triggered.
+
+    """
+    from gearshift.controllers import Controller
+    templates = set()
+    seen = set()
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        namespace = dict()
+        for cls in reversed(type(obj).__mro__):
+            namespace.update(cls.__dict__)
+        try:
+            namespace.update(object.__getattribute__(obj, '__dict__'))
+        except AttributeError:
+            pass
+        for name, value in namespace.iteritems():
+            if isinstance(value, Controller):
+                stack.append(value)
+            elif isinstance(value, types.FunctionType):
+                exposes = getattr(value, '_cp_config', {}).get(
+                    'tools.expose.exposes', {})
+                for expose in exposes.itervalues():
+                    template = expose.get('template')
+                    if not template or template == 'json':
+                        continue
+                    if template.startswith('.'):
+                        module = value.__module__
+                        template = module[:module.rfind('.')] + template
+                    templates.add((template, expose.get('format')))
+    return templates
+
+def precompile_templates(roots=None):
+    """Load and compile the templates exposed by the mounted applications.
+
+    This is done on startup, so that the first requests need not compile
+    them. The time needed for each template is logged, and the Genshi
+    template cache is enlarged to hold all templates unless its size has
+    been configured with genshi.max_cache_size.
+
+    Returns the number of exposed templates per template engine.
+
+    """
+    if roots is None:
+        roots = [app.root for app in cherrypy.tree.apps.itervalues()
+            if app.root is not None]
+    templates = set()
+    for root in roots:
+        templates |= exposed_templates(root)
+    compile = []
+    counts = dict()
+    for template, format in sorted(templates):
+        try:
+            engine, name, enginename, format = _choose_format(
+                template, format)
+        except KeyError, e:
+            log.error("Cannot precompile template %s: %s", template, e)
+            continue
+        if enginename in loaders:
+            compile.append((enginename, name, format, template))
+            counts[enginename] = counts.get(enginename, 0) + 1
+    if counts.get('genshi'):
+        if genshi is None:
+            _init_genshi()
+        # leave room for included templates as well
+        capacity = counts['genshi'] + 25
+        if (config.get("genshi.max_cache_size", None) is None
+                and genshi_loader._cache.capacity < capacity):
+            genshi_loader._cache.capacity = capacity
+    for enginename, name, format, template in compile:
+        start = time.time()
+        try:
+            loaders[enginename](name, format)
+        except Exception:
+            log.exception("Error precompiling template %s", template)
+            continue
+        log.info("Precompiled %s template %s in %.1f ms", enginename,
+            template, (time.time() - start) * 1000)
+    return counts
@@ -7,10 +7,109 @@ from gearshift import util as tg_util
 from gearshift import config
 from gearshift import view
 
-from gearshift.tools.expose.render import render
+from gearshift.tools.expose.render import render, resolve
 
 log = logging.getLogger("gearshift.expose")
 
+
+class ExposeTable(object):
+    """The expose options of a controller method, resolved per request kind.
+
+    Which expose decorator applies, the template engine and the content type
+    only depend on tg_format, the Accept header and the config. They are
+    worked out once for every combination seen and then looked up. The
+    table is cleared when the config is updated or when it grows beyond
+    size entries, since clients can send arbitrary Accept headers.
+
+    """
+
+    size = 100
+
+    def __init__(self, exposes, module=None):
+        self.exposes = exposes
+        self.module = module
+        self._resolved = dict()
+        self._generation = None
+
+    def resolve(self, tg_format, accept_header, get):
+        """Return the render options and the resolved template.
+
+        The config of the request is accessed with get.
+
+        """
+        key = (tg_format, accept_header, get('tools.expose.format', None),
+            get('tools.expose.template', None),
+            get('tools.expose.allow_json', False),
+            get('tools.expose.stream', False), get('tg.content_type', None))
+        resolved = self._resolved
+        if self._generation != config.generation:
+            resolved = self._resolved = dict()
+            self._generation = config.generation
+        try:
+            return resolved[key]
+        except KeyError:
+            if len(resolved) >= self.size:
+                resolved = self._resolved = dict()
+            options = resolved[key] = self._resolve(tg_format, accept_header,
+                                                   get)
+            return options
+
+    def _resolve(self, tg_format, accept_header, get):
+        exposes = self.exposes
+        accept = tg_util.simplify_http_accept_header(accept_header.lower())
+
+        # Select the correct expose to use. First we trust tg_format, then 
+        # accept headers, then fallback to default 
+        for key in [tg_format, accept, 'default']:
+            if exposes.has_key(key):
+                expose = exposes[key]
+                break
+        else:
+            expose = dict()
+                
+        # Unpack parameters that were supplied to @expose
+        format = expose.get('format', get('tools.expose.format', None))
+        template = expose.get('template', get('tools.expose.template', None))
+        allow_json = expose.get('allow_json', get('tools.expose.allow_json', False))
+        mapping = expose.get('mapping')
+        fragment = expose.get('fragment')
+        stream = expose.get('stream', get('tools.expose.stream', False))
+        
+        if format == "json" or (format is None and template is None):
+            template = "json"
+        
+        if allow_json and (tg_format == "json" or
+            accept in ("application/json", "text/javascript")):
+            template = "json"
+                
+        if not template:
+            template = format
+
+        content_type = expose.get('content_type',
+                                  get("tg.content_type", None))
+
+        if template and template.startswith(".") and self.module:
+            template = self.module[:self.module.rfind('.')] + template
+
+        return (template, format, mapping, fragment, stream, content_type,
+            resolve(format == 'json' and 'json' or template, format,
+                content_type))
+
+# for methods exposed by the config only
+_default_exposes = dict(default={})
+# their tables, by the id of their exposes
+_config_tables = dict()
+
+
+def _config_table(get):
+    """Return the table of a method exposed by the config only."""
+    exposes = get('tools.expose.exposes', _default_exposes)
+    table = _config_tables.get(id(exposes))
+    if table is None or table.exposes is not exposes:
+        table = _config_tables[id(exposes)] = ExposeTable(exposes)
+    return table
+
+
 class ExposeTool(cherrypy.Tool):
     """A TurboGears compatible expose tool for CherryPy
     
@@ -71,6 +170,13 @@ class ExposeTool(cherrypy.Tool):
             this expose.
     @keyparam accept_format which value of an Accept: header will
             choose this expose.
+    @keyparam stream send the output of the template engine while it is
+            rendered instead of rendering the whole page first (Genshi
+            and Kajiki only). Note that errors in the middle of the
+            template can only abort the response then. The template would
+            be rendered after the database transaction of the request has
+            ended, so the whole page is rendered first if the request runs
+            in a transaction.
     """
 
     def __init__(self):
@@ -105,49 +211,27 @@ class ExposeTool(cherrypy.Tool):
             return output
 
         get = request.config.get
-        exposes = get('tools.expose.exposes', dict(default={}))
-
-        accept = request.headers.get('Accept', "").lower()
-        accept = tg_util.simplify_http_accept_header(accept)
-    
-        tg_format = request.tg_format
-                
-        # Select the correct expose to use. First we trust tg_format, then 
-        # accept headers, then fallback to default 
-        for key in [tg_format, accept, 'default']:
-            if exposes.has_key(key):
-                expose = exposes[key]
-                break
-                
-        # Unpack parameters that were supplied to @expose
-        format = expose.get('format', get('tools.expose.format', None))
-        template = expose.get('template', get('tools.expose.template', None))
-        allow_json = expose.get('allow_json', get('tools.expose.allow_json', False))
-        mapping = expose.get('mapping')
-        fragment = expose.get('fragment')
-        
-        if format == "json" or (format is None and template is None):
-            template = "json"
-        
-        if allow_json and (tg_format == "json" or
-            accept in ("application/json", "text/javascript")):
-            template = "json"
-                
-        if not template:
-            template = format
+        table = get('tools.expose.table')
+        if table is None:
+            table = _config_table(get)
 
-        content_type = expose.get('content_type', 
-                                  config.get("tg.content_type", None))
+        (template, format, mapping, fragment, stream, content_type,
+            resolved) = table.resolve(request.tg_format,
+                                      request.headers.get('Accept', ""), get)
 
-        if template and template.startswith("."):
-            template = func.__module__[:func.__module__.rfind('.')]+template
+        if stream and getattr(request, 'in_transaction', False):
+            # the template may still load data from the database
+            stream = False
 
         output["tg_css"] = tg_util.setlike()
 
         headers = {'Content-Type': content_type}        
 
         output = render(output, template=template, format=format,
-                        mapping=mapping, headers=headers, fragment=fragment)
+                        mapping=mapping, headers=headers, fragment=fragment,
+                        stream=stream, resolved=resolved)
+        if not isinstance(output, basestring):
+            response.stream = True
 
         content_type = headers['Content-Type']
         if content_type:
@@ -191,6 +275,8 @@ class ExposeTool(cherrypy.Tool):
             
             if not func._cp_config.has_key(subspace + 'exposes'):
                 func._cp_config[subspace + 'exposes'] = {}
+                func._cp_config[subspace + 'table'] = ExposeTable(
+                    func._cp_config[subspace + 'exposes'], func.__module__)
             
             # Make a dictionary of exposes for this function indexed on 
             # accept_format and as_format
@@ -209,4 +295,4 @@ class ExposeTool(cherrypy.Tool):
             return func
         return tool_decorator
 
-__all__ = ["ExposeTool"]
+__all__ = ["ExposeTool", "ExposeTable"]
@@ -29,10 +29,16 @@ class IdentityTool(cherrypy.Tool):
                     "Visit tracking must be enabled (tools.visit.on)")
 
         log.info("Identity starting")
+        # The provider is shared by all requests and by non-request code
+        provider = identity.start_default_provider()
         # Temporary until tg-admin can call create_extension_model
-        visitor.create_extension_model()
+        visitor.create_extension_model(provider)
         # Register the plugin for the Visit Tracking framework
-        visit.enable_visit_plugin(visitor.IdentityVisitPlugin())
+        visit.enable_visit_plugin(visitor.IdentityVisitPlugin(provider))
+
+    def shutdown_extension(self):
+        # A restarted application creates the provider from its new config
+        identity.set_default_provider(None)
 
     def before_handler(self, *args, **kwargs):
         predicates = []
@@ -51,7 +57,7 @@ class IdentityTool(cherrypy.Tool):
         # Check them all for identity failures
         for predicate in predicates:
             errors = []
-            if not predicate.eval_with_object(identity.current, errors):
+            if not identity.check_predicate(predicate, errors):
                 raise identity.IdentityFailure(errors)
         request.tg_predicates = []
 
@@ -62,6 +68,9 @@ class IdentityTool(cherrypy.Tool):
                             "arguments." % self._name)
 
         kwargs['require'] = require
+        # Compile the predicate once instead of on every request
+        if require is not None:
+            identity.compile_predicate(require)
                 
         def tool_decorator(func):
             if not hasattr(func, "_cp_config"):
@@ -0,0 +1,393 @@
+"""A cache of rendered pages.
+
+Pages that look the same for many users, like the public pages of a
+catalogue, can be served from the page cache without running the
+controller and the template engine again:
+
+    @expose("myapp.templates.products")
+    @pagecache(ttl=300, params=['page'], tags=['products'])
+    def products(self, page=1):
+        ...
+
+A page is cached under its path, the given query parameters (all of them
+if params is not set), the output format, the negotiated Accept header,
+the locale and, unless vary_identity is False, the name of the logged in
+user. Only successful GET and HEAD requests are cached, and only if the
+response does not set any cookies. Cached pages are sent with an ETag and
+a Last-Modified header, so that conditional requests are answered with
+304 Not Modified. They vary on Accept and Accept-Language and, unless
+vary_identity is False, are marked private, so that shared caches don't
+serve them to other clients.
+
+When the data shown on a page changes, call pagecache.invalidate_tags()
+with one of the tags of the page. The tags may also be given as a function
+returning the tags for the arguments of the controller method. The store
+is configured like this:
+
+    # "memory" (default) for an LRU cache per process,
+    # "file" for a cache shared by the processes on a host
+    # or the dotted path of a custom store class
+    tools.pagecache.store = "memory"
+    tools.pagecache.size = 1000
+    tools.pagecache.path = "/var/cache/myapp/pages"
+    # no page is kept longer than this, whatever its ttl
+    tools.pagecache.max_ttl = 3600
+
+"""
+
+import cgi
+import cPickle as pickle
+import logging
+import os
+import tempfile
+import threading
+import time
+from email.utils import formatdate, mktime_tz, parsedate_tz
+try:
+    from hashlib import md5, sha1
+except ImportError:
+    from md5 import md5
+    from sha import sha as sha1
+
+import cherrypy
+from cherrypy import request, response
+
+from gearshift import config, identity
+from gearshift.i18n import get_locale
+from gearshift.util import load_class, simplify_http_accept_header, \
+    LRUCache
+
+log = logging.getLogger("gearshift.pagecache")
+
+# headers that belong to a single response
+_uncached_headers = frozenset(['content-length', 'date', 'server',
+    'set-cookie'])
+
+# request headers that are part of the key of a cached page
+_vary_headers = ('Accept', 'Accept-Language')
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def create_page_store():
+    """Create the page store specified in the config file."""
+    get = config.get
+    ttl = get("tools.pagecache.max_ttl", 3600)
+    store = get("tools.pagecache.store", "memory")
+    if store == "memory":
+        return MemoryPageStore(get("tools.pagecache.size", 1000), ttl)
+    if store == "file":
+        return FilePageStore(get("tools.pagecache.path", "page-cache"), ttl,
+            get("tools.pagecache.size", 1000))
+    store_class = load_class(store)
+    if store_class is None:
+        raise config.ConfigError("Page store missing: %s" % store)
+    return store_class(ttl)
+
+
+def get_page_store():
+    """Return the page store, creating it on first use."""
+    global _store
+    if _store is None:
+        _store_lock.acquire()
+        try:
+            if _store is None:
+                _store = create_page_store()
+        finally:
+            _store_lock.release()
+    return _store
+
+
+def set_page_store(store):
+    """Replace the page store, e.g. after the config has changed."""
+    global _store
+    _store = store
+
+
+def invalidate_tags(*tags):
+    """Remove the cached pages with any of the given tags."""
+    if tags:
+        get_page_store().invalidate_tags(tags)
+
+
+class MemoryPageStore(LRUCache):
+    """An LRU cache of pages in the memory of this process.
+
+    Entries are tuples (headers, body, etag, modified, tags, ttl).
+
+    """
+
+    def __init__(self, size=1000, ttl=3600):
+        super(MemoryPageStore, self).__init__(size, ttl)
+        # the time at which the pages with a tag have been invalidated
+        self._invalidated = dict()
+
+    def _is_fresh(self, entry, stored):
+        if time.time() - stored > min(entry[5], self.ttl):
+            return False
+        invalidated = self._invalidated.get
+        for tag in entry[4]:
+            if invalidated(tag, 0) >= stored:
+                return False
+        return True
+
+    def invalidate_tags(self, tags):
+        """Remove the cached pages with any of the given tags."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            invalidated = self._invalidated
+            # older invalidations can not affect cached pages any more
+            for tag, stamp in invalidated.items():
+                if now - stamp > self.ttl:
+                    del invalidated[tag]
+            for tag in tags:
+                invalidated[tag] = now
+        finally:
+            self.lock.release()
+
+
+class FilePageStore(object):
+    """A cache of pages in files shared by the processes on a host.
+
+    Every page is stored in its own file, which is replaced atomically.
+    Pages are invalidated by touching a file for the tag; cached pages
+    older than that file are not used. Since every query string can make
+    a new page, the files are swept when size pages have been stored or
+    the ttl has passed since the last sweep: expired pages and tags are
+    removed, and the oldest pages beyond size.
+
+    """
+
+    def __init__(self, path, ttl=3600, size=1000):
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+        self._next_cleanup = time.time() + ttl
+        self._puts = 0
+        for directory in ('pages', 'tags'):
+            directory = os.path.join(path, directory)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def _filename(self, directory, key):
+        return os.path.join(self.path, directory,
+            sha1(unicode(key).encode('utf-8')).hexdigest())
+
+    def _mtime(self, filename):
+        try:
+            return os.stat(filename).st_mtime
+        except OSError:
+            return None
+
+    def get(self, key):
+        """Return the cached page or None."""
+        filename = self._filename('pages', key)
+        stored = self._mtime(filename)
+        if stored is None:
+            return None
+        if time.time() - stored > self.ttl:
+            self.remove(key)
+            return None
+        try:
+            f = open(filename, 'rb')
+            try:
+                entry = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if time.time() - stored > entry[5]:
+            return None
+        for tag in entry[4]:
+            invalidated = self._mtime(self._filename('tags', tag))
+            if invalidated is not None and invalidated >= stored:
+                return None
+        return entry
+
+    def put(self, key, entry):
+        """Store the page."""
+        self._puts += 1
+        if self._puts >= self.size or time.time() >= self._next_cleanup:
+            self.cleanup()
+        fd, tmpname = tempfile.mkstemp(dir=self.path)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(entry, f, 2)
+            finally:
+                f.close()
+            os.rename(tmpname, self._filename('pages', key))
+        except (IOError, OSError), e:
+            log.warning("Could not cache page: %s", e)
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
+
+    def remove(self, key):
+        """Remove the cached page."""
+        self._remove_file(self._filename('pages', key))
+
+    def invalidate_tags(self, tags):
+        """Remove the cached pages with any of the given tags."""
+        for tag in tags:
+            filename = self._filename('tags', tag)
+            open(filename, 'w').close()
+            os.utime(filename, None)
+
+    def _remove_file(self, filename):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+    def cleanup(self):
+        """Remove expired pages and tags and the oldest pages beyond size.
+
+        Invalidated tags can only affect pages stored within the ttl.
+
+        """
+        now = time.time()
+        self._next_cleanup = now + self.ttl
+        self._puts = 0
+        for directory in ('pages', 'tags'):
+            directory = os.path.join(self.path, directory)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            files = []
+            for name in names:
+                filename = os.path.join(directory, name)
+                stored = self._mtime(filename)
+                if stored is None:
+                    continue
+                if now - stored > self.ttl:
+                    self._remove_file(filename)
+                else:
+                    files.append((stored, filename))
+            if directory.endswith('pages') and len(files) > self.size:
+                files.sort()
+                for stored, filename in files[:len(files) - self.size]:
+                    self._remove_file(filename)
+
+
+def not_modified(etag, modified):
+    """Check whether the conditional request matches the cached page."""
+    match = request.headers.get('If-None-Match')
+    if match:
+        match = [tag.strip() for tag in match.split(',')]
+        return '*' in match or etag in match or 'W/' + etag in match
+    since = request.headers.get('If-Modified-Since')
+    if since:
+        since = parsedate_tz(since)
+        return since is not None and int(modified) <= mktime_tz(since)
+    return False
+
+
+class PageCacheTool(cherrypy.Tool):
+    """A tool caching the rendered output of controller methods."""
+
+    def __init__(self):
+        log.debug("Page Cache Tool initialized")
+
+        # Raise the priority to make it run after identity (30), so that
+        # access is still checked, and to wrap the rendering by expose (50)
+        return super(PageCacheTool, self).__init__(point="before_handler",
+                                                   callable=self.before_handler,
+                                                   priority=60)
+
+    def cache_key(self, params=None, vary_identity=True):
+        """Return the key of the current request in the page store."""
+        query = cgi.parse_qsl(request.query_string, keep_blank_values=True)
+        if params is not None:
+            query = [(name, value) for name, value in query if name in params]
+        query.sort()
+        accept = simplify_http_accept_header(
+            request.headers.get('Accept', '').lower())
+        user_name = None
+        if vary_identity:
+            try:
+                if not identity.current.anonymous:
+                    user_name = identity.current.user_name
+            except identity.IdentityException:
+                pass
+        key = (request.script_name + request.path_info, query,
+            getattr(request, 'tg_format', None), accept, get_locale(),
+            user_name)
+        return sha1(repr(key)).hexdigest()
+
+    def before_handler(self, ttl=60, params=None, vary_identity=True,
+            tags=()):
+        if request.handler is None or request.method not in ('GET', 'HEAD'):
+            return
+        if request.cookie.has_key('tg_flash'):
+            # the page will show a flash message
+            return
+
+        key = self.cache_key(params, vary_identity)
+        entry = get_page_store().get(key)
+        if entry is not None:
+            self.serve(entry, vary_identity)
+            request.handler = None
+            return
+
+        # Replace request.handler with self
+        oldhandler = request.handler
+
+        def wrap(*args, **kwargs):
+            return self.handler(oldhandler, key, ttl, tags, vary_identity,
+                *args, **kwargs)
+
+        request.handler = wrap
+
+    def handler(self, oldhandler, key, ttl, tags, vary_identity,
+            *args, **kwargs):
+        cookies = set(response.cookie.keys())
+        output = oldhandler(*args, **kwargs)
+
+        if (not isinstance(output, basestring)
+                or not str(response.status or 200).startswith('200')
+                or set(response.cookie.keys()) != cookies):
+            return output
+
+        if isinstance(output, unicode):
+            output = output.encode(response.headers.get('Content-Type',
+                '').partition('charset=')[2].strip() or 'utf-8')
+        if callable(tags):
+            tags = tags(*args, **kwargs)
+        headers = [(name, value) for name, value in response.headers.items()
+            if name.lower() not in _uncached_headers]
+        entry = (headers, output, '"%s"' % md5(output).hexdigest(),
+            int(time.time()), tuple(tags), ttl)
+        get_page_store().put(key, entry)
+        return self.serve(entry, vary_identity)
+
+    def serve(self, entry, vary_identity=True):
+        """Send the cached page or 304 Not Modified."""
+        headers, body, etag, modified = entry[:4]
+        for name, value in headers:
+            response.headers[name] = value
+        # the page depends on these like its key in the page store
+        vary = [name.strip() for name in response.headers.get('Vary',
+            '').split(',') if name.strip()]
+        for name in _vary_headers:
+            if name.lower() not in [other.lower() for other in vary]:
+                vary.append(name)
+        response.headers['Vary'] = ', '.join(vary)
+        if vary_identity:
+            response.headers['Cache-Control'] = 'private'
+        response.headers['ETag'] = etag
+        response.headers['Last-Modified'] = formatdate(modified, usegmt=True)
+        if not_modified(etag, modified):
+            response.status = 304
+            body = ''
+            response.headers.pop('Content-Type', None)
+        response.body = body
+        return body
+
+__all__ = ["PageCacheTool", "MemoryPageStore", "FilePageStore",
+    "create_page_store", "get_page_store", "set_page_store",
+    "invalidate_tags"]
@@ -8,6 +8,9 @@ import warnings
 import htmlentitydefs
 import socket
 import struct
+import threading
+import time
+from bisect import bisect_right
 from inspect import getargspec, getargvalues
 from itertools import izip, islice, chain, imap
 from operator import isSequenceType
@@ -87,6 +90,83 @@ class Bunch(dict):
             raise AttributeError(name)
 
 
+class LazyBunch(Bunch):
+    """A Bunch with values that are computed when first accessed.
+
+    Lazy values are set as functions without arguments, which are called
+    on the first lookup of the name; the result replaces the function.
+    Looking at all keys or values computes all lazy values.
+
+    """
+
+    def __init__(self, *args, **kw):
+        super(LazyBunch, self).__init__(*args, **kw)
+        object.__setattr__(self, '_lazy', dict())
+
+    def set_lazy(self, *args, **kw):
+        """Set lazy values, with the same arguments as dict.update."""
+        lazy = dict(*args, **kw)
+        for name in lazy:
+            dict.pop(self, name, None)
+        self._lazy.update(lazy)
+
+    def __missing__(self, name):
+        value = self._lazy.pop(name)()
+        dict.__setitem__(self, name, value)
+        return value
+
+    def __setitem__(self, name, value):
+        self._lazy.pop(name, None)
+        dict.__setitem__(self, name, value)
+
+    __setattr__ = __setitem__
+
+    def __delitem__(self, name):
+        if self._lazy.pop(name, None) is None:
+            dict.__delitem__(self, name)
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self._lazy
+
+    has_key = __contains__
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def _evaluate(self):
+        for name in self._lazy.keys():
+            self[name]
+
+    def keys(self):
+        self._evaluate()
+        return dict.keys(self)
+
+    def values(self):
+        self._evaluate()
+        return dict.values(self)
+
+    def items(self):
+        self._evaluate()
+        return dict.items(self)
+
+    def iteritems(self):
+        self._evaluate()
+        return dict.iteritems(self)
+
+    def __iter__(self):
+        self._evaluate()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._lazy)
+
+    def copy(self):
+        self._evaluate()
+        return Bunch(self)
+
+
 class DictObj(Bunch):
 
     @deprecated("Use Bunch instead of DictObj and DictWrapper.")
@@ -765,7 +845,178 @@ def match_ip(cidr, ip):
     return ip == cidr
 
 
-__all__ = ["Bunch", "DictObj", "DictWrapper", "Enum", "setlike",
+class LRUCache(object):
+    """A bounded, thread-safe LRU cache with a time to live.
+
+    An entry is only used while it is not older than ttl seconds, so that
+    changes made by other processes are noticed eventually; subclasses can
+    refine this in _is_fresh(). If more than size entries are cached, the
+    least recently used ones are dropped.
+
+    """
+
+    def __init__(self, size=10000, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Maps keys to links of a circular doubly linked list ordered
+        # by recency of use. A link is [prev, next, key, value, stored].
+        self._links = dict()
+        root = []
+        root[:] = [root, root, None, None, None]
+        self._root = root
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+
+    def get(self, key):
+        """Return the cached value or None.
+
+        None is also returned if the entry is no longer fresh.
+
+        """
+        self.lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is None:
+                return None
+            value, stored = link[3], link[4]
+            if not self._is_fresh(value, stored):
+                self._unlink(link)
+                del self._links[key]
+                return None
+            self._unlink(link)
+            self._append(link)
+            return value
+        finally:
+            self.lock.release()
+
+    def _is_fresh(self, value, stored):
+        """Check whether a cached entry may still be used."""
+        return time.time() - stored <= self.ttl
+
+    def put(self, key, value):
+        """Store the value under the key."""
+        if self.size <= 0:
+            return
+        self.lock.acquire()
+        try:
+            link = self._links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+            link = [None, None, key, value, time.time()]
+            self._append(link)
+            self._links[key] = link
+            while len(self._links) > self.size:
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._links[oldest[2]]
+        finally:
+            self.lock.release()
+
+    def update(self, key, value):
+        """Update the value of a cached entry.
+
+        This does not renew the age of the entry, so that it will still be
+        verified against the storage every ttl seconds.
+
+        """
+        # No need to lock here: the lookup and the item assignment are
+        # atomic, and updating a link that was just evicted does no harm.
+        link = self._links.get(key)
+        if link is not None:
+            link[3] = value
+
+    def remove(self, key):
+        """Remove the entry from the cache."""
+        self.lock.acquire()
+        try:
+            link = self._links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        self.lock.acquire()
+        try:
+            self._links.clear()
+            root = self._root
+            root[:] = [root, root, None, None, None]
+        finally:
+            self.lock.release()
+
+
+class IPRangeSet(object):
+    """A set of IP address blocks for fast membership tests.
+
+    The blocks are given in the CIDR notation understood by match_ip(), with
+    IPv4 addresses mapped to IPv6. They are parsed once into a sorted list of
+    non-overlapping integer ranges, so that checking an address takes a
+    single binary search even for thousands of blocks.
+
+    """
+
+    def __init__(self, cidrs=()):
+        ranges = []
+        for cidr in cidrs:
+            if '/' in cidr:
+                cidr, prefix = cidr.split('/', 1)
+                masked = (':' in cidr and 128 or 32) - int(prefix)
+            else:
+                masked = 0
+            start = _inet_prefix(inet_aton(cidr.strip()), masked) << masked
+            ranges.append((start, start | ((1 << masked) - 1)))
+        ranges.sort()
+        self.starts, self.ends = starts, ends = [], []
+        for start, end in ranges:
+            if ends and start <= ends[-1] + 1:
+                if end > ends[-1]:
+                    ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+
+    @classmethod
+    def from_file(cls, path):
+        """Read the address blocks from a file, one per line.
+
+        Empty lines and comments starting with '#' are ignored.
+
+        """
+        f = open(path)
+        try:
+            return cls(filter(None, [line.split('#', 1)[0].strip()
+                for line in f]))
+        finally:
+            f.close()
+
+    def __contains__(self, ip):
+        ip = _inet_prefix(inet_aton(ip), 0)
+        i = bisect_right(self.starts, ip) - 1
+        return i >= 0 and ip <= self.ends[i]
+
+    def __len__(self):
+        """Return the number of non-overlapping address ranges."""
+        return len(self.starts)
+
+
+__all__ = ["Bunch", "LazyBunch", "LRUCache", "DictObj", "DictWrapper", "Enum", "setlike",
            "get_package_name", "get_model", "load_project_config",
            "ensure_sequence", "has_arg", "to_kw", "from_kw", "adapt_call",
            "call_on_stack", "remove_keys", "arg_index",
@@ -776,4 +1027,4 @@ __all__ = ["Bunch", "DictObj", "DictWrapper", "Enum", "setlike",
            "to_unicode", "to_utf8", "quote_cookie", "unquote_cookie",
            "get_template_encoding_default", "get_mime_type_for_format",
            "mime_type_has_charset", "find_precision", "copy_if_mutable",
-           "match_ip", "deprecated"]
+           "match_ip", "IPRangeSet", "deprecated"]
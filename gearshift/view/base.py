@@ -13,13 +13,15 @@ import gearshift
 from gearshift import identity, config
 from gearshift.i18n import get_locale
 from gearshift.util import (
-    Bunch, get_template_encoding_default,
+    Bunch, LazyBunch, get_template_encoding_default,
     get_mime_type_for_format, mime_type_has_charset)
 
 log = logging.getLogger("gearshift.view")
 
 variable_providers = []
 root_variable_providers = []
+# functions computing template variables when they are first used
+lazy_variables = dict()
 
 class cycle:
     """Loops forever over an iterator.
@@ -83,6 +85,31 @@ def ipeek(iterable):
     except StopIteration:
         return None
 
+_constant_vars = None
+
+def _create_constant_vars():
+    """Return the template variables that are the same for every request."""
+    webpath = '' ## FIXME: gearshift.startup.webpath or 
+    return dict(
+        checker = checker,
+        config = config.get,
+        cycle = cycle,
+        ipeek = ipeek,
+        quote_plus = quote_plus,
+        selector = selector,
+        tg_js = '/' + webpath + 'tg_js',
+        tg_static = '/' + webpath + 'tg_static',
+        tg_toolbox = '/' + webpath + 'tg_toolbox',
+        tg_version = gearshift.__version__,
+        url = gearshift.url,
+        widgets = '/' + webpath + 'tg_widgets',
+    )
+
+def _get_session():
+    if config.get('tools.sessions.on', None):
+        return cherrypy.session
+    return None
+
 def stdvars():
     """Create a Bunch of variables that should be available in all templates.
 
@@ -129,34 +156,23 @@ def stdvars():
     that can add more variables to this list. The callable will be called with
     the vars Bunch after these standard variables have been set up.
 
-    """
+    The locale and the session are only looked up when a template uses them.
+    Variables that are expensive to compute can be added the same way by
+    putting a function without arguments into gearshift.view.lazy_variables
+    or by calling vars.set_lazy(name=function) in a variable provider.
 
-    if config.get('tools.sessions.on', None):
-        session = cherrypy.session
-    else:
-        session = None
+    """
+    global _constant_vars
+    if _constant_vars is None:
+        _constant_vars = _create_constant_vars()
 
-    webpath = '' ## FIXME: gearshift.startup.webpath or 
-    tg_vars = Bunch(
-        checker = checker,
-        config = config.get,
-        cycle = cycle,
+    tg_vars = LazyBunch(_constant_vars,
         errors = getattr(cherrypy.request, 'validation_errors', {}),
         identity = identity.current,
         inputs = getattr(cherrypy.request, 'input_values', {}),
-        ipeek = ipeek,
-        locale = get_locale(),
-        quote_plus = quote_plus,
         request = cherrypy.request,
-        selector = selector,
-        session = session,
-        tg_js = '/' + webpath + 'tg_js',
-        tg_static = '/' + webpath + 'tg_static',
-        tg_toolbox = '/' + webpath + 'tg_toolbox',
-        tg_version = gearshift.__version__,
-        url = gearshift.url,
-        widgets = '/' + webpath + 'tg_widgets',
     )
+    tg_vars.set_lazy(lazy_variables, locale=get_locale, session=_get_session)
     for provider in variable_providers:
         provider(tg_vars)
     root_vars = dict()
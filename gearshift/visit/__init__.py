@@ -2,3 +2,6 @@ from gearshift.visit.api import current
 from gearshift.visit.api import enable_visit_plugin
 from gearshift.visit.api import shutdown_extension
 from gearshift.visit.api import create_extension_model
+from gearshift.visit.api import invalidate_visit
+from gearshift.visit.api import get_manager_stats
+from gearshift.visit.api import get_plugin_stats
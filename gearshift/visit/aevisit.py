@@ -5,7 +5,7 @@ from google.appengine.ext import db
 
 from gearshift import config
 from gearshift.util import load_class
-from gearshift.visit.api import BaseVisitManager, Visit
+from gearshift.visit.api import BaseVisitManager, Visit, extend_below
 
 log = logging.getLogger("gearshift.visit.aevisit")
 
@@ -23,6 +23,8 @@ class AppEngineVisitManager(object):
         
         self.create_model()
         self.timeout = timeout
+        self.extend_below = extend_below(timeout)
+        self.stats = dict(extend_suppressed=0)
 
     def create_model(self):
         # Nothing to do here
@@ -52,11 +54,22 @@ class AppEngineVisitManager(object):
         # it might be a better approach to set a long expiry (e.g. 14 days) 
         # and not extend it to avoid extending visits on every request
         if config.get("tools.visit.extend_timeout", True):
-            visit.expiry = now+self.timeout
-            visit.put()
+            if visit.expiry - now < self.extend_below:
+                visit.expiry = now+self.timeout
+                visit.put()
+            else:
+                self.stats['extend_suppressed'] += 1
         
         return Visit(visit_key, False)
 
+    def get_stats(self):
+        """Return the current statistics of the visit manager."""
+        return dict(self.stats)
+
+    def cookie_value(self, visit):
+        """Return the value of the visit cookie to be sent or None."""
+        return visit.key
+
 class TG_Visit(db.Model):
 
     created = db.DateTimeProperty(auto_now=True)
@@ -1,10 +1,12 @@
 import logging
+import re
 try:
 	from hashlib import sha1
 except ImportError:
 	from sha import sha as sha1
 import threading
 import time
+from Queue import Queue, Empty, Full
 
 from random import random
 from datetime import timedelta, datetime
@@ -13,7 +15,7 @@ import cherrypy
 from cherrypy import request
 
 from gearshift import config
-from gearshift.util import load_class
+from gearshift.util import load_class, LRUCache
 from gearshift.identity.base import verify_identity_status
 
 log = logging.getLogger("gearshift.visit")
@@ -24,6 +26,9 @@ _manager = None
 # Global list of plugins for the Visit Tracking framework
 _plugins = list()
 
+# Global filter for requests that shall not be tracked
+_request_filter = None
+
 # Accessor functions for getting and setting the current visit information.
 def current():
     """Retrieve the current visit record from the cherrypy request."""
@@ -56,6 +61,9 @@ def shutdown_extension():
     if not _manager:
         return
     log.info("Visit Tracking shutting down")
+    for plugin in _plugins:
+        if isinstance(plugin, AsyncVisitPlugin):
+            plugin.shutdown()
     _manager.shutdown()
     _manager = None
 
@@ -64,14 +72,76 @@ def create_extension_model():
     if _manager:
         _manager.create_model()
 
+def invalidate_visit(visit_key):
+    """Drop any cached information about the visit with the given key.
+
+    This is called on logout, so that the next request will consult the
+    visit storage again.
+
+    """
+    if _manager:
+        _manager.invalidate(visit_key)
+
+def get_manager_stats():
+    """Return a copy of the statistics of the running visit manager."""
+    if not hasattr(_manager, 'get_stats'):
+        return dict()
+    return _manager.get_stats()
+
+def extend_below(timeout):
+    """Return the remaining lifetime below which visits shall be extended.
+
+    This is the fraction tools.visit.extend_below (default 1.0, i.e. always
+    extend) of the visit timeout. With 0.5, a visit is only extended when
+    less than half of the timeout is remaining, which saves most of the
+    expiry writes of active visitors.
+
+    """
+    fraction = float(config.get("tools.visit.extend_below", 1.0))
+    seconds = timeout.days * 86400 + timeout.seconds
+    return timedelta(seconds=seconds * fraction)
+
+def get_plugin_stats():
+    """Return the statistics of all asynchronous visit plugins by name."""
+    return dict((plugin.name, plugin.get_stats())
+        for plugin in _plugins if isinstance(plugin, AsyncVisitPlugin))
+
 def enable_visit_plugin(plugin):
     """Register a visit tracking plugin.
 
-    These plugins will be called for each request.
+    These plugins will be called for each request. Plugins with a true
+    'asynchronous' attribute are called from a pool of worker threads
+    instead, see AsyncVisitPlugin.
 
     """
+    if getattr(plugin, 'asynchronous', False):
+        plugin = AsyncVisitPlugin(plugin)
     _plugins.append(plugin)
 
+def _create_request_filter():
+    """Create the RequestFilter specified in the config file."""
+    get = config.get
+    bots = get("tools.visit.exclude.bots", False)
+    if bots is True:
+        bots = RequestFilter.default_bots
+    request_filter = RequestFilter(
+        paths=get("tools.visit.exclude.paths", ['/favicon.ico']),
+        prefixes=get("tools.visit.exclude.prefixes",
+            ['/tg_static/', '/tg_js/']),
+        patterns=get("tools.visit.exclude.patterns", []),
+        bots=bots or [])
+    if request_filter:
+        return request_filter
+    return None
+
+def request_snapshot():
+    """Return the information about the current request for plugins."""
+    headers = request.headers
+    return dict(time=datetime.now(), method=request.method,
+        path_info=request.path_info, query_string=request.query_string,
+        remote_ip=request.remote.ip, referer=headers.get('Referer'),
+        user_agent=headers.get('User-Agent'))
+
 class Visit(object):
     """Basic container for visit related data."""
 
@@ -79,6 +149,101 @@ class Visit(object):
         self.key = key
         self.is_new = is_new
 
+    def persist(self):
+        """Make sure the visit is stored.
+
+        Visits returned by the visit manager are already stored.
+
+        """
+        pass
+
+
+class LazyVisit(Visit):
+    """A new visit that is only stored when it is actually needed.
+
+    The visit is stored through the visit manager and its cookie is sent
+    when persist() is called, which the identity plugin does when a user
+    logs in. Plugins writing attributes to the visit mark it as dirty, and
+    dirty visits are stored at the end of the request.
+
+    """
+
+    def __init__(self, key, send_cookie):
+        self.__dict__.update(key=key, is_new=True,
+            persisted=False, dirty=False, _send_cookie=send_cookie)
+
+    def __setattr__(self, name, value):
+        self.__dict__['dirty'] = True
+        super(LazyVisit, self).__setattr__(name, value)
+
+    def persist(self):
+        """Store the visit and send the visit cookie."""
+        if self.persisted:
+            return
+        self.__dict__['persisted'] = True
+        visit = _manager.new_visit_with_key(self.key)
+        if visit is None:
+            return
+        log.debug("Stored new visit with key: %s", self.key)
+        cookie_value = _manager.cookie_value(visit)
+        if cookie_value:
+            self._send_cookie(cookie_value)
+
+    def persist_if_dirty(self):
+        """Store the visit if a plugin has written to it."""
+        if self.dirty:
+            self.persist()
+
+class RequestFilter(object):
+    """Decide which requests are not tracked by visit and identity.
+
+    Requests are excluded if their path equals one of the given paths,
+    starts with one of the given prefixes or matches one of the regular
+    expressions in patterns, or if their User-Agent header contains one
+    of the regular expressions in bots (case-insensitive). Requests with
+    an Authorization header are never excluded as bots, since they need
+    their identity.
+
+    """
+
+    # User-Agent patterns of crawlers and monitoring tools
+    default_bots = ['bot\\b', 'crawl', 'spider', 'slurp', 'monitor',
+        'health.?check', 'pingdom', 'nagios']
+
+    def __init__(self, paths=(), prefixes=(), patterns=(), bots=()):
+        self.paths = frozenset(paths)
+        self.prefixes = tuple(prefixes)
+        self.pattern = self._compile(patterns)
+        self.bots = self._compile(bots, re.IGNORECASE)
+
+    def _compile(self, patterns, flags=0):
+        if not patterns:
+            return None
+        return re.compile('|'.join(['(?:%s)' % pattern
+            for pattern in patterns]), flags)
+
+    def __nonzero__(self):
+        return bool(self.paths or self.prefixes or self.pattern or self.bots)
+
+    def excludes(self, path, user_agent=None, authorization=None):
+        """Check whether the request with the given path is excluded."""
+        if path in self.paths:
+            return True
+        if self.prefixes and path.startswith(self.prefixes):
+            return True
+        if self.pattern is not None and self.pattern.match(path):
+            return True
+        if self.bots is not None and user_agent and not authorization:
+            return self.bots.search(user_agent) is not None
+        return False
+
+    def excludes_request(self):
+        """Check whether the current request is excluded."""
+        headers = request.headers
+        return self.excludes(request.path_info, headers.get('User-Agent'),
+            headers.get('Authorization'))
+
+
 class VisitTool(cherrypy.Tool):
     """A tool that automatically tracks visitors."""
 
@@ -98,7 +263,7 @@ class VisitTool(cherrypy.Tool):
         if not config.get("tools.visit.on", False):
             return
         # Bail out if this extension is already running
-        global _manager
+        global _manager, _request_filter
         if _manager:
             return
 
@@ -108,6 +273,7 @@ class VisitTool(cherrypy.Tool):
         timeout = timedelta(minutes=config.get("tools.visit.timeout", 20))
         # Create the thread that manages updating the visits
         _manager = _create_visit_manager(timeout)
+        _request_filter = _create_request_filter()
 
     def before_handler(self, **kw):
         """Check whether submitted request belongs to an existing visit."""
@@ -136,9 +302,20 @@ class VisitTool(cherrypy.Tool):
         # Use max age only if the cookie shall explicitly be permanent
         self.cookie_max_age = get("cookie.permanent",
             False) and int(get("timeout", "20")) * 60 or None
+        # Don't store new visits before they are actually needed
+        lazy = get("lazy", False)
 
         cpreq = cherrypy.request
         visit = current()
+        if (not visit and _request_filter is not None
+                and _request_filter.excludes_request()):
+            # Static files, health checks and bots are not tracked. Plugins
+            # may still set up some cheap defaults, like anonymous identity.
+            log.debug("Not tracking request for: %s", cpreq.path_info)
+            for plugin in _plugins:
+                if hasattr(plugin, 'skip_request'):
+                    plugin.skip_request()
+            return
         if not visit:
             visit_key = None
             for source in source:
@@ -158,11 +335,21 @@ class VisitTool(cherrypy.Tool):
                     break
             if visit:
                 log.debug("Using visit from request with key: %s", visit_key)
+            elif lazy:
+                visit_key = self._generate_key()
+                visit = LazyVisit(visit_key, self.send_cookie)
+                cpreq.hooks.attach('before_finalize', visit.persist_if_dirty)
+                log.debug("Created lazy visit with key: %s", visit_key)
             else:
                 visit_key = self._generate_key()
                 visit = _manager.new_visit_with_key(visit_key)
                 log.debug("Created new visit with key: %s", visit_key)
-            self.send_cookie(visit_key)
+            if visit is not None and not isinstance(visit, LazyVisit):
+                # Some visit managers need not send the cookie on every
+                # request
+                cookie_value = _manager.cookie_value(visit)
+                if cookie_value:
+                    self.send_cookie(cookie_value)
             set_current(visit)
         # Inform all the plugins that a request has been made for the current
         # visit. This gives plugins the opportunity to track click-path or
@@ -218,15 +405,283 @@ class VisitTool(cherrypy.Tool):
             cookies[self.cookie_name].output())
 
 
+class AsyncVisitPlugin(object):
+    """Feed a visit plugin from a pool of worker threads.
+
+    Instead of record_request(visit), the plugin must provide
+    record_requests(records) which is called with batches of (visit,
+    request snapshot) tuples. The request snapshot is the dict returned
+    by request_snapshot(). Plugins should not write to the visit, since
+    the request may have been finished already.
+
+    The plugin may override the following settings with attributes of the
+    same name, the defaults are taken from tools.visit.plugins.*:
+
+    queue_size: the maximum number of pending records (default 10000)
+    batch_size: the maximum number of records per call (default 100)
+    workers: the number of worker threads (default 1)
+    overflow: what to do when the queue is full, 'drop' the record
+        (default) or 'block' the request for up to block_timeout seconds
+        (default 1.0) and drop it only then
+
+    """
+
+    def __init__(self, plugin):
+        get = lambda name, default: getattr(plugin, name,
+            config.get("tools.visit.plugins.%s" % name, default))
+        self.plugin = plugin
+        self.name = getattr(plugin, 'name', plugin.__class__.__name__)
+        self.queue = Queue(int(get('queue_size', 10000)))
+        self.batch_size = int(get('batch_size', 100))
+        self.num_workers = int(get('workers', 1))
+        self.overflow = get('overflow', 'drop')
+        if self.overflow not in ('drop', 'block'):
+            raise config.ConfigError("Unsupported visit plugin overflow"
+                " policy: %s" % self.overflow)
+        self.block_timeout = float(get('block_timeout', 1.0))
+        self.workers = []
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = dict(queued=0, dropped=0, batches=0, records=0,
+            errors=0, last_latency=0.0, max_latency=0.0, total_latency=0.0)
+
+    def record_request(self, visit):
+        """Queue the visit and a snapshot of the current request."""
+        if not self.workers:
+            self.start()
+        record = (visit, request_snapshot())
+        try:
+            if self.overflow == 'block':
+                self.queue.put(record, True, self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except Full:
+            self._count(dropped=1)
+        else:
+            self._count(queued=1)
+
+    def start(self):
+        self._lock.acquire()
+        try:
+            if self.workers:
+                return
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self.run,
+                    name="VisitPlugin-%s-%d" % (self.name, i))
+                worker.setDaemon(True)
+                worker.start()
+                self.workers.append(worker)
+        finally:
+            self._lock.release()
+
+    def shutdown(self, timeout=None):
+        """Stop the worker threads after the pending records are sent."""
+        self._lock.acquire()
+        try:
+            workers, self.workers = self.workers, []
+            for worker in workers:
+                self.queue.put(None)
+            for worker in workers:
+                worker.join(timeout)
+        finally:
+            self._lock.release()
+
+    def _count(self, **counts):
+        self._stats_lock.acquire()
+        try:
+            for name, count in counts.iteritems():
+                self.stats[name] += count
+        finally:
+            self._stats_lock.release()
+
+    def get_stats(self):
+        """Return the current statistics of the plugin.
+
+        Latencies are the seconds spent in record_requests() per batch.
+
+        """
+        self._stats_lock.acquire()
+        try:
+            stats = self.stats.copy()
+        finally:
+            self._stats_lock.release()
+        stats['queue_depth'] = self.queue.qsize()
+        return stats
+
+    def run(self):
+        get, get_nowait = self.queue.get, self.queue.get_nowait
+        while True:
+            record = get()
+            if record is None:
+                return
+            batch = [record]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    record = get_nowait()
+                except Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+            self.dispatch(batch)
+            if stop:
+                return
+
+    def dispatch(self, batch):
+        """Pass a batch of records to the plugin."""
+        start = time.time()
+        try:
+            self.plugin.record_requests(batch)
+        except Exception:
+            log.exception("Error in visit plugin %s", self.name)
+            self._count(errors=1)
+        latency = time.time() - start
+        self._stats_lock.acquire()
+        try:
+            stats = self.stats
+            stats['batches'] += 1
+            stats['records'] += len(batch)
+            stats['last_latency'] = latency
+            stats['total_latency'] += latency
+            if latency > stats['max_latency']:
+                stats['max_latency'] = latency
+        finally:
+            self._stats_lock.release()
+
+
+class VisitCache(LRUCache):
+    """A bounded, thread-safe LRU cache of visit expiry times.
+
+    The cache maps visit keys to their expiry. An entry is only used while
+    its expiry lies in the future and while it is not older than ttl seconds,
+    so that changes made by other processes are noticed eventually. If more
+    than size entries are cached, the least recently used ones are dropped.
+
+    """
+
+    def _is_fresh(self, expiry, stored):
+        return (time.time() - stored <= self.ttl
+            and expiry >= datetime.now(expiry.tzinfo))
+
+
+class VisitUpdateQueue(object):
+    """A bounded, thread-safe queue of pending visit expiry updates.
+
+    The queue is split into stripes, each with its own buffer and lock,
+    so that request threads queueing updates for different visits rarely
+    contend with each other. The flusher swaps the buffer of every stripe
+    for an empty one, holding each stripe lock only for the swap itself.
+
+    Updates are dropped if a later expiry is already queued for the visit
+    (stale updates) or if the queue already holds max_size visits.
+
+    """
+
+    def __init__(self, stripes=16, max_size=100000):
+        stripes = max(1, stripes)
+        self.stripe_size = max(1, max_size // stripes)
+        # every stripe is a list [lock, buffer, stale, dropped]
+        self.stripes = [[threading.Lock(), dict(), 0, 0]
+            for i in xrange(stripes)]
+
+    def _stripe(self, visit_key):
+        return self.stripes[hash(visit_key) % len(self.stripes)]
+
+    def __len__(self):
+        return sum([len(stripe[1]) for stripe in self.stripes])
+
+    def __contains__(self, visit_key):
+        return visit_key in self._stripe(visit_key)[1]
+
+    def get(self, visit_key, default=None):
+        return self._stripe(visit_key)[1].get(visit_key, default)
+
+    def stale(self):
+        """Return the number of stale updates dropped so far."""
+        return sum([stripe[2] for stripe in self.stripes])
+
+    def dropped(self):
+        """Return the number of updates dropped because of a full queue."""
+        return sum([stripe[3] for stripe in self.stripes])
+
+    def put(self, visit_key, expiry):
+        """Queue the new expiry for the visit.
+
+        Return the number of visits now queued in the stripe of the visit,
+        or None if the update was dropped as stale or for a full queue.
+
+        """
+        stripe = self._stripe(visit_key)
+        lock = stripe[0]
+        lock.acquire()
+        try:
+            buffer = stripe[1]
+            queued = buffer.get(visit_key)
+            if queued is not None:
+                if queued >= expiry:
+                    stripe[2] += 1
+                    return None
+            elif len(buffer) >= self.stripe_size:
+                stripe[3] += 1
+                return None
+            buffer[visit_key] = expiry
+            return len(buffer)
+        finally:
+            lock.release()
+
+    def swap(self):
+        """Empty the queue and return the pending updates as a dict."""
+        queue = dict()
+        for stripe in self.stripes:
+            lock = stripe[0]
+            lock.acquire()
+            try:
+                pending, stripe[1] = stripe[1], dict()
+            finally:
+                lock.release()
+            queue.update(pending)
+        return queue
+
+
 class BaseVisitManager(threading.Thread):
 
     def __init__(self, timeout):
         super(BaseVisitManager, self).__init__(name="VisitManager")
         self.timeout = timeout
-        self.queue = dict()
-        self.lock = threading.Lock()
+        get = config.get
+        # Only extend visits when less than this is remaining until expiry
+        self.extend_below = extend_below(timeout)
+        # Pending expiry updates, written to the storage every interval
+        self.queue = VisitUpdateQueue(get("tools.visit.queue.stripes", 16),
+            get("tools.visit.queue.max_size", 100000))
+        # Flush early if this many visits are queued
+        self.high_water = get("tools.visit.queue.high_water", 10000)
         self._shutdown = threading.Event()
-        self.interval = 30
+        self._flush = threading.Event()
+        # The interval between flushes adapts to the load, between
+        # min_interval and max_interval seconds
+        self.max_interval = get("tools.visit.interval", 30)
+        self.min_interval = min(get("tools.visit.min_interval", 5),
+            self.max_interval)
+        self.interval = self.max_interval
+        # Cache of visit expiry times, so that requests of active visits
+        # don't need to hit the visit storage.
+        self.cache = VisitCache(config.get("tools.visit.cache.size", 10000),
+            config.get("tools.visit.cache.ttl", 60))
+        # Expired visits are deleted every gc_interval seconds in chunks of
+        # gc_chunk_size visits, but not more than gc_max_chunks chunks at once
+        self.gc_interval = config.get("tools.visit.gc.interval", 600)
+        self.gc_chunk_size = config.get("tools.visit.gc.chunk_size", 500)
+        self.gc_max_chunks = config.get("tools.visit.gc.max_chunks", 20)
+        self._next_gc = time.time() + self.gc_interval
+        self.stats = dict(extend_suppressed=0, flush_runs=0, flush_updates=0,
+            flush_last_updates=0, flush_last_duration=0.0,
+            flush_max_duration=0.0, gc_runs=0, gc_deleted=0,
+            gc_last_deleted=0, gc_last_duration=0.0)
+        # for the statistics updated by the request threads
+        self._stats_lock = threading.Lock()
         self.setDaemon(True)
         # We need to create the visit model before the manager thread is
         # started.
@@ -236,9 +691,30 @@ class BaseVisitManager(threading.Thread):
     def create_model(self):
         pass
 
+    def create_visit(self, visit_key, created, expiry):
+        """Store a new visit with the given key in the visit storage.
+
+        May return False if the visit could not be stored.
+
+        """
+        raise NotImplementedError
+
+    def lookup_expiry(self, visit_key):
+        """Return the expiry of the stored visit with this key.
+
+        Return None if the visit doesn't exist.
+
+        """
+        raise NotImplementedError
+
     def new_visit_with_key(self, visit_key):
         """Return a new Visit object with the given key."""
-        raise NotImplementedError
+        created = datetime.now()
+        expiry = created + self.timeout
+        if self.create_visit(visit_key, created, expiry) is False:
+            return None
+        self.cache.put(visit_key, expiry)
+        return Visit(visit_key, True)
 
     def visit_for_key(self, visit_key):
         """Return the visit for this key.
@@ -246,36 +722,137 @@ class BaseVisitManager(threading.Thread):
         Return None if the visit doesn't exist or has expired.
 
         """
-        raise NotImplementedError
+        expiry = self.cache.get(visit_key)
+        if expiry is None:
+            expiry = self.lookup_expiry(visit_key)
+            if expiry is None:
+                return None
+            if expiry < datetime.now(expiry.tzinfo):
+                return None
+            self.cache.put(visit_key, expiry)
+        # Visit hasn't expired, extend it if it is going to expire soon
+        now = datetime.now(expiry.tzinfo)
+        if expiry - now < self.extend_below:
+            self.update_visit(visit_key, now + self.timeout)
+        else:
+            self._stats_lock.acquire()
+            try:
+                self.stats['extend_suppressed'] += 1
+            finally:
+                self._stats_lock.release()
+        return Visit(visit_key, False)
 
     def update_queued_visits(self, queue):
         """Extend the expiration of the queued visits."""
         raise NotImplementedError
 
+    def delete_expired_visits(self, before, limit):
+        """Delete up to limit visits that expired before the given time.
+
+        The visits with the earliest expiry should be deleted first.
+        Return the number of deleted visits.
+
+        """
+        raise NotImplementedError
+
+    def collect_garbage(self):
+        """Delete expired visits in chunks if the gc interval has passed."""
+        if not self.gc_interval or time.time() < self._next_gc:
+            return
+        self._next_gc = time.time() + self.gc_interval
+        # Give visits extended by the last flush some time to be stored
+        before = datetime.now() - timedelta(seconds=self.max_interval)
+        start = time.time()
+        deleted = 0
+        try:
+            for chunk in xrange(self.gc_max_chunks):
+                count = self.delete_expired_visits(before, self.gc_chunk_size)
+                deleted += count
+                if count < self.gc_chunk_size or self._shutdown.isSet():
+                    break
+        except NotImplementedError:
+            log.info("Visit manager can't delete expired visits.")
+            self.gc_interval = 0
+            return
+        except Exception:
+            log.exception("Error deleting expired visits.")
+        duration = time.time() - start
+        stats = self.stats
+        stats['gc_runs'] += 1
+        stats['gc_deleted'] += deleted
+        stats['gc_last_deleted'] = deleted
+        stats['gc_last_duration'] = duration
+        log.info("Deleted %d expired visits in %.3f seconds",
+            deleted, duration)
+
+    def cookie_value(self, visit):
+        """Return the value of the visit cookie to be sent or None."""
+        return visit.key
+
     def update_visit(self, visit_key, expiry):
+        queued = self.queue.put(visit_key, expiry)
+        if queued is None:
+            # the cache must not claim an expiry that is not persisted
+            return
+        if queued * len(self.queue.stripes) > self.high_water:
+            # wake up the flusher
+            self._flush.set()
+        self.cache.update(visit_key, expiry)
+
+    def invalidate(self, visit_key):
+        """Forget the cached expiry of the visit with the given key."""
+        self.cache.remove(visit_key)
+
+    def get_stats(self):
+        """Return the current statistics of the visit manager."""
+        self._stats_lock.acquire()
         try:
-            self.lock.acquire()
-            self.queue[visit_key] = expiry
+            stats = dict(self.stats)
         finally:
-            self.lock.release()
+            self._stats_lock.release()
+        stats.update(queue_depth=len(self.queue),
+            queue_stale=self.queue.stale(), queue_dropped=self.queue.dropped(),
+            interval=self.interval)
+        return stats
+
+    def flush(self):
+        """Write the pending expiry updates and adapt the flush interval."""
+        # take the pending updates and leave an empty queue
+        queue = self.queue.swap()
+        if not queue:
+            self.interval = self.max_interval
+            return
+        start = time.time()
+        self.update_queued_visits(queue)
+        duration = time.time() - start
+        stats = self.stats
+        stats['flush_runs'] += 1
+        stats['flush_updates'] += len(queue)
+        stats['flush_last_updates'] = len(queue)
+        stats['flush_last_duration'] = duration
+        stats['flush_max_duration'] = max(
+            stats['flush_max_duration'], duration)
+        # Flush more often when many visits are queued, so that single
+        # flushes stay small, and less often otherwise. Never flush more
+        # often than flushing itself takes.
+        if len(queue) > self.high_water // 2:
+            interval = self.interval / 2.0
+        else:
+            interval = self.interval * 2
+        self.interval = max(self.min_interval,
+            min(self.max_interval, interval), duration)
 
     def shutdown(self, timeout=None):
         self._shutdown.set()
+        self._flush.set()
         self.join(timeout)
         if self.isAlive():
             log.error("Visit Manager thread failed to shutdown.")
+        self.cache.clear()
 
     def run(self):
         while not self._shutdown.isSet():
-            self.lock.acquire()
-            queue = None
-            try:
-                # make a copy of the queue and empty the original
-                if self.queue:
-                    queue = self.queue.copy()
-                    self.queue.clear()
-            finally:
-                self.lock.release()
-            if queue is not None:
-                self.update_queued_visits(queue)
-            self._shutdown.wait(self.interval)
+            self.flush()
+            self.collect_garbage()
+            self._flush.wait(self.interval)
+            self._flush.clear()
@@ -8,7 +8,7 @@ from couchdb.schema import Document, Schema, BooleanField, DateTimeField, \
 
 from gearshift import config
 from gearshift.util import load_class
-from gearshift.visit.api import BaseVisitManager, Visit
+from gearshift.visit.api import BaseVisitManager
 from gearshift.database.cd import datastore
 
 log = logging.getLogger("gearshift.visit.cdvisit")
@@ -17,6 +17,9 @@ visit_class = None
 
 class CouchDbVisitManager(BaseVisitManager):
 
+    # how often conflicting visit updates are retried
+    conflict_retries = 3
+
     def __init__(self, timeout):
         global visit_class
         visit_class_path = config.get("tools.visit.cdprovider.model",
@@ -25,20 +28,20 @@ class CouchDbVisitManager(BaseVisitManager):
         if not visit_class:
             log.error("Error loading \"%s\"" % visit_class_path)
         
-        self.create_model()
         self.timeout = timeout
         
         super(CouchDbVisitManager, self).__init__(timeout)
 
     def create_model(self):
-        # Nothing to do here
-        return
+        """Create the design document for the visit views."""
+        try:
+            visit_class.by_expiry.sync(datastore.db)
+        except Exception, e:
+            log.error("Error creating the visit views: %s", e)
 
-    def new_visit_with_key(self, visit_key):
-        expiry = datetime.now()+self.timeout
-        
+    def create_visit(self, visit_key, created, expiry):
         key = "VISIT:%s" % visit_key
-        visit = visit_class(id=key, expiry=expiry)
+        visit = visit_class(id=key, created=created, expiry=expiry)
         try:
             visit.store(datastore.db)
         except ResourceConflict:
@@ -46,38 +49,83 @@ class CouchDbVisitManager(BaseVisitManager):
         except AttributeError:
             # AttributeError: 'NoneType' object has no attribute 'makefile'
             log.error("CouchDB server is down")
-            return None
-        
-        return Visit(visit_key, True)
+            return False
 
-    def visit_for_key(self, visit_key):
-        """Return the visit for this key.
+    def lookup_expiry(self, visit_key):
+        """Return the expiry of the visit with this key.
 
-        Returns None if the visit doesn't exist or has expired.
+        Returns None if the visit doesn't exist.
 
         """
         visit = visit_class.lookup_visit(visit_key)
-        now = datetime.now()
-        
-        if visit is None or visit.expiry < now:
+        if visit is None:
             return None
-        
-        # Visit hasn't expired, extend it
-        self.update_visit(visit_key, now+self.timeout)
-        return Visit(visit_key, False)
+        return visit.expiry
         
     def update_queued_visits(self, queue):
-        for visit_key, expiry in queue.items():
-            visit = visit_class.load(datastore.db, "VISIT:%s" % visit_key)
-            visit.expiry = expiry
-            visit.store(datastore.db)
-        
+        """Extend the expiration of the queued visits.
+
+        The current revisions of all visits are fetched with a single
+        multi-key request and the updated visits are written back with a
+        single bulk request. Visits with conflicting updates are retried.
+
+        """
+        db = datastore.db
+        pending = dict([("VISIT:%s" % visit_key, expiry)
+            for visit_key, expiry in queue.iteritems()])
+        for attempt in xrange(self.conflict_retries + 1):
+            docs = []
+            for row in db.view('_all_docs', keys=pending.keys(),
+                    include_docs=True):
+                doc = row.get('doc')
+                if doc is None:
+                    # visit has been deleted in the meantime
+                    continue
+                visit = visit_class.wrap(doc)
+                visit.expiry = pending[doc['_id']]
+                docs.append(visit.unwrap())
+            if not docs:
+                break
+            conflicts = dict()
+            for success, doc_id, rev_or_exc in db.update(docs):
+                if not success:
+                    if isinstance(rev_or_exc, ResourceConflict):
+                        conflicts[doc_id] = pending[doc_id]
+                    else:
+                        log.error("Error updating visit %s: %s",
+                            doc_id, rev_or_exc)
+            if not conflicts:
+                break
+            pending = conflicts
+        else:
+            log.error("Giving up updating %d visits after conflicts",
+                len(pending))
+
+    def delete_expired_visits(self, before, limit):
+        db = datastore.db
+        # DateTimeFields are stored as ISO 8601 strings that sort correctly
+        rows = visit_class.by_expiry(db,
+            endkey=visit_class(expiry=before).unwrap()['expiry'],
+            limit=limit)
+        docs = [dict(_id=row.id, _rev=row.value, _deleted=True)
+            for row in rows]
+        if docs:
+            db.update(docs)
+        return len(docs)
+
 class TG_Visit(Document):
     type = TextField(default="Visit")
 
     created = DateTimeField(default=datetime.now)
     expiry = DateTimeField()
 
+    by_expiry = View('visit', """
+        function(doc) {
+            if (doc.type == 'Visit') {
+                emit(doc.expiry, doc._rev);
+            }
+        }""", wrapper=None)
+
     @classmethod
     def lookup_visit(cls, visit_key):
         key = "VISIT:%s" % visit_key
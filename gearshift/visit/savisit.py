@@ -1,10 +1,12 @@
+import time
 from datetime import datetime
 
-from sqlalchemy import Table, Column, String, DateTime
+from sqlalchemy import Table, Column, String, DateTime, bindparam, select
 from sqlalchemy.orm import class_mapper
 
 from gearshift import config
-from gearshift.database import get_engine, bind_metadata, metadata, session, mapper
+from gearshift.database.sa.sa import get_engine, bind_metadata, metadata, \
+    session, mapper
 from gearshift.util import load_class
 from gearshift.visit.api import BaseVisitManager, Visit
 
@@ -38,41 +40,78 @@ class SqlAlchemyVisitManager(BaseVisitManager):
         bind_metadata()
         class_mapper(visit_class).local_table.create(checkfirst=True)
 
-    def new_visit_with_key(self, visit_key):
-        created = datetime.now()
+    def create_visit(self, visit_key, created, expiry):
         visit = visit_class()
         visit.visit_key = visit_key
         visit.created = created
-        visit.expiry = created + self.timeout
+        visit.expiry = expiry
         session.flush()
-        return Visit(visit_key, True)
 
-    def visit_for_key(self, visit_key):
-        """Return the visit for this key.
+    def lookup_expiry(self, visit_key):
+        """Return the expiry of the visit with this key.
 
-        Returns None if the visit doesn't exist or has expired.
+        Returns None if the visit doesn't exist.
 
         """
         visit = visit_class.lookup_visit(visit_key)
-        if not visit:
-            return None
-        now = datetime.now(visit.expiry.tzinfo)
-        if visit.expiry < now:
-            return None
-
-        # Visit hasn't expired, extend it
-        self.update_visit(visit_key, now+self.timeout)
-        return Visit(visit_key, False)
+        return visit and visit.expiry or None
 
     def update_queued_visits(self, queue):
-        # TODO this should be made transactional
-        table = class_mapper(visit_class).mapped_table
-        engine = table.bind
+        """Extend the expiration of the queued visits.
+
+        All visits are updated in one transaction with a single executemany
+        UPDATE statement, honouring the column names of the visit class.
+
+        """
+        if not queue:
+            return
+        visit_mapper = class_mapper(visit_class)
+        table = visit_mapper.mapped_table
+        key_column = visit_mapper.get_property('visit_key').columns[0]
+        expiry_column = visit_mapper.get_property('expiry').columns[0]
+        update = table.update(key_column == bindparam('_visit_key'),
+            values={expiry_column.key: bindparam('_expiry')})
         # Now update each of the visits with the most recent expiry
-        for visit_key, expiry in queue.items():
-            log.info("updating visit (%s) to expire at %s", visit_key, expiry)
-            # FIXME: Need to support custom column names
-            engine.execute(table.update(table.c.visit_key==visit_key, values={'expiry': expiry}))
+        params = [dict(_visit_key=visit_key, _expiry=expiry)
+            for visit_key, expiry in queue.iteritems()]
+        start = time.time()
+        conn = table.bind.connect()
+        try:
+            trans = conn.begin()
+            try:
+                conn.execute(update, params)
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
+        log.info("Updated expiry of %d visits in %.3f seconds",
+            len(params), time.time() - start)
+
+    def delete_expired_visits(self, before, limit):
+        visit_mapper = class_mapper(visit_class)
+        table = visit_mapper.mapped_table
+        key_column = visit_mapper.get_property('visit_key').columns[0]
+        expiry_column = visit_mapper.get_property('expiry').columns[0]
+        conn = table.bind.connect()
+        try:
+            trans = conn.begin()
+            try:
+                # Select the keys first, since not all databases support
+                # subqueries with a limit in DELETE statements
+                keys = [row[0] for row in conn.execute(select([key_column],
+                    expiry_column < before, order_by=[expiry_column],
+                    limit=limit))]
+                if keys:
+                    conn.execute(table.delete(key_column.in_(keys)))
+                trans.commit()
+            except:
+                trans.rollback()
+                raise
+        finally:
+            conn.close()
+        return len(keys)
 
 
 # The Visit table
@@ -80,7 +119,7 @@ class SqlAlchemyVisitManager(BaseVisitManager):
 visits_table = Table('tg_visit', metadata,
     Column('visit_key', String(40), primary_key=True),
     Column('created', DateTime, nullable=False, default=datetime.now),
-    Column('expiry', DateTime)
+    Column('expiry', DateTime, index=True)
 )
 
 
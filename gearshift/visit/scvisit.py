@@ -0,0 +1,134 @@
+"""A visit manager keeping all visit information in a signed cookie.
+
+The visit key, the creation time and the expiry of the visit are encoded
+into the cookie value together with an HMAC signature, so visits need no
+storage at all. Enable it with:
+
+    tools.visit.manager = "gearshift.visit.scvisit.SignedCookieVisitManager"
+    tools.visit.signed.secret = "some long random string"
+
+The cookie is only re-issued when less than the fraction of the visit
+timeout given by tools.visit.signed.renew (default 0.5) is remaining.
+
+"""
+
+import hmac
+import logging
+import time
+try:
+	from hashlib import sha1
+except ImportError:
+	import sha as sha1
+from datetime import datetime
+
+from gearshift import config
+from gearshift.visit.api import Visit
+
+log = logging.getLogger("gearshift.visit.scvisit")
+
+
+def _compare_digest(a, b):
+    """Compare two strings in time independent of their common prefix."""
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class SignedCookieVisitManager(object):
+
+    def __init__(self, timeout):
+        get = config.get
+        self.timeout = timeout
+        self.timeout_seconds = timeout.days * 86400 + timeout.seconds
+        secret = get("tools.visit.signed.secret", None)
+        if not secret:
+            raise config.ConfigError(
+                "tools.visit.signed.secret must be set for signed visit"
+                " cookies")
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        self.secret = secret
+        # re-issue the cookie when less than this fraction of the timeout
+        # is remaining
+        self.renew = float(get("tools.visit.signed.renew", 0.5))
+
+    def create_model(self):
+        # Nothing to do here
+        return
+
+    def shutdown(self, timeout=None):
+        return
+
+    def invalidate(self, visit_key):
+        return
+
+    def sign(self, value):
+        """Return the HMAC signature for the value."""
+        return hmac.new(self.secret, value, sha1).hexdigest()
+
+    def encode(self, visit):
+        """Return the signed cookie value for the visit."""
+        value = '%s-%x-%x' % (visit.key,
+            int(time.mktime(visit.created.timetuple())),
+            int(time.mktime(visit.expiry.timetuple())))
+        return '%s-%s' % (value, self.sign(value))
+
+    def decode(self, cookie_value):
+        """Return key, creation and expiry time from a signed cookie value.
+
+        Returns None if the value is malformed or the signature is invalid.
+
+        """
+        try:
+            value, signature = str(cookie_value).rsplit('-', 1)
+            visit_key, created, expiry = value.split('-')
+            created, expiry = int(created, 16), int(expiry, 16)
+        except (ValueError, UnicodeError):
+            return None
+        if not _compare_digest(self.sign(value), signature):
+            log.warning("Invalid signature of visit cookie: %s", cookie_value)
+            return None
+        return visit_key, created, expiry
+
+    def new_visit_with_key(self, visit_key):
+        """Return a new Visit object with the given key."""
+        now = int(time.time())
+        visit = Visit(visit_key, True)
+        visit.created = datetime.fromtimestamp(now)
+        visit.expiry = datetime.fromtimestamp(now + self.timeout_seconds)
+        return visit
+
+    def visit_for_key(self, cookie_value):
+        """Return the visit for this signed cookie value.
+
+        Returns None if the cookie is invalid or the visit has expired.
+
+        """
+        decoded = self.decode(cookie_value)
+        if decoded is None:
+            return None
+        visit_key, created, expiry = decoded
+        now = int(time.time())
+        if expiry < now:
+            return None
+        visit = Visit(visit_key, False)
+        visit.created = datetime.fromtimestamp(created)
+        visit.expiry = datetime.fromtimestamp(expiry)
+        if expiry - now < self.renew * self.timeout_seconds:
+            # Extend the visit, the cookie will be re-issued
+            visit.expiry = datetime.fromtimestamp(now + self.timeout_seconds)
+            visit.renewed = True
+        return visit
+
+    def cookie_value(self, visit):
+        """Return the value of the visit cookie or None.
+
+        The cookie needs only to be sent for new or renewed visits.
+
+        """
+        if visit.is_new or getattr(visit, 'renewed', False):
+            return self.encode(visit)
+        return None
@@ -0,0 +1,288 @@
+"""A visit manager sharing visit expiry times between local processes.
+
+Several processes on one host can share a memory-mapped file holding a
+fixed-size hash table that maps visit keys to their expiry. Visits found
+in the table need no database query, no matter which process created or
+last extended them. Visits are still stored and extended through a backend
+visit manager, which persists them to the database in the background.
+Enable it with:
+
+    tools.visit.manager = "gearshift.visit.shmvisit.SharedMemoryVisitManager"
+    tools.visit.shm.backend = "gearshift.visit.savisit.SqlAlchemyVisitManager"
+    tools.visit.shm.path = "/var/run/myapp/visits.shm"
+    tools.visit.shm.slots = 65536
+
+"""
+
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+try:
+    import fcntl
+except ImportError: # Windows
+    fcntl = None
+from datetime import datetime
+
+from gearshift import config
+from gearshift.util import load_class
+from gearshift.visit.api import Visit, extend_below
+
+log = logging.getLogger("gearshift.visit.shmvisit")
+
+
+class VisitTable(object):
+    """A fixed-slot hash table of visit expiry times in a shared file.
+
+    Every slot holds a visit key of up to 40 bytes, the expiry as seconds
+    since the epoch and a checksum over both. A slot is always written as
+    a whole, holding a lock on its byte range where fcntl is available.
+    Readers don't lock; a slot that is being written concurrently fails
+    the checksum and is treated as missing. Since the table is only a
+    cache in front of the visit storage, entries may be evicted at will.
+
+    """
+
+    magic = 'GSVISIT1'
+    header = struct.Struct('!8sQ')
+    slot = struct.Struct('!40sqL')
+    # how many neighbouring slots are tried for a key
+    probes = 8
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        self.size = self.header.size + slots * self.slot.size
+        fd = self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        self._lock(0, self.header.size)
+        try:
+            if not os.fstat(fd).st_size:
+                # a new file has not been mapped by any process yet
+                log.info("Initializing shared visit table %s", path)
+                self._initialize(fd)
+            elif not self._compatible(fd):
+                self.fd = self._replace()
+        finally:
+            if fcntl:
+                fcntl.lockf(fd, fcntl.LOCK_UN, self.header.size, 0)
+        if self.fd != fd:
+            os.close(fd)
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def _initialize(self, fd):
+        os.ftruncate(fd, self.size)
+        os.lseek(fd, 0, 0)
+        os.write(fd, self.header.pack(self.magic, self.slots))
+
+    def _compatible(self, fd):
+        """Check whether the file holds a table with the same slots."""
+        os.lseek(fd, 0, 0)
+        head = os.read(fd, self.header.size)
+        return (len(head) == self.header.size
+            and self.header.unpack(head) == (self.magic, self.slots)
+            and os.fstat(fd).st_size >= self.size)
+
+    def _replace(self):
+        """Put a new table in place of an incompatible one.
+
+        Other processes may still have the old file mapped and would crash
+        if it was truncated, so a new file is renamed into its place. The
+        other processes use the old table until they are restarted.
+
+        """
+        log.warning("Replacing shared visit table %s, which has another "
+            "number of slots or format", self.path)
+        fd, tmpname = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)))
+        try:
+            self._initialize(fd)
+            os.rename(tmpname, self.path)
+        except:
+            os.close(fd)
+            os.remove(tmpname)
+            raise
+        return fd
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def _lock(self, offset, length):
+        if fcntl:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, offset)
+
+    def _unlock(self, offset, length):
+        if fcntl:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+    def _offsets(self, visit_key):
+        index = zlib.crc32(visit_key) & 0xffffffff
+        for probe in xrange(self.probes):
+            yield (self.header.size
+                + ((index + probe) % self.slots) * self.slot.size)
+
+    def _read(self, offset):
+        """Return key and expiry stored at the offset or (None, 0)."""
+        key, expiry, checksum = self.slot.unpack(
+            self.map[offset:offset + self.slot.size])
+        if not expiry or checksum != self._checksum(key, expiry):
+            return None, 0
+        return key.rstrip('\0'), expiry
+
+    def _checksum(self, key, expiry):
+        return zlib.crc32(struct.pack('!40sq', key, expiry)) & 0xffffffff
+
+    def _write(self, offset, visit_key, expiry):
+        size = self.slot.size
+        self._lock(offset, size)
+        try:
+            self.map[offset:offset + size] = self.slot.pack(visit_key,
+                expiry, self._checksum(visit_key.ljust(40, '\0'), expiry))
+        finally:
+            self._unlock(offset, size)
+
+    def get(self, visit_key):
+        """Return the expiry of the visit in seconds or None."""
+        visit_key = str(visit_key)
+        for offset in self._offsets(visit_key):
+            key, expiry = self._read(offset)
+            if key == visit_key:
+                return expiry
+        return None
+
+    def put(self, visit_key, expiry):
+        """Store the expiry of the visit in seconds.
+
+        The visit takes the slot already holding it, an empty or expired
+        slot, or else the slot of the visit that expires first.
+
+        """
+        visit_key = str(visit_key)
+        if len(visit_key) > 40:
+            return
+        now = time.time()
+        target = target_expiry = None
+        for offset in self._offsets(visit_key):
+            key, slot_expiry = self._read(offset)
+            if key == visit_key or slot_expiry < now:
+                target = offset
+                break
+            if target is None or slot_expiry < target_expiry:
+                target, target_expiry = offset, slot_expiry
+        self._write(target, visit_key, expiry)
+
+    def remove(self, visit_key):
+        """Remove the visit from the table."""
+        visit_key = str(visit_key)
+        for offset in self._offsets(visit_key):
+            key, expiry = self._read(offset)
+            if key == visit_key:
+                self._write(offset, '', 0)
+
+
+class SharedMemoryVisitManager(object):
+
+    def __init__(self, timeout):
+        get = config.get
+        self.timeout = timeout
+        self.timeout_seconds = timeout.days * 86400 + timeout.seconds
+        below = extend_below(timeout)
+        self.extend_below_seconds = below.days * 86400 + below.seconds
+        backend_path = get("tools.visit.shm.backend",
+            "gearshift.visit.savisit.SqlAlchemyVisitManager")
+        backend = load_class(backend_path)
+        if backend is None:
+            raise RuntimeError("VisitManager plugin missing: %s"
+                % backend_path)
+        self.backend = backend(timeout)
+        self.table = VisitTable(get("tools.visit.shm.path", "visits.shm"),
+            get("tools.visit.shm.slots", 65536))
+        self.stats = dict(shm_hits=0, shm_misses=0)
+        self._stats_lock = threading.Lock()
+
+    def create_model(self):
+        self.backend.create_model()
+
+    def shutdown(self, timeout=None):
+        self.backend.shutdown(timeout)
+        self.table.close()
+
+    def invalidate(self, visit_key):
+        self.table.remove(visit_key)
+        self.backend.invalidate(visit_key)
+
+    def get_stats(self):
+        """Return the current statistics of the visit manager."""
+        stats = self.backend.get_stats()
+        self._stats_lock.acquire()
+        try:
+            stats.update(self.stats)
+        finally:
+            self._stats_lock.release()
+        return stats
+
+    def _count(self, name):
+        self._stats_lock.acquire()
+        try:
+            self.stats[name] += 1
+        finally:
+            self._stats_lock.release()
+
+    def _backend_expiry(self, visit_key):
+        """Return the expiry of the visit known to the backend or None.
+
+        This is the expiry cached or queued by the backend, which may or may
+        not have extended the visit, or else the one in the visit storage.
+
+        """
+        backend = self.backend
+        expiry = backend.cache.get(visit_key)
+        if expiry is None:
+            expiry = backend.queue.get(visit_key) or backend.lookup_expiry(
+                visit_key)
+        if expiry is None:
+            return None
+        return int(time.mktime(expiry.timetuple()))
+
+    def cookie_value(self, visit):
+        """Return the value of the visit cookie to be sent or None."""
+        return self.backend.cookie_value(visit)
+
+    def new_visit_with_key(self, visit_key):
+        """Return a new Visit object with the given key."""
+        visit = self.backend.new_visit_with_key(visit_key)
+        if visit is not None:
+            self.table.put(visit_key, int(time.time()) + self.timeout_seconds)
+        return visit
+
+    def visit_for_key(self, visit_key):
+        """Return the visit for this key.
+
+        Return None if the visit doesn't exist or has expired.
+
+        """
+        expiry = self.table.get(visit_key)
+        now = int(time.time())
+        if expiry is None or expiry < now:
+            self._count('shm_misses')
+            visit = self.backend.visit_for_key(visit_key)
+            if visit is not None:
+                # the backend only extends the visit if it expires soon
+                expiry = self._backend_expiry(visit_key)
+                if expiry is not None:
+                    self.table.put(visit_key, expiry)
+            return visit
+        self._count('shm_hits')
+        # Visit hasn't expired, extend it if it is going to expire soon
+        if expiry - now < self.extend_below_seconds:
+            self.backend.update_visit(visit_key,
+                datetime.fromtimestamp(now + self.timeout_seconds))
+            # the backend may have dropped the update for a full queue
+            expiry = self._backend_expiry(visit_key)
+            if expiry is not None:
+                self.table.put(visit_key, expiry)
+        return Visit(visit_key, False)
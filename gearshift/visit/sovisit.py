@@ -1,12 +1,13 @@
 from datetime import datetime
 
-from sqlobject import SQLObject, SQLObjectNotFound, StringCol, DateTimeCol
-from sqlobject.sqlbuilder import Update
+from sqlobject import SQLObject, SQLObjectNotFound, StringCol, DateTimeCol, \
+    DatabaseIndex
+from sqlobject.sqlbuilder import Delete, IN, Select, Update
 
 from gearshift import config
 from gearshift.database.so import PackageHub
 from gearshift.util import load_class
-from gearshift.visit.api import BaseVisitManager, Visit
+from gearshift.visit.api import BaseVisitManager
 
 hub = PackageHub("gearshift.visit")
 __connection__ = hub
@@ -43,27 +44,21 @@ class SqlObjectVisitManager(BaseVisitManager):
             log.info("No database is configured: Visit Tracking is disabled.")
             return
 
-    def new_visit_with_key(self, visit_key):
+    def create_visit(self, visit_key, created, expiry):
         hub.begin()
-        visit = visit_class(visit_key=visit_key,
-            expiry=datetime.now()+self.timeout)
+        visit = visit_class(visit_key=visit_key, created=created,
+            expiry=expiry)
         hub.commit()
         hub.end()
-        return Visit(visit_key, True)
 
-    def visit_for_key(self, visit_key):
-        """Return the visit for this key.
+    def lookup_expiry(self, visit_key):
+        """Return the expiry of the visit with this key.
 
-        Returns None if the visit doesn't exist or has expired.
+        Returns None if the visit doesn't exist.
 
         """
         visit = visit_class.lookup_visit(visit_key)
-        now = datetime.now()
-        if not visit or visit.expiry < now:
-            return None
-        # Visit hasn't expired, extend it
-        self.update_visit(visit_key, now+self.timeout)
-        return Visit(visit_key, False)
+        return visit and visit.expiry or None
 
     def update_queued_visits(self, queue):
         if hub is None: # if VisitManager extension wasn't shutted down cleanly
@@ -85,6 +80,27 @@ class SqlObjectVisitManager(BaseVisitManager):
         finally:
             hub.end()
 
+    def delete_expired_visits(self, before, limit):
+        if hub is None: # if VisitManager extension wasn't shutted down cleanly
+            return 0
+        hub.begin()
+        try:
+            conn = hub.getConnection()
+            try:
+                q = visit_class.q
+                ids = [row[0] for row in conn.queryAll(conn.sqlrepr(
+                    Select(q.id, where=(q.expiry < before),
+                        orderBy=q.expiry, limit=limit)))]
+                if ids:
+                    conn.query(conn.sqlrepr(Delete(q, where=IN(q.id, ids))))
+                hub.commit()
+            except:
+                hub.rollback()
+                raise
+        finally:
+            hub.end()
+        return len(ids)
+
 class TG_Visit(SQLObject):
 
     class sqlmeta:
@@ -94,6 +110,7 @@ class TG_Visit(SQLObject):
             alternateMethodName="by_visit_key")
     created = DateTimeCol(default=datetime.now)
     expiry = DateTimeCol()
+    expiry_index = DatabaseIndex('expiry')
 
     @classmethod
     def lookup_visit(cls, visit_key):
@@ -6,7 +6,7 @@ import cherrypy
 
 from gearshift import config
 from gearshift.util import load_class
-from gearshift.visit.api import BaseVisitManager, Visit
+from gearshift.visit.api import BaseVisitManager
 
 import logging
 
@@ -30,27 +30,21 @@ class StormVisitManager(BaseVisitManager):
     def create_model(self):
         return
 
-    def new_visit_with_key(self, visit_key):
+    def create_visit(self, visit_key, created, expiry):
         store = cherrypy.thread_data.store
 
-        visit = visit_class(visit_key=visit_key,
-            expiry=datetime.now()+self.timeout)
+        visit = visit_class(visit_key=visit_key, created=created,
+            expiry=expiry)
         store.add(visit)
-        return Visit(visit_key, True)
 
-    def visit_for_key(self, visit_key):
-        """Return the visit for this key.
+    def lookup_expiry(self, visit_key):
+        """Return the expiry of the visit with this key.
 
-        Returns None if the visit doesn't exist or has expired.
+        Returns None if the visit doesn't exist.
 
         """
         visit = visit_class.lookup_visit(visit_key)
-        now = datetime.now()
-        if not visit or visit.expiry < now:
-            return None
-        # Visit hasn't expired, extend it
-        self.update_visit(visit_key, now+self.timeout)
-        return Visit(visit_key, False)
+        return visit and visit.expiry or None
 
     def update_queued_visits(self, queue):
         # TODO: get_connection()
@@ -70,6 +64,26 @@ class StormVisitManager(BaseVisitManager):
         finally:
             store.close()
 
+    def delete_expired_visits(self, before, limit):
+        database = create_database(config.get('storm.dburi'))
+        store = Store(database)
+
+        try:
+            try:
+                ids = list(store.find(visit_class.id,
+                    visit_class.expiry < before).order_by(
+                    visit_class.expiry)[:limit])
+                if ids:
+                    store.find(visit_class,
+                        visit_class.id.is_in(ids)).remove()
+                store.commit()
+            except:
+                store.rollback()
+                raise
+        finally:
+            store.close()
+        return len(ids)
+
 class TG_Visit(object):
 
     __storm_table__ = "tg_visit"